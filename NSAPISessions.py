@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: API Sessions
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# api responses used to all go to the shared api_response topic, so every open browser received and parsed every other browser's responses
+#   a request can now name its own reply topic in content.reply_to, under api_response/, which only that session subscribes to
+#   content.id is the correlation id: it comes back in the response, so the session can match the response to its request
+#   requests without reply_to (ex: scripts written against the old api) still get their response on api_response
+# the broker forgets a session's subscription when it disconnects, so there is nothing to tear down there
+#   we remember sessions only to report on them, and forget those which made no request for idle_timeout seconds
+#   the browser drops its own requests which were never answered, see APICall
+
+import re
+import time
+import logging
+
+SHARED_REPLY_TOPIC = 'api_response'
+# no wildcards or deeper levels, so a request can not make us publish anywhere else
+REPLY_TOPIC_PATTERN = re.compile(r'^api_response/[A-Za-z0-9_.-]{1,128}$')
+
+
+class NSAPISessions:
+    """
+    Picks the reply topic for each api request, and keeps track of the sessions using their own
+    """
+
+    def __init__(self, loop, idle_timeout=3600, cleanup_cycle=300):
+        """
+        API Sessions
+        :param loop: asyncio loop
+        :type loop: AbstractEventLoop
+        :param idle_timeout: forget a session after this many seconds without a request
+        :type idle_timeout: int
+        :param cleanup_cycle: seconds between looking for idle sessions
+        :type cleanup_cycle: int
+        """
+        self.loop = loop
+        self.idle_timeout = idle_timeout
+        self.cleanup_cycle = cleanup_cycle
+        self.sessions = {}  # reply topic -> last request, time.monotonic()
+        self.session_replies = 0
+        self.shared_replies = 0
+        self.rejected = 0
+        self.expired = 0
+        self.cleanup_handle = self.loop.call_later(self.cleanup_cycle, self.cleanup)
+
+    def get_reply_topic(self, content):
+        """
+        Choose where to publish the response to a request
+        :param content: content of the request message
+        :type content: dict
+        :return: mqtt topic
+        :rtype: str
+        """
+        reply_to = content.get('reply_to')
+        if reply_to is None:
+            self.shared_replies += 1
+            return SHARED_REPLY_TOPIC
+        if not isinstance(reply_to, str) or not REPLY_TOPIC_PATTERN.match(reply_to):
+            logging.warning('ignoring invalid reply topic: %s, responding on: %s' % (reply_to, SHARED_REPLY_TOPIC))
+            self.rejected += 1
+            self.shared_replies += 1
+            return SHARED_REPLY_TOPIC
+        if reply_to not in self.sessions:
+            logging.debug('new api session: %s' % reply_to)
+        self.sessions[reply_to] = time.monotonic()
+        self.session_replies += 1
+        return reply_to
+
+    def cleanup(self):
+        stale = time.monotonic() - self.idle_timeout
+        for reply_topic in [reply_topic for reply_topic, last_request in self.sessions.items() if last_request < stale]:
+            logging.debug('forgetting idle api session: %s' % reply_topic)
+            del self.sessions[reply_topic]
+            self.expired += 1
+        self.cleanup_handle = self.loop.call_later(self.cleanup_cycle, self.cleanup)
+
+    def get_stats(self):
+        return {
+            'sessions': len(self.sessions),
+            'session_replies': self.session_replies,
+            'shared_replies': self.shared_replies,
+            'rejected': self.rejected,
+            'expired': self.expired,
+        }
+
+    def stop(self):
+        if self.cleanup_handle is not None:
+            self.cleanup_handle.cancel()
+        logging.info('API sessions: %s' % self.get_stats())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: Admission Queue
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# when a whole lab reboots, every client asks for stage2 and then pulls kernel, initrd and more at the same moment
+#   the admission queue limits how many clients may be installing at once, globally and per boot image
+#   a client over the limit is told to wait and ask again, and clients are admitted in the order they first asked (FIFO)
+#   an earlier client waiting for a full boot image does not hold up later clients waiting for a different one
+#   an admitted client holds its slot until it reaches a release state, or its lease runs out
+#     states the stage server sets itself release right away (see NSStageServer.set_client_state)
+#     others arrive on the change stream, ex: the writer expiring stage2 into complete, and are checked by release_finished
+#     a client may already be in a release state when admitted, left from its last boot, so only a state other than that one counts
+#   waiting clients poll, so one which stops asking is forgotten after a few missed retries
+
+import time
+import logging
+
+from collections import OrderedDict
+
+
+class NSAdmissionQueue:
+    """
+    Limits the number of clients installing at once, with FIFO ordering of the clients waiting
+    """
+    # client states which mean the heavy part of booting is over
+    release_states = ['unattended', 'stage4', 'complete', 'inactive', 'error']
+
+    def __init__(self, max_active=0, max_active_per_image=0, retry_seconds=30, lease_seconds=900):
+        """
+        Admission Queue
+        :param max_active: clients allowed to install at once, 0 for no limit
+        :type max_active: int
+        :param max_active_per_image: clients allowed to install the same boot image at once, 0 for no limit
+        :type max_active_per_image: int
+        :param retry_seconds: how long waiting clients wait before asking again
+        :type retry_seconds: int
+        :param lease_seconds: an admitted client gives up its slot after this long, even if it never reaches a release state
+        :type lease_seconds: int
+        """
+        self.max_active = max_active
+        self.max_active_per_image = max_active_per_image
+        self.retry_seconds = retry_seconds
+        self.lease_seconds = lease_seconds
+        self.active = {}  # mac -> (boot image name, lease expiration)
+        self.admitted_states = {}  # mac -> (state, state expiration) of the client when it was admitted
+        self.waiting = OrderedDict()  # mac -> [boot image name, last seen], in the order clients first asked
+        self.admitted_total = 0
+
+    @property
+    def enabled(self):
+        return self.max_active > 0 or self.max_active_per_image > 0
+
+    def expire(self, now):
+        # drop leases which ran out, and waiting clients which stopped asking
+        for client_mac in [client_mac for client_mac, (_, expiration) in self.active.items() if expiration <= now]:
+            logging.debug('admission lease expired for client: %s' % client_mac)
+            del self.active[client_mac]
+            self.admitted_states.pop(client_mac, None)
+        stale = now - self.retry_seconds * 3
+        for client_mac in [client_mac for client_mac, (_, last_seen) in self.waiting.items() if last_seen < stale]:
+            logging.debug('client stopped waiting for admission: %s' % client_mac)
+            del self.waiting[client_mac]
+
+    def admit(self, client_mac, boot_image_name, client_state=None):
+        """
+        Ask to start installing a boot image
+        :param client_mac: mac address
+        :type client_mac: str
+        :param boot_image_name: name of boot image
+        :type boot_image_name: str
+        :param client_state: (state, state expiration) of the client right now, see release_finished
+        :type client_state: Tuple[str, str]
+        :return: admitted, position in line (1 is next, 0 if admitted), and number of clients waiting
+        :rtype: Tuple[bool, int, int]
+        """
+        if not self.enabled:
+            return True, 0, 0
+        now = time.monotonic()
+        self.expire(now)
+        if client_mac in self.active and self.active[client_mac][0] == boot_image_name:
+            # asking again, ex: the stage2 script was fetched twice
+            return True, 0, len(self.waiting)
+        # a client changing boot image gives up whatever it held
+        self.active.pop(client_mac, None)
+        self.admitted_states.pop(client_mac, None)
+        self.waiting[client_mac] = [boot_image_name, now]
+        # hand out free slots in FIFO order, as if every waiting client had asked just now
+        total = len(self.active)
+        per_image = {}
+        for active_image, _ in self.active.values():
+            per_image[active_image] = per_image.get(active_image, 0) + 1
+        position = 0
+        for waiting_mac, (waiting_image, _) in self.waiting.items():
+            fits = (self.max_active <= 0 or total < self.max_active) and (self.max_active_per_image <= 0 or per_image.get(waiting_image, 0) < self.max_active_per_image)
+            if fits:
+                if waiting_mac == client_mac:
+                    del self.waiting[client_mac]
+                    self.active[client_mac] = (boot_image_name, now + self.lease_seconds)
+                    self.admitted_states[client_mac] = client_state
+                    self.admitted_total += 1
+                    return True, 0, len(self.waiting)
+                # reserved for an earlier client, which gets it on its next retry
+                total += 1
+                per_image[waiting_image] = per_image.get(waiting_image, 0) + 1
+            else:
+                position += 1
+                if waiting_mac == client_mac:
+                    break
+        return False, position, len(self.waiting)
+
+    def release(self, client_mac):
+        # client reached a release state, or will not be installing anything after all
+        self.active.pop(client_mac, None)
+        self.admitted_states.pop(client_mac, None)
+        self.waiting.pop(client_mac, None)
+
+    def release_finished(self, clients):
+        """
+        Release admitted clients which reached a release state we did not set ourselves, or were deleted
+        :param clients: mac -> client, of the client manager
+        :type clients: dict
+        """
+        for client_mac in list(self.active):
+            client = clients.get(client_mac)
+            if client is None:
+                logging.debug('releasing admission of deleted client: %s' % client_mac)
+                self.release(client_mac)
+            elif client.state in self.release_states and (client.state, client.state_expiration) != self.admitted_states.get(client_mac):
+                logging.debug('releasing admission of client: %s, which reached state: %s' % (client_mac, client.state))
+                self.release(client_mac)
+
+    def get_stats(self):
+        per_image = {}
+        for active_image, _ in self.active.values():
+            per_image[active_image] = per_image.get(active_image, 0) + 1
+        return {
+            'max_active': self.max_active,
+            'max_active_per_image': self.max_active_per_image,
+            'active': len(self.active),
+            'active_per_image': per_image,
+            'waiting': len(self.waiting),
+            'admitted_total': self.admitted_total,
+        }
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: Boot Image Catalog
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# the catalog is the one place where boot image metadata is parsed; each metadata.yaml is parsed once per change
+#   FileWatcher owns it: refresh_entries() rescans the boot images it saw filesystem events for, refresh() scans everything, and both write the catalog to a small index file
+#   Stage and API load that index at startup, and reload it only when the file changes
+#   lookup() is O(1) by name, and checks the single entry against disk so a just-edited image is never served stale
+#   the FileWatcher is the only writer of the index; index_version increases whenever it writes a changed catalog
+#   lookup() and discard() in Stage and API can see a change before the FileWatcher does, they keep it as a local override
+#     overrides never touch the index or index_version, they bump local_version instead, and are dropped when a newer index is loaded
+#   version is (index_version, local_version), so consumers can skip work when neither changed
+
+import os
+import json
+import logging
+import pathlib
+
+from NSCommon import get_file_modified, validate_boot_image_metadata, sort_by_key
+from NSFileCache import boot_image_metadata_cache
+
+
+class NSBootImageCatalog:
+    """
+    Catalog of boot images found in boot_images/, both a-la-carte files and folders with metadata.yaml
+    """
+    index_format = 1
+
+    def __init__(self, paths):
+        """
+        Boot Image Catalog
+        :param paths: paths object
+        :type paths: dict
+        """
+        self.boot_images_path = pathlib.Path(paths['boot_images'])
+        self.index_file = pathlib.Path(paths['boot_image_catalog'])
+        self.index_version = 0
+        self.local_version = 0
+        self.entries = {}  # boot_image_name -> {'kind': file|folder, 'stamp': [inode, mtime_ns, size], 'metadata': dict or None if invalid}
+        self.overrides = {}  # boot_image_name -> entry, or None if deleted, as seen by this process since the index was loaded
+        self.index_stamp = None
+        self.sorted_version = None
+        self.sorted_boot_images = []
+        self.load()
+
+    @property
+    def version(self):
+        return self.index_version, self.local_version
+
+    @staticmethod
+    def get_stamp(file_path):
+        # None if the file does not exist
+        try:
+            stat = file_path.stat()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+
+    def load(self):
+        """
+        Load the catalog from the index file, if it exists
+        """
+        stamp = self.get_stamp(self.index_file)
+        if stamp is None:
+            return
+        try:
+            with open(self.index_file, 'r') as index_f:
+                index = json.load(index_f)
+            if index['format'] != self.index_format:
+                raise Exception('unsupported index format: %s' % index['format'])
+            self.index_version = index['version']
+            self.entries = index['entries']
+            self.index_stamp = stamp
+            # the FileWatcher has caught up with whatever we saw, and lookup() checks against disk again anyway
+            self.overrides = {}
+            logging.debug('loaded boot image catalog version %s with %s entries' % (self.index_version, len(self.entries)))
+        except Exception as ex:
+            logging.error('unable to load boot image catalog index: %s, %s' % (self.index_file, ex))
+
+    def save(self):
+        """
+        Write the catalog to the index file, replacing it atomically so that readers never see a partial index.
+        Only the FileWatcher writes the index
+        """
+        index = {
+            'format': self.index_format,
+            'version': self.index_version,
+            'entries': self.entries,
+        }
+        temp_file = self.index_file.with_name('%s.%s.tmp' % (self.index_file.name, os.getpid()))
+        try:
+            with open(temp_file, 'w') as index_f:
+                json.dump(index, index_f, default=str)
+            os.replace(temp_file, self.index_file)
+            self.index_stamp = self.get_stamp(self.index_file)
+        except Exception as ex:
+            logging.error('unable to save boot image catalog index: %s, %s' % (self.index_file, ex))
+
+    def mark_changed(self):
+        self.index_version += 1
+        logging.debug('boot image catalog changed, now version %s' % self.index_version)
+        self.save()
+
+    def get_entry(self, boot_image_name):
+        if boot_image_name in self.overrides:
+            return self.overrides[boot_image_name]
+        return self.entries.get(boot_image_name)
+
+    def set_override(self, boot_image_name, entry):
+        # only this process sees it, until the FileWatcher writes the same change to the index
+        self.overrides[boot_image_name] = entry
+        self.local_version += 1
+
+    def sync(self):
+        """
+        Reload the index file if someone else (the FileWatcher) wrote a new one
+        """
+        stamp = self.get_stamp(self.index_file)
+        if stamp is not None and stamp != self.index_stamp:
+            self.load()
+
+    def scan_entry(self, image_path, entry=None):
+        """
+        Build the catalog entry for a boot image, reusing the given entry if its file has not changed
+        :param image_path: path to a-la-carte file or boot image folder
+        :type image_path: pathlib.Path
+        :param entry: current entry for this boot image
+        :type entry: dict
+        :return: entry, or None if this is not a boot image
+        :rtype: dict
+        """
+        image_name = str(image_path.name)
+        if image_path.suffix.lower() == '.ipxe' and image_path.is_file():
+            kind = 'file'
+            stamp_file = image_path
+        elif image_path.is_dir():
+            kind = 'folder'
+            stamp_file = image_path.joinpath('metadata.yaml')
+        else:
+            return None
+        stamp = self.get_stamp(stamp_file)
+        if stamp is None:
+            return None
+        if entry is not None and entry['kind'] == kind and entry['stamp'] == stamp:
+            return entry
+        if kind == 'file':
+            # TODO it makes more sense for files to have modified rather than created,
+            #  but we cannot rename the key because the schema needs to match on both file and folder
+            metadata = {
+                'created': get_file_modified(image_path),
+                'image_type': 'a-la-carte',
+                'description': '%s, a file found in boot_images/' % image_name,
+                'release': 'none',
+                'arch': 'none',
+                'boot_image_name': image_name,
+                'stage2_filename': image_name,
+                'supports_unattended': 'false',
+                'stage2_unattended_filename': 'none',
+            }
+        else:
+            try:
+                # already validated, and shared with everything else in this process
+                metadata = boot_image_metadata_cache.get(stamp_file)
+            except FileNotFoundError:
+                return None
+        if kind == 'file' and not validate_boot_image_metadata(metadata):
+            logging.error('metadata validation failed for boot image: %s' % image_name)
+            metadata = None
+        # invalid images are kept with metadata None, so that we do not parse them again until they change
+        return {
+            'kind': kind,
+            'stamp': stamp,
+            'metadata': metadata,
+        }
+
+    def refresh(self):
+        """
+        Scan boot_images/, parsing only what changed, and save the index if anything did
+        :return: True if the catalog changed
+        :rtype: bool
+        """
+        entries = {}
+        if self.boot_images_path.is_dir():
+            for image_path in self.boot_images_path.iterdir():
+                image_name = str(image_path.name)
+                entry = self.scan_entry(image_path, self.entries.get(image_name))
+                if entry is not None:
+                    entries[image_name] = entry
+        if entries == self.entries:
+            return False
+        self.entries = entries
+        self.mark_changed()
+        return True
+
+    def refresh_entries(self, image_names):
+        """
+        Scan only the given boot images (ex: those a filesystem event was seen for), and save the index if anything changed
+        :param image_names: names of files or folders in boot_images/
+        :type image_names: Iterable[str]
+        :return: True if the catalog changed
+        :rtype: bool
+        """
+        changed = False
+        for image_name in image_names:
+            entry = self.entries.get(image_name)
+            current = self.scan_entry(self.boot_images_path.joinpath(image_name), entry)
+            if current is entry:
+                continue
+            changed = True
+            if current is None:
+                del self.entries[image_name]
+            else:
+                self.entries[image_name] = current
+        if not changed:
+            return False
+        self.mark_changed()
+        return True
+
+    def lookup(self, boot_image_name):
+        """
+        Find a boot image by name
+        :param boot_image_name: name of boot image
+        :type boot_image_name: str
+        :return: entry with kind and metadata (None if invalid), or None if there is no such boot image
+        :rtype: dict
+        """
+        self.sync()
+        if pathlib.Path(boot_image_name).name != boot_image_name:
+            # only direct children of boot_images/
+            return None
+        entry = self.get_entry(boot_image_name)
+        current = self.scan_entry(self.boot_images_path.joinpath(boot_image_name), entry)
+        if current is not entry:
+            # changed since the index was written, keep our copy up to date until the FileWatcher catches up
+            self.set_override(boot_image_name, current)
+        return current
+
+    def discard(self, boot_image_name):
+        # forget a boot image we just deleted, without waiting for the FileWatcher
+        self.sync()
+        if self.get_entry(boot_image_name) is not None:
+            self.set_override(boot_image_name, None)
+
+    def get_boot_images(self):
+        """
+        Get metadata of all valid boot images, sorted by name. The list is only rebuilt when version changes
+        :return: list of metadata
+        :rtype: List[dict]
+        """
+        if self.sorted_version != self.version:
+            entries = [entry for image_name, entry in self.entries.items() if image_name not in self.overrides]
+            entries.extend(entry for entry in self.overrides.values() if entry is not None)
+            boot_images = [entry['metadata'] for entry in entries if entry['metadata'] is not None]
+            self.sorted_boot_images = sort_by_key(boot_images, 'boot_image_name')
+            self.sorted_version = self.version
+        return self.sorted_boot_images
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: Boot Plans
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# on the boot path, TFTP and Stage need the same facts about a client on every request: which ipxe.bin, which stage2 file, which unattended config
+#   a boot plan is all of those, resolved to absolute paths and validated once, plus the stage2 variables block already rendered
+#   a plan remembers exactly what it was built from: the values it read from the client config, client record and settings, and the versions of the file lists it used
+#   client records and settings are reloaded (and their version bumped) all the time for reasons that do not affect the plan, like a state change,
+#     so the plan is keyed on those values rather than on record versions or object identity
+#   looking up a plan is a dictionary lookup and a comparison of those, and it is rebuilt only when one of them changed
+#   the ipxe_builds and boot_images DataSources (published by FileWatcher) tell us when files were added, removed or changed
+
+import logging
+import pathlib
+
+from NSDataSource import NSDataSource
+from NSFileCache import get_build_metadata
+
+# the stage2 variables block, added between the preamble and the boot image content
+STAGE2_VARIABLES = '''
+    #### variables added by Netboot Studio
+    # boot-image-name will always be set to match the name of the boot image
+    set boot-image-name %s
+    set boot-image-path ${boot-images}/${boot-image-name}
+    set boot-image-path-nfs ${boot-images-nfs}/${boot-image-name}
+    set client-ip %s
+    # client-arch is set by the preamble
+    set client-mac %s
+    set client-hostname %s
+    set debian-mirror %s
+    set ubuntu-mirror %s
+    #### end variables
+    echo Booting ${boot-image-name}...
+
+    '''
+
+
+def render_stage2_variables(image_name, client_data, settings):
+    """
+    Render the stage2 variables block for a client
+    :param image_name: name of boot image
+    :type image_name: str
+    :param client_data: client record
+    :type client_data: NSClientRecord
+    :param settings: settings object
+    :type settings: dict
+    :return: variables block
+    :rtype: str
+    """
+    return STAGE2_VARIABLES % (image_name, client_data.ip, client_data.mac, client_data.hostname, settings['debian_mirror'], settings['ubuntu_mirror'])
+
+
+# choose which ipxe build to serve a client: its own ipxe_build if that exists, otherwise the default from settings for its arch
+#   returns (ipxe_build, problem), where problem is a message to log if we had to fall back, or could not
+#   used by boot plans for both TFTP and Stage, so that a client gets the same binary either way
+#   a build counts as existing only if its metadata is valid, which is looked up in the shared build metadata cache
+def choose_ipxe_build(ipxe_builds, client_ipxe_build, arch, settings):
+    ipxe_builds = pathlib.Path(ipxe_builds)
+    if client_ipxe_build and get_build_metadata(ipxe_builds.joinpath(client_ipxe_build)) is not None:
+        return client_ipxe_build, None
+    default_ipxe_build = settings.get('ipxe_build_%s' % arch, '')
+    if not default_ipxe_build or get_build_metadata(ipxe_builds.joinpath(default_ipxe_build)) is None:
+        return client_ipxe_build, 'could not find build with id: %s, and default ipxe build for %s does not exist: %s' % (client_ipxe_build, arch, default_ipxe_build)
+    return default_ipxe_build, 'could not find build with id: %s, falling back to default[%s]: %s' % (client_ipxe_build, arch, default_ipxe_build)
+
+
+# the client config keys and settings that build_plan reads, and so the values a plan is keyed on
+PLAN_CONFIG_KEYS = ('ipxe_build', 'boot_image', 'do_unattended', 'unattended_config', 'stage4')
+PLAN_SETTINGS_KEYS = ('debian_mirror', 'ubuntu_mirror')
+
+
+def get_plan_key(client_data, settings):
+    """
+    Get the values a boot plan for a client is built from
+    :param client_data: client record
+    :type client_data: NSClientRecord
+    :param settings: settings object
+    :type settings: dict
+    :return: plan key
+    :rtype: tuple
+    """
+    config = client_data.config
+    return (tuple(config.get(key) for key in PLAN_CONFIG_KEYS),
+            tuple(settings.get(key) for key in PLAN_SETTINGS_KEYS),
+            settings.get('ipxe_build_%s' % client_data.arch, ''),
+            client_data.arch, client_data.ip, client_data.hostname)
+
+
+class NSBootPlan:
+    """
+    Everything TFTP and Stage need to serve a client, resolved ahead of time
+    """
+    __slots__ = ('key', 'file_versions',
+                 'ipxe_build', 'ipxe_file', 'ipxe_problem',
+                 'boot_image_name', 'do_unattended', 'stage2', 'stage2_variables',
+                 'unattended_config', 'unattended_file', 'stage4')
+
+    def is_current(self, key, file_versions):
+        return self.key == key and self.file_versions == file_versions
+
+
+class NSBootPlanner:
+    """
+    Builds boot plans and keeps one per client, rebuilding a plan only when something it depends on changed
+    """
+
+    def __init__(self, config, paths, client_mgr, boot_image_catalog, loop):
+        """
+        Boot Planner
+        :param config: config object
+        :type config: RawConfigParser
+        :param paths: paths object
+        :type paths: dict
+        :param client_mgr: client manager
+        :type client_mgr: NSClientManager
+        :param boot_image_catalog: boot image catalog
+        :type boot_image_catalog: NSBootImageCatalog
+        :param loop: asyncio loop
+        :type loop: AbstractEventLoop
+        """
+        self.paths = paths
+        self.client_manager = client_mgr
+        self.boot_image_catalog = boot_image_catalog
+        self.ipxe_builds = pathlib.Path(self.paths['ipxe_builds'])
+        self.boot_images = pathlib.Path(self.paths['boot_images'])
+        self.unattended_configs = pathlib.Path(self.paths['unattended_configs'])
+        self.plans = {}  # mac -> NSBootPlan
+        self.ipxe_builds_version = 0
+        self.boot_images_version = 0
+        self.catalog_synced_version = 0
+        self.builds = 0
+        self.hits = 0
+        # FileWatcher publishes these lists only when they change, which is exactly when plans using them need to be rebuilt
+        #   the callbacks run for every message received, so they only bump a version
+        self.data_sources = {
+            'ipxe_builds': NSDataSource(config, paths, loop, 'ipxe_builds', 'consumer', self.ipxe_builds_changed),
+            'boot_images': NSDataSource(config, paths, loop, 'boot_images', 'consumer', self.boot_images_changed),
+        }
+
+    def stop(self):
+        for data_source in self.data_sources.values():
+            data_source.stop()
+
+    def ipxe_builds_changed(self, value):
+        self.ipxe_builds_version += 1
+
+    def boot_images_changed(self, value):
+        self.boot_images_version += 1
+
+    def get_plan(self, client_data):
+        """
+        Get the boot plan for a client
+        :param client_data: client record
+        :type client_data: NSClientRecord
+        :return: boot plan
+        :rtype: NSBootPlan
+        """
+        settings = self.client_manager.get_settings()
+        if self.catalog_synced_version != self.boot_images_version:
+            self.catalog_synced_version = self.boot_images_version
+            self.boot_image_catalog.sync()
+        key = get_plan_key(client_data, settings)
+        plan = self.plans.get(client_data.mac)
+        if plan is not None and plan.is_current(key, self.get_file_versions(plan.boot_image_name)):
+            self.hits += 1
+            return plan
+        plan = self.build_plan(client_data, settings, key)
+        self.plans[client_data.mac] = plan
+        return plan
+
+    def get_file_versions(self, boot_image_name):
+        # plans for virtual boot images do not depend on the boot image catalog
+        if boot_image_name in ['standby_loop', 'menu', '']:
+            return self.ipxe_builds_version, None
+        return self.ipxe_builds_version, self.boot_image_catalog.version
+
+    def forget(self, client_mac):
+        self.plans.pop(client_mac, None)
+
+    def build_plan(self, client_data, settings, key):
+        """
+        Resolve everything needed to serve a client
+        :param client_data: client record
+        :type client_data: NSClientRecord
+        :param settings: settings object
+        :type settings: dict
+        :param key: values the plan is built from, from get_plan_key
+        :type key: tuple
+        :return: boot plan
+        :rtype: NSBootPlan
+        """
+        self.builds += 1
+        config = client_data.config
+        plan = NSBootPlan()
+        plan.key = key
+        plan.ipxe_build, plan.ipxe_problem = choose_ipxe_build(self.ipxe_builds, config['ipxe_build'], client_data.arch, settings)
+        ipxe_file = self.ipxe_builds.joinpath(plan.ipxe_build).joinpath('ipxe.bin')
+        plan.ipxe_file = ipxe_file if ipxe_file.is_file() else None
+        plan.boot_image_name = config['boot_image']
+        plan.do_unattended = config['do_unattended']
+        plan.stage2 = self.resolve_stage2(plan.boot_image_name, client_data.arch, plan.do_unattended)
+        plan.stage2_variables = render_stage2_variables(plan.boot_image_name, client_data, settings)
+        plan.unattended_config = config['unattended_config']
+        if plan.unattended_config and plan.unattended_config != 'blank.cfg':
+            plan.unattended_file = self.unattended_configs.joinpath(plan.unattended_config)
+        else:
+            plan.unattended_file = None
+        plan.stage4 = config['stage4']
+        plan.file_versions = self.get_file_versions(plan.boot_image_name)
+        logging.debug('built boot plan for client: %s, boot image: %s, ipxe build: %s' % (client_data.mac, plan.boot_image_name, plan.ipxe_build))
+        return plan
+
+    def resolve_stage2(self, boot_image_name, arch, do_unattended):
+        """
+        Find the stage2 file for a boot image
+        :param boot_image_name: name of boot image
+        :type boot_image_name: str
+        :param arch: client arch
+        :type arch: str
+        :param do_unattended: whether the client is doing an unattended install
+        :type do_unattended: bool
+        :return: kind (virtual, file or folder), path to stage2 file, and an error message if it can not be served
+        :rtype: {'kind': str, 'file': pathlib.Path, 'error': str}
+        """
+        stage2 = {
+            'kind': 'virtual',
+            'file': None,
+            'error': None,
+        }
+        if not boot_image_name:
+            stage2['error'] = 'client does not have a boot_image'
+            return stage2
+        if boot_image_name in ['standby_loop', 'menu']:
+            return stage2
+        b_path = self.boot_images.joinpath(boot_image_name)
+        boot_image = self.boot_image_catalog.lookup(boot_image_name)
+        if boot_image is None:
+            stage2['error'] = 'failed to find boot_image named: %s, at path: %s' % (boot_image_name, b_path)
+            return stage2
+        stage2['kind'] = boot_image['kind']
+        metadata = boot_image['metadata']
+        if metadata is None:
+            stage2['error'] = 'metadata validation failed for boot image: %s' % boot_image_name
+        elif boot_image['kind'] == 'file':
+            # this is a file boot image, aka a-la-carte
+            stage2['file'] = b_path
+        elif do_unattended and not metadata['supports_unattended']:
+            stage2['error'] = 'tried to do unattended for a boot image that does not support unattended'
+        elif metadata['arch'] != 'none' and arch != metadata['arch']:
+            stage2['error'] = 'client arch: %s does not match boot image arch: %s' % (arch, metadata['arch'])
+        else:
+            if do_unattended:
+                b_file = b_path.joinpath(metadata['stage2_unattended_filename'])
+            else:
+                b_file = b_path.joinpath(metadata['stage2_filename'])
+            if b_file.is_file():
+                stage2['file'] = b_file
+            else:
+                stage2['error'] = 'failed to find stage2 file at: %s' % b_file
+        return stage2
+
+    def get_stats(self):
+        return {
+            'plans': len(self.plans),
+            'builds': self.builds,
+            'hits': self.hits,
+        }
@@ -20,22 +20,42 @@ Netboot Studio iPXE Client Manager
 
 # this is what ipxe stage1 providing as url parameters:
 # mac=${mac}&buildarch=${buildarch}&platform=${platform}&manufacturer=${manufacturer}&chip=${chip}&ip=${ip}&uuid=${uuid}&serial=${serial}&product=${product}&version=${version}&unixtime=${unixtime}&asset=${asset}
+import io
 import sys
+import csv
 import uuid
 import time
 import json
+import hmac
+import hashlib
 import logging
 import pathlib
 import mysql.connector
 from mysql.connector import errorcode
+from collections import deque
 from configparser import RawConfigParser
 
-from NSCommon import get_timestamp, get_seconds_until_timestamp
+from NSCommon import get_timestamp, get_seconds_until_timestamp, json_merge_patch
+from NSJson import json_dumps, json_loads
+from NSFileCache import get_build_metadata
+from NSClientRecord import NSClientRecord
+from NSClientQuery import NSClientQueryIndex
 from NSPubSub import NSMQTTClient
 
 # Database Notes
 # we store all data as text; we make zero use of the database column type system
 #   this is intentional, intended to simplify the future transition to a potentially totally different database system
+# every write to a client row increments its version, so that writers can compare-and-set instead of reading before writing
+#   rows created before the version column existed have a NULL version, which we treat as 0
+SQL_NEXT_VERSION = "version = CAST(COALESCE(version, '0') AS UNSIGNED) + 1"
+SQL_MATCH_VERSION = "COALESCE(version, '0') = %s"
+
+# Forwarded Writes
+# anyone with the broker credentials can publish on the writes topic, and the web ui hands those to every browser
+#   so followers sign each write with a secret that only the services have: broker.write_secret from config.ini, or else the database password
+#   the writer refuses writes with a bad signature, older than FORWARDED_WRITE_MAX_AGE seconds, or with an id it has already performed
+#   writes are published with qos 1, so one may arrive twice, or late after the follower reconnects; the id check drops the repeat
+FORWARDED_WRITE_MAX_AGE = 600
 
 
 class NSClientManager:
@@ -59,6 +79,13 @@ class NSClientManager:
         'debian_mirror': 'http://deb.debian.org/debian',
         'ubuntu_mirror': 'http://archive.ubuntu.com/ubuntu',
     }
+    # followers may only ask the writer to call these methods
+    forwarded_write_methods = ['new_client', 'set_client_config', 'set_client_info', 'patch_client', 'set_client_state', 'set_client_states', 'set_client_ip', 'set_client_arch', 'set_client_hostname', 'delete_client', 'set_settings']
+    # client columns which hold json objects
+    client_json_fields = NSClientRecord.json_fields
+    # columns used for bulk import and export of clients, config keys are flattened into their own columns
+    client_export_fields = ['mac', 'ip', 'arch', 'hostname']
+    client_config_fields = ['boot_image', 'boot_image_once', 'unattended_config', 'do_unattended', 'ipxe_build', 'uboot_script', 'stage4']
     client_states = {
         'dhcp': {
             'state_text': 'Newly Discovered via DHCP Sniffer',
@@ -84,6 +111,14 @@ class NSClientManager:
             'active': True,
             'error': False,
         },
+        'queued': {
+            'state_text': 'Waiting to boot',
+            'description': 'Too many clients are booting right now, client is waiting for its turn',
+            'state_expiration_seconds': 300,  # waiting clients ask again every admission_retry_seconds, which renews this
+            'state_expiration_action': 'inactive',
+            'active': True,
+            'error': False,
+        },
         'stage2': {
             'state_text': 'Stage2 boot image requested',
             'description': 'Client fetched a boot image, and will not be performing an unattended installation',
@@ -160,16 +195,68 @@ class NSClientManager:
         self.sql_db = self.config.get('database', 'database')
         self.mqtt_client_name = 'ClientManager_%s_%s' % (self.name, self.uuid)
         self.mqtt_topic = 'NetbootStudio/ClientManager'
-        self.mqtt_client = NSMQTTClient(self.mqtt_client_name, self.config, self.paths, [(self.mqtt_topic, 0)], self.mqtt_receive, self.loop)
+        # the writer publishes every change on mqtt_topic_changes, and followers forward their writes to it on mqtt_topic_writes
+        self.mqtt_topic_changes = 'NetbootStudio/ClientManager/Changes'
+        self.mqtt_topic_writes = 'NetbootStudio/ClientManager/Writes'
+        self.change_sequence = 0
+        self.client_index = {}  # mac -> client, kept in sync with self.clients
+        self.client_positions = {}  # mac -> position in self.clients, so one client can be replaced or removed without searching the list
+        self.query_index = NSClientQueryIndex()  # for query_clients, told about every change announced on the change stream
+        self.change_listeners = []  # called whenever clients or settings changed, see add_change_listener
+        self.expiration_timer = None  # writer only, see schedule_expiration_check
+        self.write_key = self.get_write_key()
+        self.recent_writes = deque()  # (timestamp, id) of forwarded writes performed within FORWARDED_WRITE_MAX_AGE, oldest first
+        self.recent_write_ids = set()
+        self.mqtt_client = NSMQTTClient(self.mqtt_client_name, self.config, self.paths, [(self.mqtt_topic, 0), (self.mqtt_topic_changes, 0), (self.mqtt_topic_writes, 1)], self.mqtt_receive, self.loop,
+                                        self.mqtt_connected)
+        self.connect_store()
+
+    def connect_store(self):
+        """
+        Connect to the database and load the clients list
+        """
         if self.setup_database():
             logging.info('Client Manager is ready, connected to: %s@%s:%s/%s' % (self.sql_user, self.sql_host, self.sql_port, self.sql_db))
             self.get_clients_from_db()
+            # followers that started before us are waiting for a snapshot
+            self.send_changes_msg(None, None)
+
+    def get_write_key(self):
+        # key for signing forwarded writes, see Forwarded Writes
+        if self.config.has_option('broker', 'write_secret'):
+            return self.config.get('broker', 'write_secret').encode('utf-8')
+        return self.sql_pass.encode('utf-8')
+
+    def sign_write(self, write_json):
+        return hmac.new(self.write_key, write_json.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def mqtt_connected(self):
+        # called on the loop once we are subscribed, after every (re)connect to the broker
+        pass
+
+    def add_change_listener(self, callback):
+        """
+        Register a function to be called whenever clients or settings changed, ex: to push the change to a DataSource
+          it may be called from another thread, ex: the dhcp sniffer, and takes no arguments
+        :param callback: function to call
+        :type callback: Callable
+        """
+        self.change_listeners.append(callback)
+
+    def notify_change_listeners(self):
+        for callback in self.change_listeners:
+            try:
+                callback()
+            except Exception as ex:
+                logging.exception('exception in client manager change listener: %s' % ex)
 
     def stop(self):
         """
         Clean things up
         """
         logging.info('Shutting down Client Manager')
+        if self.expiration_timer is not None:
+            self.expiration_timer.cancel()
         if self.conn:
             self.conn.close()
 
@@ -183,25 +270,105 @@ class NSClientManager:
         """
         try:
             if topic == self.mqtt_topic:
-                msg_obj = json.loads(msg)
+                msg_obj = json_loads(msg)
                 if msg_obj['sender'] != self.mqtt_client_name:  # ignore our own messages
                     if msg_obj['message_type'] == 'update':
                         logging.debug('received update signal from another ClientManager instance')
                         self.get_clients_from_db()
                         self.read_settings()
+                        self.notify_change_listeners()
+            elif topic == self.mqtt_topic_changes:
+                msg_obj = json_loads(msg)
+                if msg_obj['message_type'] == 'snapshot_request':
+                    logging.debug('sending a snapshot to follower: %s' % msg_obj['sender'])
+                    self.send_changes_msg(None, None)
+            elif topic == self.mqtt_topic_writes:
+                msg_obj = json_loads(msg)
+                if msg_obj['message_type'] == 'write':
+                    self.handle_forwarded_write(msg_obj)
         except Exception as ex:
             logging.exception('exception while mqtt_receive in client manager: %s' % ex)
 
-    def send_update_msg(self):
+    def handle_forwarded_write(self, msg_obj):
+        """
+        Perform a write that a follower forwarded to us
+        :param msg_obj: write message
+        :type msg_obj: dict
+        """
+        write_json = msg_obj.get('write')
+        if not isinstance(write_json, str) or not hmac.compare_digest(self.sign_write(write_json), str(msg_obj.get('signature'))):
+            logging.error('refusing forwarded write with a bad signature, from: %s' % msg_obj.get('sender'))
+            return
+        write = json_loads(write_json)
+        now = time.time()
+        while self.recent_writes and self.recent_writes[0][0] < now - FORWARDED_WRITE_MAX_AGE:
+            self.recent_write_ids.discard(self.recent_writes.popleft()[1])
+        if write['id'] in self.recent_write_ids:
+            # sent again by the follower after a reconnect, as it never saw the acknowledgement
+            logging.debug('ignoring repeated forwarded write: %s, from: %s' % (write['id'], msg_obj['sender']))
+            return
+        if abs(now - write['timestamp']) > FORWARDED_WRITE_MAX_AGE:
+            logging.error('refusing stale forwarded write: %s, from: %s' % (write['id'], msg_obj['sender']))
+            return
+        self.recent_writes.append((write['timestamp'], write['id']))
+        self.recent_write_ids.add(write['id'])
+        method_name = write['method']
+        if method_name not in self.forwarded_write_methods:
+            logging.error('refusing forwarded write for unknown method: %s, from: %s' % (method_name, msg_obj['sender']))
+            return
+        logging.debug('performing forwarded write: %s from: %s' % (method_name, msg_obj['sender']))
+        getattr(self, method_name)(*write['args'], **write['kwargs'])
+
+    def send_update_msg(self, changed_macs=None, deleted_macs=None):
+        """
+        Signal other ClientManager instances that something changed, and publish the change for followers
+        :param changed_macs: macs of clients that were created or changed, None means everything
+        :type changed_macs: List[str]
+        :param deleted_macs: macs of clients that were deleted
+        :type deleted_macs: List[str]
+        """
         try:
             message = {
                 'sender': self.mqtt_client_name,
                 'message_type': 'update',
             }
-            message_json = json.dumps(message)
+            message_json = json_dumps(message)
             self.mqtt_client.publish(self.mqtt_topic, message_json)
         except Exception as ex:
             logging.exception('exception while send_update_message: %s' % ex)
+        self.send_changes_msg(changed_macs, deleted_macs)
+
+    def send_changes_msg(self, changed_macs, deleted_macs):
+        """
+        Publish changed client records and current settings on the change stream.
+          when changed_macs is None, a full snapshot is sent
+        :param changed_macs: macs of clients that were created or changed
+        :type changed_macs: List[str]
+        :param deleted_macs: macs of clients that were deleted
+        :type deleted_macs: List[str]
+        """
+        try:
+            self.change_sequence += 1
+            if changed_macs is None:
+                message_type = 'snapshot'
+                clients = [client.to_dict() for client in self.clients]
+                self.query_index.rebuild(self.clients)
+            else:
+                message_type = 'changes'
+                clients = [self.client_index[mac].to_dict() for mac in changed_macs if mac in self.client_index]
+                self.query_index.update(self.client_index, list(changed_macs) + list(deleted_macs or []))
+            message = {
+                'sender': self.mqtt_client_name,
+                'message_type': message_type,
+                'sequence': self.change_sequence,
+                'clients': clients,
+                'deleted': deleted_macs or [],
+                'settings': self.settings,
+            }
+            self.mqtt_client.publish(self.mqtt_topic_changes, json_dumps(message))
+        except Exception as ex:
+            logging.exception('exception while send_changes_msg: %s' % ex)
+        self.notify_change_listeners()
 
     def new_settings_file(self):
         # create a fresh settings file
@@ -253,7 +420,7 @@ class NSClientManager:
         if self.validate_settings(new_settings):
             self.settings = new_settings
             self.save_settings()
-            self.send_update_msg()
+            self.send_update_msg(changed_macs=[])
             return True
         else:
             return False
@@ -358,7 +525,8 @@ class NSClientManager:
         retobj = {
             'result': [],
             'success': True,
-            'error': None
+            'error': None,
+            'rowcount': 0,
         }
         conn = None
         try:
@@ -376,6 +544,7 @@ class NSClientManager:
             except Exception:
                 retobj['result'] = None
                 pass
+            retobj['rowcount'] = cursor.rowcount
             conn.commit()
             cursor.close()
             conn.close()
@@ -392,6 +561,10 @@ class NSClientManager:
                 error_msg = 'looks like the table already exists in the database'
                 retobj['success'] = True
                 pass
+            elif err.errno == errorcode.ER_DUP_FIELDNAME:
+                error_msg = 'looks like the column already exists in the table'
+                retobj['success'] = True
+                pass
             if not retobj['success']:
                 logging.exception(error_msg)
                 retobj['error'] = error_msg
@@ -409,6 +582,60 @@ class NSClientManager:
                 pass
         return retobj
 
+    def db_transaction(self, work):
+        """
+        Perform work within a single transaction, committing only if it completes without exception
+        :param work: function which takes a cursor, performs any statements it needs, and returns a result
+        :type work: Callable
+        :return: result object
+        :rtype: {'result': Any, 'success': bool, 'error':str}
+        """
+        retobj = {
+            'result': None,
+            'success': True,
+            'error': None
+        }
+        conn = None
+        try:
+            conn = mysql.connector.connect(user=self.sql_user, password=self.sql_pass, host=self.sql_host, database=self.sql_db)
+            conn.start_transaction()
+            cursor = conn.cursor(dictionary=True)
+            retobj['result'] = work(cursor)
+            conn.commit()
+            cursor.close()
+            conn.close()
+            conn = None
+        except Exception:
+            error_msg = 'unexpected exception while performing sql transaction, rolling back'
+            logging.exception(error_msg)
+            retobj['success'] = False
+            retobj['error'] = error_msg
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+        if conn is not None:
+            logging.debug('trying to cleanup an orphan db connection')
+            try:
+                conn.close()
+            except Exception:
+                pass
+        return retobj
+
+    def db_cmd_many(self, statements):
+        """
+        Perform several SQL statements as a single transaction, committing only if all of them succeed
+        :param statements: list of (statement, vals) tuples
+        :type statements: List[tuple]
+        :return: result object
+        :rtype: {'result': Any, 'success': bool, 'error':str}
+        """
+        def work(cursor):
+            for statement, vals in statements:
+                cursor.execute(statement, vals)
+        return self.db_transaction(work)
+
     def reconnect(self):
         # try to reconnect to database, and if we fail retry on a 2 second loop forever until it works
         loop_count = 0
@@ -433,11 +660,17 @@ class NSClientManager:
         """
         Ensure that the database exists, and has the expected table.
         """
-        sql_template_clients = 'CREATE TABLE clients (mac text NOT NULL, ip text NOT NULL, arch text NOT NULL, hostname text NOT NULL, info text, config text, state text )'
+        sql_template_clients = 'CREATE TABLE clients (mac text NOT NULL, ip text NOT NULL, arch text NOT NULL, hostname text NOT NULL, info text, config text, state text, version text )'
+        sql_template_version = 'ALTER TABLE clients ADD COLUMN version text'
         retobj = self.db_cmd(sql_template_clients)
         if not retobj['success']:
             logging.critical('failed to create clients table in the SQL database, we cannot continue')
             sys.exit(1)
+        # tables created by older versions lack the version column
+        retobj = self.db_cmd(sql_template_version)
+        if not retobj['success']:
+            logging.critical('failed to add version column to clients table in the SQL database, we cannot continue')
+            sys.exit(1)
         return True
 
     def client_exists(self, client_mac):
@@ -448,12 +681,66 @@ class NSClientManager:
         :return: True or False if client exists in database
         :rtype: bool
         """
-        exists = False
-        for client in self.clients:
-            if client['mac'] == client_mac:
-                exists = True
-                break
-        return exists
+        return client_mac in self.client_index
+
+    def build_default_config(self, arch):
+        """
+        Build the config for a client with the given arch, from current settings
+        :param arch: client arch
+        :type arch: str
+        :return: config object
+        :rtype: dict
+        """
+        config = {
+            'boot_image': self.settings['boot_image'],
+            'unattended_config': self.settings['unattended_config'],
+            'do_unattended': self.settings['do_unattended'],
+            'ipxe_build': self.settings['ipxe_build_%s' % arch],
+            'uboot_script': self.settings['uboot_script'],
+            'stage4': self.settings['stage4'],
+            'boot_image_once': self.settings['boot_image_once']
+        }
+        return config
+
+    def build_client_state(self, state, state_text=None, state_expiration_seconds=None, state_expiration_action=None, error=None, error_short=None, description=None):
+        """
+        Build the state object for a client, using the defaults for the given state unless overridden
+        :param state: the state we are in: dhcp, uboot, ipxe, stage2, unattended, stage4, complete, or error
+        :type state: str
+        :return: state object
+        :rtype: dict
+        """
+        # for the given state, we use the defaults, and can be overriden if needed
+        if state_text is None:
+            state_text = self.client_states[state]['state_text']
+        if state_expiration_seconds is None:
+            state_expiration_seconds = self.client_states[state]['state_expiration_seconds']
+        if state_expiration_action is None:
+            state_expiration_action = self.client_states[state]['state_expiration_action']
+        if error_short is None:
+            error_short = ''
+        if description is None:
+            description = self.client_states[state]['description']
+        if error is None:
+            error = self.client_states[state]['error']
+        active = self.client_states[state]['active']
+        if state_expiration_seconds < 1:
+            state_expiration = 'none'
+        else:
+            state_expiration = get_timestamp(plus_seconds=state_expiration_seconds)
+        state_dict = {
+            'state': {
+                'active': active,
+                'state': state,
+                'state_text': state_text,
+                'state_expiration': state_expiration,
+                'state_expiration_action': state_expiration_action,
+                'error': error,
+                'error_short': error_short,
+                'description': description,
+            },
+        }
+        return state_dict
 
     def new_client(self, client_mac, info_dhcp):
         """
@@ -468,7 +755,7 @@ class NSClientManager:
         # this only ever comes from the dhcp server, which means it does not have the ip yet.
         # the ip will be updated when when a file is requested from tftp, and when stage1 hits stage2 endpoint
         # the important part is that we have mac and arch early as possible
-        sql_template_insert = 'INSERT INTO clients (mac, ip, arch, hostname, info, config, state) VALUES (%s, %s, %s, %s, %s, %s, %s)'
+        sql_template_insert = "INSERT INTO clients (mac, ip, arch, hostname, info, config, state, version) VALUES (%s, %s, %s, %s, %s, %s, %s, '1')"
         if self.client_exists(client_mac):
             logging.error('client entry with mac: %s already exists' % client_mac)
             return False
@@ -479,75 +766,47 @@ class NSClientManager:
             info = {
                 'dhcp': info_dhcp
             }
-            config = {
-                'boot_image': self.settings['boot_image'],
-                'unattended_config': self.settings['unattended_config'],
-                'do_unattended': self.settings['do_unattended'],
-                'ipxe_build': self.settings['ipxe_build_%s' % arch],
-                'uboot_script': self.settings['uboot_script'],
-                'stage4': self.settings['stage4'],
-                'boot_image_once': self.settings['boot_image_once']
-            }
-            state = {
-                'state': {
-                    'active': self.client_states['dhcp']['active'],
-                    'state': 'dhcp',
-                    'state_text': self.client_states['dhcp']['state_text'],
-                    'state_expiration': get_timestamp(plus_seconds=self.client_states['dhcp']['state_expiration_seconds']),
-                    'state_expiration_action': self.client_states['dhcp']['state_expiration_action'],
-                    'error': False,
-                    'error_short': '',
-                    'description': self.client_states['dhcp']['description'],
-                },
-                'data': {
-                    'comment': 'reserved for future use',
-                },
-            }
-            self.clients.append({
-                'mac': client_mac,
-                'ip': client_ip,
-                'hostname': hostname,
-                'arch': arch,
-                'info': info,
-                'config': config,
-                'state': state,
-            })
+            config = self.build_default_config(arch)
+            state = self.build_client_state('dhcp')
+            client = NSClientRecord(client_mac, client_ip, arch, hostname, '1', info=info, config=config, state=state)
+            self.put_client(client)
 
-            info_json = json.dumps(info)
-            config_json = json.dumps(config)
-            state_json = json.dumps(state)
+            info_json = json_dumps(info)
+            config_json = json_dumps(config)
+            state_json = json_dumps(state)
             retobj = self.db_cmd(sql_template_insert, (client_mac, client_ip, arch, hostname, info_json, config_json, state_json))
             self.get_clients_from_db()
-            self.send_update_msg()
+            self.send_update_msg(changed_macs=[client_mac])
             return retobj['success']
         except Exception:
             logging.exception('unexpected exception while encoding info or config')
             return False
 
-    def set_client_config(self, client_mac, config_dict):
+    def set_client_config(self, client_mac, config_dict, version=None):
         """
-        Set the value of config for a client; replaces existing value, so requester must first get current state before trying to set
+        Set the value of config for a client; replaces existing value.
+          pass the version you last saw to only replace it if nobody else changed the client since, or use patch_client to change individual keys without reading first
         :param client_mac: mac address
         :type client_mac: str
         :param config_dict: config object
         :type config_dict: dict
+        :param version: expected current version of the client, or None to replace unconditionally
+        :type version: str
         :return: True or False if succeeded
         :rtype: bool
         """
-        sql_template = 'UPDATE clients SET config = %s WHERE mac = %s'
+        sql_template = 'UPDATE clients SET config = %%s, arch = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
+        if version is not None:
+            return self.compare_and_set_client(client_mac, 'config', config_dict, version)['success']
         if self.client_exists(client_mac):
             try:
-                config_json = json.dumps(config_dict)
+                config_json = json_dumps(config_dict)
                 logging.info('setting client %s config to: %s' % (client_mac, config_json))  # TODO change this back to debug
-                retobj = self.db_cmd(sql_template, (config_json, client_mac))
-                # check arch of ipxe build and update client arch to match 
-                ipxe_build_metafile = self.paths['ipxe_builds'].joinpath(config_dict['ipxe_build']).joinpath('metadata.json')
-                ipxe_build_metadata = None
-                with open(ipxe_build_metafile, 'r', encoding='utf-8') as ibmf:
-                    ipxe_build_metadata = json.load(ibmf)
-                self.set_client_arch(client_mac, ipxe_build_metadata['arch'])
+                # check arch of ipxe build and update client arch to match, in the same update
+                new_arch = self.get_ipxe_build_arch(config_dict['ipxe_build'])
+                retobj = self.db_cmd(sql_template, (config_json, new_arch, client_mac))
                 self.get_clients_from_db()
-                self.send_update_msg()
+                self.send_update_msg(changed_macs=[client_mac])
                 return retobj['success']
             except Exception:
                 logging.exception('Unexpected exception while setting config for client_mac %s', client_mac)
@@ -555,24 +814,29 @@ class NSClientManager:
             logging.error('client with mac: %s does not exist!' % client_mac)
         return False
 
-    def set_client_info(self, client_mac, info_dict):
+    def set_client_info(self, client_mac, info_dict, version=None):
         """
-        Set the value of Info for a client; replaces existing value, so requester must first get current state before trying to set
+        Set the value of Info for a client; replaces existing value.
+          pass the version you last saw to only replace it if nobody else changed the client since, or use patch_client to change individual keys without reading first
         :param client_mac: mac address
         :type client_mac: str
         :param info_dict: info object
         :type info_dict: dict
+        :param version: expected current version of the client, or None to replace unconditionally
+        :type version: str
         :return: True or False if succeeded
         :rtype: bool
         """
-        sql_template = 'UPDATE clients SET info = %s WHERE mac = %s'
+        sql_template = 'UPDATE clients SET info = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
+        if version is not None:
+            return self.compare_and_set_client(client_mac, 'info', info_dict, version)['success']
         if self.client_exists(client_mac):
             try:
-                info_json = json.dumps(info_dict)
+                info_json = json_dumps(info_dict)
                 logging.debug('setting client %s info to: %s' % (client_mac, info_json))
                 retobj = self.db_cmd(sql_template, (info_json, client_mac))
                 self.get_clients_from_db()
-                self.send_update_msg()
+                self.send_update_msg(changed_macs=[client_mac])
                 return retobj['success']
             except Exception:
                 logging.exception('Unexpected exception while setting info for client_mac %s', client_mac)
@@ -581,9 +845,121 @@ class NSClientManager:
             logging.warning('if the client also changed ip address, this may indicate that dhcp discover was attributed to a different mac address, possibly an effect of virtual networking')
         return False
 
+    def compare_and_set_client(self, client_mac, field, value, version):
+        """
+        Replace the value of info, config, or state for a client, but only if its version still matches
+        :param client_mac: mac address
+        :type client_mac: str
+        :param field: info, config, or state
+        :type field: str
+        :param value: new value for the field
+        :type value: dict
+        :param version: expected current version of the client
+        :type version: str
+        :return: result object, on conflict client is the current row
+        :rtype: {'success': bool, 'conflict': bool, 'client': NSClientRecord}
+        """
+        # field is filled in below, once it is known to be one of client_json_fields
+        sql_template = 'UPDATE clients SET %s = %%s, %s WHERE mac = %%s AND %s'
+        sql_template_arch = 'UPDATE clients SET config = %%s, arch = %%s, %s WHERE mac = %%s AND %s' % (SQL_NEXT_VERSION, SQL_MATCH_VERSION)
+        result = {
+            'success': False,
+            'conflict': False,
+            'client': None,
+        }
+        if field not in self.client_json_fields:
+            logging.error('invalid client field: %s' % field)
+            return result
+        if not self.client_exists(client_mac):
+            logging.error('client with mac: %s does not exist!' % client_mac)
+            return result
+        try:
+            if field == 'config':
+                # check arch of ipxe build and update client arch to match, in the same guarded update
+                new_arch = self.get_ipxe_build_arch(value['ipxe_build'])
+                retobj = self.db_cmd(sql_template_arch, (json_dumps(value), new_arch, client_mac, str(version)))
+            else:
+                retobj = self.db_cmd(sql_template % (field, SQL_NEXT_VERSION, SQL_MATCH_VERSION), (json_dumps(value), client_mac, str(version)))
+            if retobj['success'] and retobj['rowcount'] < 1:
+                logging.info('version conflict while setting client %s %s, expected version: %s' % (client_mac, field, version))
+                result['conflict'] = True
+            else:
+                result['success'] = retobj['success']
+            self.get_clients_from_db()
+            if result['success']:
+                self.send_update_msg(changed_macs=[client_mac])
+            result['client'] = self.client_index.get(client_mac)
+        except Exception:
+            logging.exception('Unexpected exception while setting %s for client_mac %s', field, client_mac)
+        return result
+
+    def patch_client(self, client_mac, field, patch, version=None):
+        """
+        Change individual keys of info, config, or state for a client, using json merge patch semantics (RFC 7396):
+          dicts are merged recursively, a value of None removes the key, anything else replaces the value.
+          the patch is applied to the current row within a single transaction, so there is no need to read first
+        :param client_mac: mac address
+        :type client_mac: str
+        :param field: info, config, or state
+        :type field: str
+        :param patch: merge patch to apply to the field
+        :type patch: dict
+        :param version: expected current version of the client, or None to patch unconditionally
+        :type version: str
+        :return: result object, on conflict client is the current row
+        :rtype: {'success': bool, 'conflict': bool, 'client': NSClientRecord}
+        """
+        sql_template_select = 'SELECT %s, version FROM clients WHERE mac = %%s FOR UPDATE'
+        sql_template_update = 'UPDATE clients SET %s = %%s, %s WHERE mac = %%s'
+        sql_template_arch = 'UPDATE clients SET arch = %s WHERE mac = %s'
+        result = {
+            'success': False,
+            'conflict': False,
+            'client': None,
+        }
+        if field not in self.client_json_fields:
+            logging.error('invalid client field: %s' % field)
+            return result
+        if not self.client_exists(client_mac):
+            logging.error('client with mac: %s does not exist!' % client_mac)
+            return result
+        new_arch = None
+        if field == 'config' and patch.get('ipxe_build'):
+            # check arch of ipxe build and update client arch to match
+            new_arch = self.get_ipxe_build_arch(patch['ipxe_build'])
+
+        def work(cursor):
+            cursor.execute(sql_template_select % field, (client_mac,))
+            rows = cursor.fetchall()
+            if len(rows) < 1:
+                raise Exception('client with mac: %s does not exist!' % client_mac)
+            if version is not None and str(version) != (rows[0]['version'] or '0'):
+                return False
+            value = json_merge_patch(json_loads(rows[0][field]), patch)
+            cursor.execute(sql_template_update % (field, SQL_NEXT_VERSION), (json_dumps(value), client_mac))
+            if new_arch is not None:
+                cursor.execute(sql_template_arch, (new_arch, client_mac))
+            return True
+
+        logging.debug('patching client %s %s with: %s' % (client_mac, field, json_dumps(patch)))
+        retobj = self.db_transaction(work)
+        if retobj['success']:
+            if retobj['result']:
+                result['success'] = True
+            else:
+                logging.info('version conflict while patching client %s %s, expected version: %s' % (client_mac, field, version))
+                result['conflict'] = True
+        self.get_clients_from_db()
+        if result['success']:
+            self.send_update_msg(changed_macs=[client_mac])
+        result['client'] = self.client_index.get(client_mac)
+        return result
+
     def set_client_state(self, client_mac, state, state_text=None, state_expiration_seconds=None, state_expiration_action=None, error=None, error_short=None, description=None):
         """
-        Set the value of State for a client; replaces existing value, so requester must first get current state before trying to set
+        Set the value of State for a client; replaces existing value.
+          the state object is built from the arguments, so there is no need to read first. use compare_and_set_client to only replace it if nobody else changed the client since,
+          or patch_client to change individual keys
         :param description: detailed description of what is going on
         :type description: str
         :param error_short: short description of error
@@ -603,50 +979,18 @@ class NSClientManager:
         :return: True or False if succeeded
         :rtype: bool
         """
-        sql_template = 'UPDATE clients SET state = %s WHERE mac = %s'
+        sql_template = 'UPDATE clients SET state = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
         if state not in self.client_states:
             logging.error('invalid client state: %s' % state)
             return False
-        # for the given state, we use the defaults, and can be overriden if needed
-        if state_text is None:
-            state_text = self.client_states[state]['state_text']
-        if state_expiration_seconds is None:
-            state_expiration_seconds = self.client_states[state]['state_expiration_seconds']
-        if state_expiration_action is None:
-            state_expiration_action = self.client_states[state]['state_expiration_action']
-        if error_short is None:
-            error_short = ''
-        if description is None:
-            description = self.client_states[state]['description']
-        if error is None:
-            error = self.client_states[state]['error']
-        active = self.client_states[state]['active']
-        if state_expiration_seconds < 1:
-            state_expiration = 'none'
-        else:
-            state_expiration = get_timestamp(plus_seconds=state_expiration_seconds)
-        state_dict = {
-            'state': {
-                'active': active,
-                'state': state,
-                'state_text': state_text,
-                'state_expiration': state_expiration,
-                'state_expiration_action': state_expiration_action,
-                'error': error,
-                'error_short': error_short,
-                'description': description,
-            },
-            'data': {
-                'comment': 'reserved for future use',
-            },
-        }
+        state_dict = self.build_client_state(state, state_text, state_expiration_seconds, state_expiration_action, error, error_short, description)
         if self.client_exists(client_mac):
             try:
-                state_json = json.dumps(state_dict)
+                state_json = json_dumps(state_dict)
                 logging.debug('Client %s changed state to: %s, description: %s' % (client_mac, state, description))
                 retobj = self.db_cmd(sql_template, (state_json, client_mac))
                 self.get_clients_from_db()
-                self.send_update_msg()
+                self.send_update_msg(changed_macs=[client_mac])
                 return retobj['success']
             except Exception:
                 logging.exception('Unexpected exception while setting info for client_mac %s', client_mac)
@@ -654,6 +998,41 @@ class NSClientManager:
             logging.error('client with mac: %s does not exist!' % client_mac)
         return False
 
+    def set_client_states(self, states):
+        """
+        Set the state of several clients in a single transaction, with a single reload and change message. Used by NSClientStateQueue
+        :param states: mac address -> state object, as built by build_client_state
+        :type states: dict
+        :return: True or False if succeeded
+        :rtype: bool
+        """
+        sql_template = 'UPDATE clients SET state = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
+        statements = []
+        changed_macs = []
+        for client_mac, state_dict in states.items():
+            if state_dict['state']['state'] not in self.client_states:
+                logging.error('invalid client state: %s' % state_dict['state']['state'])
+            elif not self.client_exists(client_mac):
+                logging.error('client with mac: %s does not exist!' % client_mac)
+            else:
+                statements.append((sql_template, (json_dumps(state_dict), client_mac)))
+                changed_macs.append(client_mac)
+        if not statements:
+            return False
+        try:
+            logging.debug('setting state for %s clients' % len(statements))
+            retobj = self.db_cmd_many(statements)
+            self.get_clients_from_db()
+            self.send_update_msg(changed_macs=changed_macs)
+            return retobj['success']
+        except Exception:
+            logging.exception('Unexpected exception while setting state for %s clients', len(statements))
+        return False
+
+    def wait_for_writes(self, timeout=5):
+        # writes are done by the time our methods return, followers need to wait for forwarded writes to be acknowledged
+        return True
+
     def delete_client(self, client_mac):
         """
         Delete a client from the clients table
@@ -668,7 +1047,7 @@ class NSClientManager:
                 logging.debug('deleting client %s' % client_mac)
                 retobj = self.db_cmd(sql_template, (client_mac,))
                 self.get_clients_from_db()
-                self.send_update_msg()
+                self.send_update_msg(deleted_macs=[client_mac])
                 return retobj['success']
             except Exception:
                 logging.exception('Unexpected exception while deleting client with mac: %s', client_mac)
@@ -686,13 +1065,13 @@ class NSClientManager:
         :return: True or False if succeeded
         :rtype: bool
         """
-        sql_template = 'UPDATE clients SET ip = %s WHERE mac = %s'
+        sql_template = 'UPDATE clients SET ip = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
         if self.client_exists(client_mac):
             try:
                 logging.debug('setting client %s ip to: %s' % (client_mac, client_ip))
                 retobj = self.db_cmd(sql_template, (client_ip, client_mac))
                 self.get_clients_from_db()
-                self.send_update_msg()
+                self.send_update_msg(changed_macs=[client_mac])
                 return retobj['success']
             except Exception:
                 logging.exception('Unexpected exception while setting ip for client_mac %s', client_mac)
@@ -710,13 +1089,13 @@ class NSClientManager:
         :return: True or False if succeeded
         :rtype: bool
         """
-        sql_template = 'UPDATE clients SET arch = %s WHERE mac = %s'
+        sql_template = 'UPDATE clients SET arch = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
         if self.client_exists(client_mac):
             try:
                 logging.debug('setting client %s arch to: %s' % (client_mac, client_arch))
                 retobj = self.db_cmd(sql_template, (client_arch, client_mac))
                 self.get_clients_from_db()
-                self.send_update_msg()
+                self.send_update_msg(changed_macs=[client_mac])
                 return retobj['success']
             except Exception:
                 logging.exception('Unexpected exception while setting archfor client_mac %s', client_mac)
@@ -735,13 +1114,13 @@ class NSClientManager:
         :rtype: bool
         """
         # set hostname for a client
-        sql_template = 'UPDATE clients SET hostname = %s WHERE mac = %s'
+        sql_template = 'UPDATE clients SET hostname = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
         if self.client_exists(client_mac):
             try:
                 logging.debug('setting client %s hostname to: %s' % (client_mac, hostname))
                 retobj = self.db_cmd(sql_template, (hostname, client_mac))
                 self.get_clients_from_db()
-                self.send_update_msg()
+                self.send_update_msg(changed_macs=[client_mac])
                 return retobj['success']
             except Exception:
                 logging.exception('Unexpected exception while setting hostname for client_mac %s', client_mac)
@@ -754,52 +1133,87 @@ class NSClientManager:
         Get all values for a client
         :param client_mac: mac address
         :type client_mac: str
-        :return: data
-        :rtype: dict
+        :return: client record, or False if not found
+        :rtype: NSClientRecord
         """
         self.get_clients_from_db()
-        found_client = False
-        for client in self.clients:
-            if client['mac'] == client_mac:
-                found_client = client
-                break
+        found_client = self.client_index.get(client_mac, False)
         if not found_client:
             logging.info('No client entry with mac: %s' % client_mac)
         return found_client
 
     def get_clients(self):
-        # if not self.use_cache:
-        self.get_clients_from_db()
-        # the clients datasource is calling this method every second, we can use it to check the expirations in client states
+        # our copy is reloaded after every write, and whenever another instance signals a change, so there is no need to ask the database
+        return self.clients
+
+    def get_next_expiration(self):
+        """
+        Find out when check_expirations next has something to do
+        :return: seconds until the next client state expires (0 if already due), or None if no client state will expire
+        :rtype: float
+        """
+        next_expiration = None
         for client in self.clients:
-            client_state = client['state']['state']['state']
-            client_state_text = client['state']['state']['state_text']
-            client_state_desc = client['state']['state']['description']
-            expire_timestamp = client['state']['state']['state_expiration']
+            if client.state_expiration == 'none' or client.state_expiration_action == 'none':
+                continue
+            if client.state == 'complete' and client.config['boot_image_once']:
+                return 0
+            seconds_left = get_seconds_until_timestamp(client.state_expiration)
+            if next_expiration is None or seconds_left < next_expiration:
+                next_expiration = seconds_left
+        return next_expiration
+
+    def schedule_expiration_check(self):
+        # instead of looking at every client every few seconds, check when the next client state is due to expire
+        #   called after every reload, which may be in another thread, so the timer is set from the loop
+        try:
+            self.loop.call_soon_threadsafe(self.set_expiration_timer, self.get_next_expiration())
+        except Exception:
+            logging.exception('Unexpected exception while scheduling client state expiration check')
+
+    def set_expiration_timer(self, seconds):
+        if self.expiration_timer is not None:
+            self.expiration_timer.cancel()
+            self.expiration_timer = None
+        if seconds is not None:
+            # at least a second apart, states are only checked with a resolution of one second anyway
+            self.expiration_timer = self.loop.call_later(max(seconds, 1), self.check_expirations)
+
+    def check_expirations(self):
+        """
+        Apply the expiration action of client states which expired
+        """
+        self.expiration_timer = None
+        for client in self.clients:
+            client_state = client.state
+            client_state_text = client.state_text
+            client_state_desc = client.description
+            expire_timestamp = client.state_expiration
             if expire_timestamp != 'none':
-                expire_action = client['state']['state']['state_expiration_action']
+                expire_action = client.state_expiration_action
                 if expire_action != 'none':
                     seconds_left = get_seconds_until_timestamp(expire_timestamp)
                     if client_state == 'complete':
-                        if client['config']['boot_image_once']:
+                        if client.config['boot_image_once']:
                             # this is where we reset to standby_loop
-                            logging.info('Resetting Client %s boot image to standby_loop' % client['mac'])
-                            client['config']['boot_image'] = 'standby_loop'
-                            client['config']['boot_image_once'] = False
-                            self.set_client_config(client['mac'], client['config'])
-                    # logging.info('client %s state: %s expires in %s seconds' % (client['mac'], client_state, seconds_left))
+                            logging.info('Resetting Client %s boot image to standby_loop' % client.mac)
+                            client.config['boot_image'] = 'standby_loop'
+                            client.config['boot_image_once'] = False
+                            self.set_client_config(client.mac, client.config)
+                    # logging.info('client %s state: %s expires in %s seconds' % (client.mac, client_state, seconds_left))
                     if seconds_left < 1:
                         if expire_action == 'complete':
-                            self.set_client_state(client['mac'], 'complete')
+                            self.set_client_state(client.mac, 'complete')
                         elif expire_action == 'inactive':
-                            self.set_client_state(client['mac'], 'inactive')
+                            self.set_client_state(client.mac, 'inactive')
                         elif expire_action == 'error':
                             error_short = 'Timeout: %s' % client_state_text
                             error_description = 'Timeout while: %s' % client_state_desc
-                            self.set_client_state(client['mac'], 'error', error_short=error_short, description=error_description)
+                            self.set_client_state(client.mac, 'error', error_short=error_short, description=error_description)
                         else:
                             logging.warning('dont know how to handle client state expiration action: %s' % expire_action)
-        return self.clients
+        # nothing may have changed (ex: unknown action), so schedule the next check ourselves
+        self.schedule_expiration_check()
 
     def get_clients_from_db(self):
         """
@@ -809,7 +1223,7 @@ class NSClientManager:
         sql_template = 'SELECT * FROM clients'
         try:
             retobj = self.db_cmd(sql_template)
-            clients = retobj['result']
+            rows = retobj['result']
             # TODO move conversion of unixtime to datetime object elsewhere
             # in database, we store unixtime exactly as ipxe gives it to us
             # but the user wants a human readable timestamp, so we convert it at access
@@ -821,12 +1235,520 @@ class NSClientManager:
             #         client['unixtime'] = stringtime
             #     except:
             #         client['unixtime'] = hextime
-            if clients is not None:
-                for client in clients:
-                    client['info'] = json.loads(client['info'])
-                    client['config'] = json.loads(client['config'])
-                    client['state'] = json.loads(client['state'])
-
-            self.clients = clients
+            clients = None
+            if rows is not None:
+                clients = []
+                for row in rows:
+                    # every write bumps the version, so a record with the same version is unchanged and we can skip decoding it
+                    client = self.client_index.get(row['mac'])
+                    if client is None or client.version != (row['version'] or '0'):
+                        client = NSClientRecord.from_row(row)
+                    clients.append(client)
+            self.set_clients(clients)
+            self.schedule_expiration_check()
         except Exception:
             logging.exception('Unexpected exception while getting all clients')
+
+    def set_clients(self, clients):
+        """
+        Replace our local copy of the clients list, and rebuild the index
+        :param clients: list of clients
+        :type clients: List[NSClientRecord]
+        """
+        if clients is None:
+            clients = []
+        self.client_index = {client.mac: client for client in clients}
+        self.client_positions = {client.mac: position for position, client in enumerate(clients)}
+        self.clients = clients
+        self.query_index.rebuild(clients)
+
+    def put_client(self, client):
+        """
+        Add a client to our local copy, or replace the one with the same mac. does not update the query index
+        :param client: client
+        :type client: NSClientRecord
+        """
+        position = self.client_positions.get(client.mac)
+        if position is None:
+            self.client_positions[client.mac] = len(self.clients)
+            self.clients.append(client)
+        else:
+            self.clients[position] = client
+        self.client_index[client.mac] = client
+
+    def drop_client(self, client_mac):
+        """
+        Remove a client from our local copy, moving the last client into its place. does not update the query index
+        :param client_mac: mac address
+        :type client_mac: str
+        """
+        position = self.client_positions.pop(client_mac)
+        del self.client_index[client_mac]
+        last_client = self.clients.pop()
+        if position < len(self.clients):
+            self.clients[position] = last_client
+            self.client_positions[last_client.mac] = position
+
+    def get_ipxe_build_arch(self, ipxe_build):
+        """
+        Look up the arch of an ipxe build from its metadata
+        :param ipxe_build: build id
+        :type ipxe_build: str
+        :return: arch of the build
+        :rtype: str
+        """
+        ipxe_build_metadata = get_build_metadata(self.paths['ipxe_builds'].joinpath(ipxe_build))
+        if ipxe_build_metadata is None:
+            raise Exception('ipxe build does not exist or has invalid metadata: %s' % ipxe_build)
+        return ipxe_build_metadata['arch']
+
+    @staticmethod
+    def parse_clients_csv(csv_text):
+        """
+        Parse a csv document into a list of client records suitable for import_clients
+        :param csv_text: csv content, first row must be a header including at least: mac
+        :type csv_text: str
+        :return: list of client records
+        :rtype: List[dict]
+        """
+        records = []
+        reader = csv.DictReader(io.StringIO(csv_text))
+        for row in reader:
+            record = {'config': {}}
+            for key, value in row.items():
+                if key is None or value is None:
+                    continue
+                key = key.strip()
+                value = value.strip()
+                if key in NSClientManager.client_config_fields:
+                    if value == '':
+                        continue
+                    if key in ['boot_image_once', 'do_unattended']:
+                        value = value.lower() == 'true'
+                    record['config'][key] = value
+                elif value != '':
+                    record[key] = value
+            records.append(record)
+        return records
+
+    def select_clients(self, selector):
+        """
+        Find clients matching all the keys in a selector
+        :param selector: any of: mac_prefix, hostname_prefix, arch, state, boot_image
+        :type selector: dict
+        :return: list of client macs
+        :rtype: List[str]
+        """
+        return self.query_index.select(selector)
+
+    def query_clients(self, filters=None, sort='mac', cursor=None, limit=100, fields=None):
+        """
+        Find clients matching filters, sorted, one page at a time. See NSClientQueryIndex.query
+        :param filters: any of: state, arch, boot_image (a value, or list of values), mac_prefix, hostname_prefix
+        :type filters: dict
+        :param sort: field to sort by, prefixed with - for descending
+        :type sort: str
+        :param cursor: next_cursor from the previous page
+        :type cursor: str
+        :param limit: clients per page
+        :type limit: int
+        :param fields: fields of each client to return, None for all
+        :type fields: List[str]
+        :return: a page of clients, the total number of matches, and the cursor for the next page
+        :rtype: dict
+        """
+        return self.query_index.query(filters, sort, cursor, limit, fields)
+
+    def import_clients(self, records):
+        """
+        Create or update many clients in a single transaction, sending only one update message
+        :param records: list of client records, each with at least mac, and optionally ip, arch, hostname, and config
+        :type records: List[dict]
+        :return: summary of the import: created, updated, and errors
+        :rtype: dict
+        """
+        sql_template_insert = "INSERT INTO clients (mac, ip, arch, hostname, info, config, state, version) VALUES (%s, %s, %s, %s, %s, %s, %s, '1')"
+        sql_template_update = 'UPDATE clients SET ip = %%s, arch = %%s, hostname = %%s, config = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
+        summary = {
+            'created': 0,
+            'updated': 0,
+            'errors': [],
+        }
+        existing = dict(self.client_index)
+        statements = []
+        changed = []
+        for record in records:
+            try:
+                client_mac = str(record['mac']).strip().lower()
+                config_patch = dict(record.get('config', {}))
+                for key in config_patch:
+                    if key not in self.client_config_fields:
+                        raise Exception('invalid config key: %s' % key)
+                if client_mac in existing:
+                    client = existing[client_mac]
+                    config = dict(client.config)
+                    config.update(config_patch)
+                    arch = record.get('arch', client.arch)
+                    if 'ipxe_build' in config_patch and config_patch['ipxe_build']:
+                        arch = self.get_ipxe_build_arch(config_patch['ipxe_build'])
+                    statements.append((sql_template_update, (record.get('ip', client.ip), arch, record.get('hostname', client.hostname), json_dumps(config), client_mac)))
+                    summary['updated'] += 1
+                    changed.append(client_mac)
+                else:
+                    arch = record.get('arch', 'unknown')
+                    if 'ipxe_build' in config_patch and config_patch['ipxe_build']:
+                        arch = self.get_ipxe_build_arch(config_patch['ipxe_build'])
+                    elif 'ipxe_build_%s' % arch not in self.settings:
+                        raise Exception('unsupported arch: %s, and no ipxe_build given' % arch)
+                    config = self.build_default_config(arch)
+                    config.update(config_patch)
+                    info = {
+                        'import': {
+                            'imported': get_timestamp(),
+                        }
+                    }
+                    state = self.build_client_state('inactive')
+                    statements.append((sql_template_insert, (client_mac, record.get('ip', '0.0.0.0'), arch, record.get('hostname', 'unknown'), json_dumps(info), json_dumps(config), json_dumps(state))))
+                    # guard against the same mac appearing twice within one import
+                    existing[client_mac] = NSClientRecord(client_mac, record.get('ip', '0.0.0.0'), arch, record.get('hostname', 'unknown'), info=info, config=config, state=state)
+                    summary['created'] += 1
+                    changed.append(client_mac)
+            except Exception as ex:
+                logging.error('skipping client record during import: %s, error: %s' % (record, ex))
+                summary['errors'].append({'record': record, 'error': str(ex)})
+        if statements:
+            logging.info('importing %s clients (%s new, %s updated)' % (len(statements), summary['created'], summary['updated']))
+            retobj = self.db_cmd_many(statements)
+            if not retobj['success']:
+                summary['created'] = 0
+                summary['updated'] = 0
+                changed = []
+                summary['errors'].append({'record': None, 'error': retobj['error']})
+            self.get_clients_from_db()
+            self.send_update_msg(changed_macs=changed)
+        return summary
+
+    def set_clients_config(self, config_dict, client_macs=None, selector=None):
+        """
+        Apply the given config keys to many clients in a single transaction, sending only one update message.
+          unlike set_client_config, only the given keys are changed, the rest of each client's config is left alone
+        :param config_dict: config keys to apply
+        :type config_dict: dict
+        :param client_macs: list of mac addresses
+        :type client_macs: List[str]
+        :param selector: select clients instead of listing macs, see select_clients
+        :type selector: dict
+        :return: list of macs that were changed
+        :rtype: List[str]
+        """
+        sql_template = 'UPDATE clients SET config = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
+        sql_template_arch = 'UPDATE clients SET config = %%s, arch = %%s, %s WHERE mac = %%s' % SQL_NEXT_VERSION
+        for key in config_dict:
+            if key not in self.client_config_fields:
+                raise Exception('invalid config key: %s' % key)
+        if client_macs is None:
+            client_macs = []
+        if selector is not None:
+            client_macs = list(client_macs) + self.select_clients(selector)
+        new_arch = None
+        if 'ipxe_build' in config_dict and config_dict['ipxe_build']:
+            # check arch of ipxe build once, and update all client archs to match
+            new_arch = self.get_ipxe_build_arch(config_dict['ipxe_build'])
+        existing = self.client_index
+        statements = []
+        changed = []
+        for client_mac in client_macs:
+            if client_mac in changed:
+                continue
+            if client_mac not in existing:
+                logging.error('client with mac: %s does not exist!' % client_mac)
+                continue
+            config = dict(existing[client_mac].config)
+            config.update(config_dict)
+            if new_arch is not None:
+                statements.append((sql_template_arch, (json_dumps(config), new_arch, client_mac)))
+            else:
+                statements.append((sql_template, (json_dumps(config), client_mac)))
+            changed.append(client_mac)
+        if statements:
+            logging.info('applying config: %s to %s clients' % (json_dumps(config_dict), len(changed)))
+            retobj = self.db_cmd_many(statements)
+            if not retobj['success']:
+                changed = []
+            self.get_clients_from_db()
+            self.send_update_msg(changed_macs=changed)
+        return changed
+
+    def export_clients(self, export_format='csv'):
+        """
+        Export all clients, one chunk at a time so that large lists can be streamed
+        :param export_format: csv or json
+        :type export_format: str
+        :return: generator of string chunks
+        :rtype: Generator[str]
+        """
+        clients = list(self.clients)
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=self.client_export_fields + self.client_config_fields, extrasaction='ignore')
+            writer.writeheader()
+            for client in clients:
+                row = {key: getattr(client, key) for key in self.client_export_fields}
+                row.update(client.config)
+                writer.writerow(row)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+            if buffer.tell() > 0:
+                yield buffer.getvalue()
+        elif export_format == 'json':
+            yield '['
+            for index, client in enumerate(clients):
+                record = {key: getattr(client, key) for key in self.client_export_fields}
+                record['config'] = client.config
+                if index > 0:
+                    yield ',' + json_dumps(record)
+                else:
+                    yield json_dumps(record)
+            yield ']'
+        else:
+            raise Exception('unknown export format: %s' % export_format)
+
+
+class NSClientManagerFollower(NSClientManager):
+    """
+    Read-only follower of the Client Manager. Keeps an in-memory snapshot of clients and settings, fed by the change stream
+      of the writer (the API service), and never touches the database. Writes are applied to the local snapshot right away,
+      and forwarded to the writer asynchronously
+    """
+
+    def __init__(self, config, paths, name, loop):
+        """
+        Client Manager Follower
+        :param config: config object
+        :type config: RawConfigParser
+        :param paths: paths object
+        :type paths: dict
+        """
+        self.writer_name = None  # mqtt client name of the writer we are following
+        super().__init__(config, paths, name, loop)
+
+    def connect_store(self):
+        """
+        Instead of connecting to the database, ask the writer for a full snapshot, once we are subscribed to the change stream
+        """
+        logging.info('Client Manager is ready, following the change stream on: %s' % self.mqtt_topic_changes)
+
+    def mqtt_connected(self):
+        # also after a reconnect, as we may have missed changes while disconnected
+        self.request_snapshot()
+
+    def request_snapshot(self):
+        try:
+            message = {
+                'sender': self.mqtt_client_name,
+                'message_type': 'snapshot_request',
+            }
+            self.mqtt_client.publish(self.mqtt_topic_changes, json_dumps(message))
+        except Exception as ex:
+            logging.exception('exception while request_snapshot: %s' % ex)
+
+    def mqtt_receive(self, topic, msg):
+        """
+        handle a mqtt message
+        :param topic: mqtt topic
+        :type topic: str
+        :param msg: message
+        :type msg: str
+        """
+        try:
+            if topic == self.mqtt_topic_changes:
+                msg_obj = json_loads(msg)
+                if msg_obj['message_type'] in ['snapshot', 'changes']:
+                    self.apply_changes(msg_obj)
+        except Exception as ex:
+            logging.exception('exception while mqtt_receive in client manager follower: %s' % ex)
+
+    def apply_changes(self, msg_obj):
+        """
+        Apply a snapshot or changes message from the writer to our local snapshot
+        :param msg_obj: message from the change stream
+        :type msg_obj: dict
+        """
+        if msg_obj['message_type'] == 'snapshot':
+            logging.debug('received a snapshot of %s clients from: %s' % (len(msg_obj['clients']), msg_obj['sender']))
+            self.writer_name = msg_obj['sender']
+            self.change_sequence = msg_obj['sequence']
+            self.set_clients([NSClientRecord.from_dict(client) for client in msg_obj['clients']])
+        else:
+            if msg_obj['sender'] != self.writer_name or msg_obj['sequence'] != self.change_sequence + 1:
+                # we missed something, or the writer restarted; changes are only safe to apply in order
+                logging.debug('gap in change stream, requesting a new snapshot')
+                self.request_snapshot()
+                return
+            self.change_sequence = msg_obj['sequence']
+            for client_dict in msg_obj['clients']:
+                self.put_client(NSClientRecord.from_dict(client_dict))
+            for client_mac in msg_obj['deleted']:
+                if client_mac in self.client_index:
+                    self.drop_client(client_mac)
+            self.query_index.update(self.client_index, [client['mac'] for client in msg_obj['clients']] + msg_obj['deleted'])
+        if self.validate_settings(msg_obj['settings']):
+            self.settings = msg_obj['settings']
+        self.notify_change_listeners()
+
+    def forward_write(self, method_name, *args, **kwargs):
+        """
+        Forward a write to the writer, without waiting for it to complete
+        :param method_name: name of the NSClientManager method to call
+        :type method_name: str
+        """
+        try:
+            # signed as a string, so the writer checks exactly what we signed, see Forwarded Writes
+            write_json = json_dumps({
+                'id': str(uuid.uuid4()),
+                'timestamp': time.time(),
+                'method': method_name,
+                'args': list(args),
+                'kwargs': kwargs,
+            })
+            message = {
+                'sender': self.mqtt_client_name,
+                'message_type': 'write',
+                'write': write_json,
+                'signature': self.sign_write(write_json),
+            }
+            # qos 1, so that a write is kept and sent again until the broker has it, ex: across a reconnect
+            self.mqtt_client.publish(self.mqtt_topic_writes, json_dumps(message), qos=1)
+            return True
+        except Exception as ex:
+            logging.exception('exception while forwarding write: %s, %s' % (method_name, ex))
+        return False
+
+    def wait_for_writes(self, timeout=5):
+        """
+        Wait until the broker has acknowledged our forwarded writes. Called while shutting down, when the loop is no longer running the socket for us
+        :param timeout: seconds to wait
+        :type timeout: float
+        :return: True if every write was acknowledged
+        :rtype: bool
+        """
+        try:
+            return self.mqtt_client.flush(timeout)
+        except Exception as ex:
+            logging.warning('unable to wait for forwarded writes to be sent: %s' % ex)
+        return False
+
+    def set_client_value(self, client_mac, key, value):
+        # update a single field of our local copy of a client
+        if not self.client_exists(client_mac):
+            logging.error('client with mac: %s does not exist!' % client_mac)
+            return False
+        self.client_index[client_mac].set_field(key, value)
+        self.query_index.update(self.client_index, [client_mac])
+        return True
+
+    def get_client(self, client_mac):
+        found_client = self.client_index.get(client_mac, False)
+        if not found_client:
+            logging.info('No client entry with mac: %s' % client_mac)
+        return found_client
+
+    def get_clients(self):
+        # only the writer handles state expiration
+        return self.clients
+
+    def new_client(self, client_mac, info_dhcp):
+        if self.client_exists(client_mac):
+            logging.error('client entry with mac: %s already exists' % client_mac)
+            return False
+        try:
+            arch = info_dhcp['arch']
+            client = NSClientRecord(client_mac, '0.0.0.0', arch, 'unknown', info={'dhcp': info_dhcp}, config=self.build_default_config(arch), state=self.build_client_state('dhcp'))
+        except Exception:
+            logging.exception('unexpected exception while creating client')
+            return False
+        self.put_client(client)
+        self.query_index.update(self.client_index, [client_mac])
+        return self.forward_write('new_client', client_mac, info_dhcp)
+
+    def set_client_config(self, client_mac, config_dict, version=None):
+        # a version conflict can only be detected by the writer, which then leaves the client alone and the change stream reverts our copy
+        if self.set_client_value(client_mac, 'config', config_dict):
+            return self.forward_write('set_client_config', client_mac, config_dict, version=version)
+        return False
+
+    def set_client_info(self, client_mac, info_dict, version=None):
+        if self.set_client_value(client_mac, 'info', info_dict):
+            return self.forward_write('set_client_info', client_mac, info_dict, version=version)
+        return False
+
+    def patch_client(self, client_mac, field, patch, version=None):
+        result = {
+            'success': False,
+            'conflict': False,
+            'client': None,
+        }
+        if field not in self.client_json_fields:
+            logging.error('invalid client field: %s' % field)
+            return result
+        if not self.client_exists(client_mac):
+            logging.error('client with mac: %s does not exist!' % client_mac)
+            return result
+        client = self.client_index[client_mac]
+        if version is not None and str(version) != client.version:
+            result['conflict'] = True
+        elif self.set_client_value(client_mac, field, json_merge_patch(client.get_field(field), patch)):
+            result['success'] = self.forward_write('patch_client', client_mac, field, patch, version=version)
+        result['client'] = client
+        return result
+
+    def set_client_state(self, client_mac, state, state_text=None, state_expiration_seconds=None, state_expiration_action=None, error=None, error_short=None, description=None):
+        if state not in self.client_states:
+            logging.error('invalid client state: %s' % state)
+            return False
+        state_dict = self.build_client_state(state, state_text, state_expiration_seconds, state_expiration_action, error, error_short, description)
+        if self.set_client_value(client_mac, 'state', state_dict):
+            return self.forward_write('set_client_state', client_mac, state, state_text=state_text, state_expiration_seconds=state_expiration_seconds,
+                                      state_expiration_action=state_expiration_action, error=error, error_short=error_short, description=description)
+        return False
+
+    def set_client_states(self, states):
+        applied = {}
+        for client_mac, state_dict in states.items():
+            if state_dict['state']['state'] not in self.client_states:
+                logging.error('invalid client state: %s' % state_dict['state']['state'])
+            elif self.set_client_value(client_mac, 'state', state_dict):
+                applied[client_mac] = state_dict
+        if applied:
+            return self.forward_write('set_client_states', applied)
+        return False
+
+    def set_client_ip(self, client_mac, client_ip):
+        if self.set_client_value(client_mac, 'ip', client_ip):
+            return self.forward_write('set_client_ip', client_mac, client_ip)
+        return False
+
+    def set_client_arch(self, client_mac, client_arch):
+        if self.set_client_value(client_mac, 'arch', client_arch):
+            return self.forward_write('set_client_arch', client_mac, client_arch)
+        return False
+
+    def set_client_hostname(self, client_mac, hostname):
+        if self.set_client_value(client_mac, 'hostname', hostname):
+            return self.forward_write('set_client_hostname', client_mac, hostname)
+        return False
+
+    def delete_client(self, client_mac):
+        if not self.client_exists(client_mac):
+            logging.error('client with mac: %s does not exist!' % client_mac)
+            return False
+        self.drop_client(client_mac)
+        self.query_index.update(self.client_index, [client_mac])
+        return self.forward_write('delete_client', client_mac)
+
+    def set_settings(self, new_settings):
+        if self.validate_settings(new_settings):
+            self.settings = new_settings
+            return self.forward_write('set_settings', new_settings)
+        return False
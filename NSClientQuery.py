@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: Client Queries
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# with 10k+ clients, sending the whole list to the browser and filtering it there is slow, so the client manager answers queries itself
+#   the query index keeps a set of macs per state, arch and boot image, and mac and hostname lists kept sorted, for prefix ranges and paging
+#   the client manager tells the index which clients changed, at the same points it announces changes on the change stream
+#   a client can change in place just before that (ex: NSClientStateQueue applies state right away), so matches are checked against the record itself
+#     at worst a client shows up in a query a moment late, never in a query it does not match
+# pagination uses a cursor holding the sort value and mac of the last client returned, so pages do not shift when clients are added or removed
+
+import base64
+import logging
+
+from bisect import bisect_left, bisect_right, insort
+from threading import Lock
+
+from NSJson import json_dumps, json_loads
+
+# filters backed by a set of macs per value
+EQUALITY_FILTERS = ('state', 'arch', 'boot_image')
+# filters backed by a sorted list
+PREFIX_FILTERS = {'mac_prefix': 'mac', 'hostname_prefix': 'hostname'}
+SORT_FIELDS = ('mac', 'hostname', 'ip', 'arch', 'state', 'boot_image', 'version')
+# top level keys of NSClientRecord.to_dict
+PROJECTION_FIELDS = ('mac', 'ip', 'arch', 'hostname', 'version', 'info', 'config', 'state')
+MAX_LIMIT = 1000
+
+
+def get_sort_value(client, field):
+    if field == 'boot_image':
+        return str(client.config.get('boot_image', ''))
+    return str(getattr(client, field))
+
+
+def client_matches(client, filters):
+    # check a record against the filters, see NSClientQueryIndex.query
+    for field, value in filters.items():
+        if field in PREFIX_FILTERS:
+            if not get_sort_value(client, PREFIX_FILTERS[field]).startswith(value):
+                return False
+        elif get_sort_value(client, field) not in value:
+            return False
+    return True
+
+
+def project_client(client, fields):
+    if fields is None:
+        return client.to_dict()
+    # only what was asked for, so that info is not decoded unless needed
+    result = {}
+    for field in fields:
+        if field == 'state':
+            result['state'] = client.get_state()
+        else:
+            result[field] = getattr(client, field)
+    return result
+
+
+def encode_cursor(sort_field, key):
+    return base64.urlsafe_b64encode(json_dumps([sort_field, key[0], key[1]]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, sort_field):
+    try:
+        cursor_field, value, mac = json_loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('invalid cursor')
+    if cursor_field != sort_field:
+        raise ValueError('cursor is for sort: %s, not: %s' % (cursor_field, sort_field))
+    return value, mac
+
+
+def normalize_filters(filters):
+    """
+    Check filters, and turn each equality filter into a set of allowed values
+    :param filters: filter name -> value (or list of values, for equality filters)
+    :type filters: dict
+    :return: normalized filters
+    :rtype: dict
+    """
+    normalized = {}
+    for field, value in (filters or {}).items():
+        if field in PREFIX_FILTERS:
+            if not isinstance(value, str):
+                raise ValueError('filter: %s must be a string' % field)
+            # macs are stored lowercase
+            normalized[field] = value.lower() if field == 'mac_prefix' else value
+        elif field in EQUALITY_FILTERS:
+            values = value if isinstance(value, list) else [value]
+            normalized[field] = {str(v) for v in values}
+        else:
+            raise ValueError('unknown filter: %s, must be one of: %s' % (field, ', '.join(EQUALITY_FILTERS + tuple(PREFIX_FILTERS))))
+    return normalized
+
+
+class NSClientQueryIndex:
+    """
+    Indexes over the clients of a client manager, for filtered, sorted and paged queries
+    """
+
+    def __init__(self):
+        self.lock = Lock()  # clients change from the loop, mqtt, and the dhcp sniffer thread
+        self.clients = {}  # mac -> client
+        self.indexed = {}  # mac -> values it is indexed under, so they can be removed when it changes
+        self.values = {field: {} for field in EQUALITY_FILTERS}  # field -> value -> set of macs
+        self.sorted_keys = {'mac': [], 'hostname': []}  # field -> sorted list of (value, mac)
+        self.queries = 0
+
+    def rebuild(self, clients):
+        """
+        Index a whole new clients list
+        :param clients: list of clients
+        :type clients: List[NSClientRecord]
+        """
+        with self.lock:
+            self.clients = {client.mac: client for client in clients}
+            self.indexed = {}
+            self.values = {field: {} for field in EQUALITY_FILTERS}
+            for client in clients:
+                self.add(client)
+            self.sorted_keys = {field: sorted((values[field], mac) for mac, values in self.indexed.items()) for field in self.sorted_keys}
+
+    def update(self, client_index, macs):
+        """
+        Re-index some clients, after they were created, changed, or deleted
+        :param client_index: mac -> client, of the client manager
+        :type client_index: dict
+        :param macs: macs of the clients that changed
+        :type macs: List[str]
+        """
+        with self.lock:
+            for client_mac in macs:
+                old_values = self.remove(client_mac)
+                client = client_index.get(client_mac)
+                if client is None:
+                    self.clients.pop(client_mac, None)
+                    if old_values is not None:
+                        for field, keys in self.sorted_keys.items():
+                            del keys[bisect_left(keys, (old_values[field], client_mac))]
+                    continue
+                self.clients[client_mac] = client
+                new_values = self.add(client)
+                for field, keys in self.sorted_keys.items():
+                    if old_values is not None and old_values[field] == new_values[field]:
+                        continue
+                    if old_values is not None:
+                        del keys[bisect_left(keys, (old_values[field], client_mac))]
+                    insort(keys, (new_values[field], client_mac))
+
+    def add(self, client):
+        values = {field: get_sort_value(client, field) for field in EQUALITY_FILTERS + tuple(self.sorted_keys)}
+        self.indexed[client.mac] = values
+        for field in EQUALITY_FILTERS:
+            self.values[field].setdefault(values[field], set()).add(client.mac)
+        return values
+
+    def remove(self, client_mac):
+        values = self.indexed.pop(client_mac, None)
+        if values is not None:
+            for field in EQUALITY_FILTERS:
+                macs = self.values[field][values[field]]
+                macs.discard(client_mac)
+                if not macs:
+                    del self.values[field][values[field]]
+        return values
+
+    def prefix_range(self, field, prefix):
+        # all (value, mac) in a sorted list whose value starts with prefix
+        keys = self.sorted_keys[field]
+        start = bisect_left(keys, (prefix,))
+        end = bisect_left(keys, (prefix + '\U0010ffff',)) if prefix else len(keys)
+        return keys[start:end]
+
+    def match(self, filters):
+        """
+        Find clients matching all of the filters
+        :param filters: normalized filters, see normalize_filters
+        :type filters: dict
+        :return: matching macs, or None if there were no filters (everything matches)
+        :rtype: set
+        """
+        candidates = []
+        for field, value in filters.items():
+            if field in PREFIX_FILTERS:
+                candidates.append({mac for _, mac in self.prefix_range(PREFIX_FILTERS[field], value)})
+            else:
+                candidates.append(set().union(*[self.values[field].get(v, set()) for v in value]))
+        if not candidates:
+            return None
+        candidates.sort(key=len)
+        matches = candidates[0].intersection(*candidates[1:])
+        # the index may be a moment behind a record which changed in place
+        return {mac for mac in matches if client_matches(self.clients[mac], filters)}
+
+    def select(self, selector):
+        """
+        Find clients matching a selector
+        :param selector: any of: mac_prefix, hostname_prefix, arch, state, boot_image
+        :type selector: dict
+        :return: list of client macs, in mac order
+        :rtype: List[str]
+        """
+        filters = normalize_filters(selector)
+        with self.lock:
+            matches = self.match(filters)
+            return [mac for _, mac in self.sorted_keys['mac'] if matches is None or mac in matches]
+
+    def query(self, filters=None, sort='mac', cursor=None, limit=100, fields=None):
+        """
+        Find clients matching filters, one page at a time
+        :param filters: any of: state, arch, boot_image (a value, or list of values), mac_prefix, hostname_prefix
+        :type filters: dict
+        :param sort: field to sort by, one of SORT_FIELDS, prefixed with - for descending. ties are sorted by mac
+        :type sort: str
+        :param cursor: next_cursor from the previous page, to get the page after it
+        :type cursor: str
+        :param limit: clients per page, at most MAX_LIMIT
+        :type limit: int
+        :param fields: fields of each client to return, from PROJECTION_FIELDS, None for all. mac is always included
+        :type fields: List[str]
+        :return: a page of clients, the total number of matches, and the cursor for the next page (None if this is the last)
+        :rtype: {'clients': List[dict], 'total': int, 'next_cursor': str}
+        """
+        filters = normalize_filters(filters)
+        descending = sort.startswith('-')
+        sort_field = sort.lstrip('-')
+        if sort_field not in SORT_FIELDS:
+            raise ValueError('unknown sort field: %s, must be one of: %s' % (sort_field, ', '.join(SORT_FIELDS)))
+        limit = int(limit)
+        if limit < 1 or limit > MAX_LIMIT:
+            raise ValueError('limit must be between 1 and %s' % MAX_LIMIT)
+        if fields is not None:
+            unknown = [field for field in fields if field not in PROJECTION_FIELDS]
+            if unknown:
+                raise ValueError('unknown fields: %s, must be among: %s' % (', '.join(unknown), ', '.join(PROJECTION_FIELDS)))
+            fields = ['mac'] + [field for field in fields if field != 'mac']
+        with self.lock:
+            self.queries += 1
+            matches = self.match(filters)
+            if sort_field in self.sorted_keys:
+                # already in order, only the matches need to be picked out
+                keys = self.sorted_keys[sort_field]
+            else:
+                keys = sorted((get_sort_value(self.clients[mac], sort_field), mac) for mac in (self.clients if matches is None else matches))
+                matches = None  # keys holds only matches
+            total = len(keys) if matches is None else len(matches)
+            if descending:
+                end = bisect_left(keys, tuple(decode_cursor(cursor, sort))) if cursor else len(keys)
+                positions = range(end - 1, -1, -1)
+            else:
+                start = bisect_right(keys, tuple(decode_cursor(cursor, sort))) if cursor else 0
+                positions = range(start, len(keys))
+            page = []
+            next_cursor = None
+            for position in positions:
+                key = keys[position]
+                if matches is not None and key[1] not in matches:
+                    continue
+                if len(page) == limit:
+                    # there is at least one more
+                    next_cursor = encode_cursor(sort, page[-1])
+                    break
+                page.append(key)
+            clients = [project_client(self.clients[mac], fields) for _, mac in page]
+        logging.debug('client query: %s, sort: %s, matched: %s, returned: %s' % (filters, sort, total, len(clients)))
+        return {
+            'clients': clients,
+            'total': total,
+            'next_cursor': next_cursor,
+        }
+
+    def get_stats(self):
+        return {
+            'clients': len(self.clients),
+            'queries': self.queries,
+        }
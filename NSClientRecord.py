@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: Client Record
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# the client manager keeps every client in memory, and services look them up on every request
+#   a record with __slots__ is much smaller than a dict holding three nested dicts, and attribute access is a single lookup
+#   state is flattened into the record, and info (the largest part, and rarely needed) is only decoded when first accessed
+#   use to_dict at the boundary (api responses, datasources, change stream), which produces the same shape as before
+
+from NSJson import json_dumps, json_loads
+
+
+class NSClientRecord:
+    """
+    A single client, as stored in the clients table
+    """
+    __slots__ = ('mac', 'ip', 'arch', 'hostname', 'version', 'config',
+                 'state', 'state_text', 'active', 'state_expiration', 'state_expiration_action', 'error', 'error_short', 'description',
+                 '_info', '_info_json')
+
+    # columns holding json objects, state is flattened into the record but is still a json object in the database
+    json_fields = ('info', 'config', 'state')
+
+    def __init__(self, mac, ip='0.0.0.0', arch='unknown', hostname='unknown', version='0', info=None, config=None, state=None, info_json=None):
+        """
+        Client Record
+        :param mac: mac address
+        :type mac: str
+        :param info: info object, or None if giving info_json instead
+        :type info: dict
+        :param config: config object
+        :type config: dict
+        :param state: state object, as built by NSClientManager.build_client_state
+        :type state: dict
+        :param info_json: info as a json string, decoded on first access
+        :type info_json: str
+        """
+        self.mac = mac
+        self.ip = ip
+        self.arch = arch
+        self.hostname = hostname
+        self.version = version
+        self.config = config if config is not None else {}
+        self._info = info
+        self._info_json = info_json
+        self.state = 'inactive'
+        self.state_text = ''
+        self.active = False
+        self.state_expiration = 'none'
+        self.state_expiration_action = 'none'
+        self.error = False
+        self.error_short = ''
+        self.description = ''
+        if state is not None:
+            self.set_state(state)
+
+    def __repr__(self):
+        return 'NSClientRecord(mac=%s, ip=%s, arch=%s, hostname=%s, state=%s, version=%s)' % (self.mac, self.ip, self.arch, self.hostname, self.state, self.version)
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Create a record from a row of the clients table, where json fields are still text
+        :param row: row from the database
+        :type row: dict
+        :return: client record
+        :rtype: NSClientRecord
+        """
+        return cls(row['mac'], row['ip'], row['arch'], row['hostname'], row.get('version') or '0',
+                   config=json_loads(row['config']), state=json_loads(row['state']), info_json=row['info'])
+
+    @classmethod
+    def from_dict(cls, client):
+        """
+        Create a record from the output of to_dict
+        :param client: client object
+        :type client: dict
+        :return: client record
+        :rtype: NSClientRecord
+        """
+        return cls(client['mac'], client['ip'], client['arch'], client['hostname'], client.get('version', '0'),
+                   info=client['info'], config=client['config'], state=client['state'])
+
+    @property
+    def info(self):
+        if self._info is None:
+            if self._info_json is not None:
+                self._info = json_loads(self._info_json)
+                self._info_json = None
+            else:
+                self._info = {}
+        return self._info
+
+    @info.setter
+    def info(self, info):
+        self._info = info
+        self._info_json = None
+
+    def info_as_json(self):
+        # avoid a decode and re-encode if info was never touched
+        if self._info is None and self._info_json is not None:
+            return self._info_json
+        return json_dumps(self.info)
+
+    def set_state(self, state_dict):
+        """
+        Flatten a state object into this record
+        :param state_dict: state object, as built by NSClientManager.build_client_state
+        :type state_dict: dict
+        """
+        state = state_dict['state']
+        self.state = state['state']
+        self.state_text = state['state_text']
+        self.active = state['active']
+        self.state_expiration = state['state_expiration']
+        self.state_expiration_action = state['state_expiration_action']
+        self.error = state['error']
+        self.error_short = state['error_short']
+        self.description = state['description']
+
+    def get_state(self):
+        """
+        Build the state object for this record, in the shape stored in the database and expected by the web ui
+        :return: state object
+        :rtype: dict
+        """
+        return {
+            'state': {
+                'active': self.active,
+                'state': self.state,
+                'state_text': self.state_text,
+                'state_expiration': self.state_expiration,
+                'state_expiration_action': self.state_expiration_action,
+                'error': self.error,
+                'error_short': self.error_short,
+                'description': self.description,
+            },
+        }
+
+    def get_field(self, field):
+        # get one of json_fields, in the shape stored in the database
+        if field == 'state':
+            return self.get_state()
+        return getattr(self, field)
+
+    def set_field(self, field, value):
+        # set one of json_fields, from the shape stored in the database
+        if field == 'state':
+            self.set_state(value)
+        else:
+            setattr(self, field, value)
+
+    def to_dict(self):
+        """
+        Convert to a plain client object, for api responses, datasources, and the change stream
+        :return: client object
+        :rtype: dict
+        """
+        return {
+            'mac': self.mac,
+            'ip': self.ip,
+            'arch': self.arch,
+            'hostname': self.hostname,
+            'version': self.version,
+            'info': self.info,
+            'config': self.config,
+            'state': self.get_state(),
+        }
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: Client State Queue
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# stage handlers change client state on every request, and a client often makes several requests in a row (ex: stage4 entry, then a script)
+#   instead of writing each transition, handlers put them in this queue and return right away
+#   the new state is applied to the local client record immediately, so anything reading clients in this process sees it
+#   within the window, only the latest state per client is kept, and everything pending is written with a single set_client_states call
+#   stop() writes whatever is still pending, and waits for it to be written (or for a follower, acknowledged by the broker), so transitions are not lost on shutdown
+
+import logging
+
+
+class NSClientStateQueue:
+    """
+    Write-behind queue for client state transitions, coalesced per client and written in batches
+    """
+
+    def __init__(self, client_mgr, loop, window=0.25, max_batch=100):
+        """
+        Client State Queue
+        :param client_mgr: client manager (or follower) to write to
+        :type client_mgr: NSClientManager
+        :param loop: asyncio loop
+        :type loop: AbstractEventLoop
+        :param window: seconds to wait after the first queued transition before writing
+        :type window: float
+        :param max_batch: write right away once this many clients are pending
+        :type max_batch: int
+        """
+        self.client_manager = client_mgr
+        self.loop = loop
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}  # mac -> state object, in the order clients were first queued
+        self.flush_handle = None
+        self.stopping = False
+        self.queued = 0
+        self.coalesced = 0
+        self.batches = 0
+
+    def set_client_state(self, client_mac, state, **kwargs):
+        """
+        Queue a state transition. Takes the same arguments as NSClientManager.set_client_state
+        :param client_mac: mac address
+        :type client_mac: str
+        :param state: the state we are in: dhcp, uboot, ipxe, stage2, unattended, stage4, complete, or error
+        :type state: str
+        :return: True if queued
+        :rtype: bool
+        """
+        if state not in self.client_manager.client_states:
+            logging.error('invalid client state: %s' % state)
+            return False
+        client = self.client_manager.get_client(client_mac)
+        if not client:
+            logging.error('client with mac: %s does not exist!' % client_mac)
+            return False
+        # expiration is computed now, when the transition actually happened
+        state_dict = self.client_manager.build_client_state(state, **kwargs)
+        client.set_state(state_dict)
+        if client_mac in self.pending:
+            self.coalesced += 1
+        self.pending[client_mac] = state_dict
+        self.queued += 1
+        if self.stopping or len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.window, self.flush)
+        return True
+
+    def flush(self):
+        """
+        Write everything pending now
+        :return: True if the write succeeded, or there was nothing to write
+        :rtype: bool
+        """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return True
+        batch = self.pending
+        self.pending = {}
+        self.batches += 1
+        logging.debug('writing state for %s clients' % len(batch))
+        try:
+            return self.client_manager.set_client_states(batch)
+        except Exception as ex:
+            logging.exception('exception while writing client states: %s' % ex)
+        return False
+
+    def get_stats(self):
+        return {
+            'queued': self.queued,
+            'coalesced': self.coalesced,
+            'batches': self.batches,
+            'pending': len(self.pending),
+        }
+
+    def stop(self):
+        # anything queued after this is written right away
+        logging.info('Draining client state queue')
+        self.stopping = True
+        self.flush()
+        self.client_manager.wait_for_writes()
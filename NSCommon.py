@@ -35,6 +35,8 @@ from pathvalidate import sanitize_filename, replace_symbol
 
 import NSJanus
 
+from NSJson import payload_dumps, payload_loads
+
 # this is the format we use for all timestamps, its in utc/zulu
 NS_TIMESAMP_FORMAT = "%Y-%m-%d %H:%M:%S %z"
 
@@ -111,6 +113,22 @@ def validate_boot_image_metadata(metadata):
     return all_good
 
 
+# apply an RFC 7396 json merge patch: dicts are merged recursively, None removes a key, anything else replaces the value
+def json_merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return patch
+    if isinstance(target, dict):
+        result = dict(target)
+    else:
+        result = {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = json_merge_patch(result.get(key), value)
+    return result
+
+
 # standardize format for file modified timestamps
 def get_file_modified(this_file):
     this_statbuf = os.stat(this_file)
@@ -226,6 +244,7 @@ def build_paths(config_dir):
     paths_object['ssl_cert'] = paths_object['certs'].joinpath('server_cert.pem')  # SSL cert required for HTTPS and WSS
     paths_object['ssl_key'] = paths_object['certs'].joinpath('server_key.key')  # SSL key required for HTTPS and WSS
     paths_object['boot_images'] = paths_object['config_base'].joinpath('boot_images')  # boot_images folder
+    paths_object['boot_image_catalog'] = paths_object['config_base'].joinpath('boot_images.catalog.json')  # index of boot_images metadata, written by FileWatcher
     paths_object['unattended_configs'] = paths_object['config_base'].joinpath('unattended_configs')  # unattended_configs folder
     paths_object['ipxe_builds'] = paths_object['config_base'].joinpath('ipxe_builds')  # where ipxe builds will live
     paths_object['wimboot_builds'] = paths_object['config_base'].joinpath('wimboot_builds')  # where wimboot builds will live
@@ -240,6 +259,7 @@ def build_paths(config_dir):
     paths_object['iso'] = paths_object['config_base'].joinpath('iso')  # uploaded iso files live here
     paths_object['uboot_scripts'] = paths_object['config_base'].joinpath('uboot_scripts')  # uboot scripts that become uboot binaries
     paths_object['uboot_binaries'] = paths_object['config_base'].joinpath('uboot_binaries')  # uboot binaries, aka boot.scr.uimg
+    paths_object['checksum_index'] = paths_object['config_base'].joinpath('checksums.json')  # checksums of files served by stage server, used for ETags
     paths_object['temp'] = paths_object['config_base'].joinpath('temp')  # temporary scratch space for tasks
     path_strings = {}
     for entryname, pathobj in paths_object.items():
@@ -326,6 +346,7 @@ class NSSafeQueue(NSJanus.Queue):
 class NSMessage:
     # common message format for http, websocket, and mqtt messages
     # if this came from the broker via a topic, that gets set within the message, otherwise it is blank and you must set it yourself
+    # large messages are compressed by to_json, see payload_dumps in NSJson
     _data = None
 
     def __init__(self, _msg=None):
@@ -343,7 +364,7 @@ class NSMessage:
 
     def to_json(self):
         try:
-            _string = json.dumps(self._data)
+            _string = payload_dumps(self._data)
         except Exception as ex:
             logging.error('Exception while dumping NSMessage to json: %s', ex)
             _string = ''
@@ -351,7 +372,7 @@ class NSMessage:
 
     def from_json(self, _json):
         try:
-            _parsed = json.loads(_json)
+            _parsed = payload_loads(_json)
         except Exception as ex:
             logging.error('Exception while parsing NSMessage from json: %s', ex)
             _parsed = dict()
@@ -6,11 +6,11 @@ Netboot Studio Data Source
 #    This file is part of Netboot Studio, a system for managing netboot clients
 #    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
 import asyncio
-import json
 import logging
 import uuid
 
 from NSPubSub import NSMQTTClient
+from NSJson import json_dumps, json_dumps_bytes, payload_dumps, payload_loads
 
 
 class NSDataSource:
@@ -18,22 +18,39 @@ class NSDataSource:
     # for a provider, the_function is called every cycle_time seconds and if the value has changed that change is published
     # for a consumer, the_function is called with the new value if the value changes
     #   a consumer can provide None as the_function, to not get notified (use .get_value() instead)
+    # every published value has a version, which increases by one each time, and a source_id which is different every time the provider starts
+    #   a provider given a key_field, whose value is a list of dicts with a unique key_field, publishes changes as a delta: added, changed and removed entries
+    #     order (list of keys) is only included if it changed; if most entries changed, the whole value is published instead
+    #   a consumer applies a delta only if it has the version the delta was made from, otherwise it asks for the current value
+    #   the whole value is sent as new_value (nothing to diff against, or not a keyed list), or as current_value in response to a request
+    #   consumers ask for the current value whenever they (re)connect to the broker
+    # a provider can also be told that its value changed, with notify(), instead of (or as well as) polling
+    #   then scan_cycle is just a slow heartbeat, in case a notification was missed, and scan_cycle None means no polling at all
+    #   notifications within notify_delay are handled with a single update
+    notify_delay = 0.05  # seconds
 
-    def __init__(self, config, paths, loop, name, source_type, the_function=None, scan_cycle=4):
+    def __init__(self, config, paths, loop, name, source_type, the_function=None, scan_cycle=4, key_field=None):
         self.config = config
         self.paths = paths
         self.loop = loop
         self.source_type = source_type
         self.the_function = the_function
         self.scan_cycle = scan_cycle
+        self.key_field = key_field
         self.name = name
         logging.debug('setting up data source: %s' % self.name)
         self.mqtt_client_name = '%s_%s_%s' % (self.name, self.source_type, uuid.uuid4())
         self.value = {}
-        self.value_json = json.dumps(self.value)
+        self.value_json = json_dumps(self.value)
+        self.version = 0
+        # provider: our own id. consumer: id of the provider our value came from
+        self.source_id = self.mqtt_client_name if self.source_type == 'provider' else None
+        self.item_jsons = None  # provider: key -> json of that entry, when the value is a keyed list
         self.mqtt_topic = 'NetbootStudio/DataSources/%s' % name
-        self.mqtt_client = NSMQTTClient(self.mqtt_client_name, self.config, self.paths, [(self.mqtt_topic, 0)], self.mqtt_receive, self.loop)
+        connect_callback = self.request_value if self.source_type == 'consumer' else None
+        self.mqtt_client = NSMQTTClient(self.mqtt_client_name, self.config, self.paths, [(self.mqtt_topic, 0)], self.mqtt_receive, self.loop, connect_callback)
         self.scan_task = None
+        self.notify_pending = False
         if self.source_type == 'provider':
             if self.the_function is not None:
                 self.scan_task = self.loop.create_task(self.scanner())
@@ -41,16 +58,32 @@ class NSDataSource:
     def stop(self):
         # for the moment not sure what to stop here
         logging.info('Shutting down DataSource: %s' % self.name)
-        if self.source_type == 'provider':
+        if self.scan_task is not None:
             self.scan_task.cancel()
         self.mqtt_client.stop()
 
     async def scanner(self):
-        # this is the scan loop
+        # this is the scan loop, without a scan_cycle we only publish the first value, and then wait for notify()
         while True:
             await self.update()
+            if self.scan_cycle is None:
+                break
             await asyncio.sleep(self.scan_cycle)
 
+    def notify(self):
+        """
+        Tell a provider that its value changed. Safe to call from any thread
+        """
+        if self.notify_pending:
+            return
+        self.notify_pending = True
+        self.loop.call_soon_threadsafe(self.loop.call_later, self.notify_delay, self.handle_notify)
+
+    def handle_notify(self):
+        # a notify() after this point needs another update, as we may already have read the value
+        self.notify_pending = False
+        self.loop.create_task(self.update())
+
     def mqtt_receive(self, topic, msg):
         """
         handle a mqtt message
@@ -71,29 +104,129 @@ class NSDataSource:
     def handle_message(self, message):
         # handle messages on our topic
         try:
-            message_dict = json.loads(message)
-            # we only care about request, someone askkng for the current value
+            message_dict = payload_loads(message)
+            message_type = message_dict['message_type']
             if self.source_type == 'provider':
-                if message_dict['message_type'] == 'request':
-                    value_message = {
-                        'message_type': 'current_value',
-                        'value': self.value
-                    }
-                    self.mqtt_client.publish(self.mqtt_topic, json.dumps(value_message))
+                # we only care about request, someone askkng for the current value
+                if message_type == 'request':
+                    self.publish_value('current_value')
             elif self.source_type == 'consumer':
-                if message_dict['message_type'] == 'new_value' or message_dict['message_type'] == 'current_value':
-                    logging.debug('new value for data_source: %s' % self.name)
+                if message_type == 'new_value' or message_type == 'current_value':
+                    self.source_id = message_dict.get('source_id')
+                    self.version = message_dict.get('version', 0)
                     if self.value != message_dict['value']:
+                        logging.debug('new value for data_source: %s' % self.name)
                         self.value = message_dict['value']
-                        self.value_json = json.dumps(message_dict['value'])
+                        self.value_json = json_dumps(message_dict['value'])
                         if self.the_function is not None:
                             self.the_function(self.value)
+                elif message_type == 'delta':
+                    if message_dict['source_id'] != self.source_id or message_dict['base_version'] != self.version:
+                        # we missed something (or the provider restarted), a delta is no use to us
+                        logging.debug('version gap for data_source: %s, have: %s, delta from: %s' % (self.name, self.version, message_dict['base_version']))
+                        self.request_value()
+                        return
+                    logging.debug('new delta for data_source: %s' % self.name)
+                    self.apply_delta(message_dict)
+                    if self.the_function is not None:
+                        self.the_function(self.value)
         except Exception as ex:
             logging.exception('exception while handling data source message: %s' % ex)
 
+    def request_value(self):
+        # ask the provider for the whole current value
+        self.mqtt_client.publish(self.mqtt_topic, json_dumps({'message_type': 'request'}))
+
+    def apply_delta(self, delta):
+        """
+        Apply a delta to our value, as a consumer
+        :param delta: delta message
+        :type delta: dict
+        """
+        key_field = delta['key_field']
+        entries = {entry[key_field]: entry for entry in self.value}
+        order = delta.get('order')
+        if order is None:
+            # only entries changed, not which ones there are or their order
+            order = list(entries)
+        for key in delta['removed']:
+            entries.pop(key, None)
+        for entry in delta['added'] + delta['changed']:
+            entries[entry[key_field]] = entry
+        self.value = [entries[key] for key in order]
+        self.value_json = None  # only needed by providers
+        self.version = delta['version']
+
+    def publish_value(self, message_type):
+        value_message = {
+            'message_type': message_type,
+            'source_id': self.source_id,
+            'version': self.version,
+            'value': self.value,
+        }
+        self.mqtt_client.publish(self.mqtt_topic, payload_dumps(value_message))
+
     def get_value(self):
         return self.value
 
+    def get_item_jsons(self, value):
+        """
+        Encode each entry of a keyed list by itself, so that we can tell which entries changed
+        :param value: value from the_function
+        :type value: Any
+        :return: key -> json of entry, in order, or None if value is not a list of dicts with a unique key_field
+        :rtype: dict
+        """
+        if self.key_field is None or not isinstance(value, list):
+            return None
+        item_jsons = {}
+        try:
+            for entry in value:
+                key = entry[self.key_field]
+                if key in item_jsons:
+                    return None
+                item_jsons[key] = json_dumps_bytes(entry)
+        except (KeyError, TypeError):
+            return None
+        return item_jsons
+
+    def get_delta(self, value, item_jsons):
+        """
+        Compare with what we published last, as a provider
+        :param value: new value, a keyed list
+        :type value: List[dict]
+        :param item_jsons: new key -> json of entry, from get_item_jsons
+        :type item_jsons: dict
+        :return: delta message, or None if it is better to publish the whole value
+        :rtype: dict
+        """
+        if self.item_jsons is None:
+            return None
+        added = []
+        changed = []
+        for entry in value:
+            key = entry[self.key_field]
+            old_json = self.item_jsons.get(key)
+            if old_json is None:
+                added.append(entry)
+            elif old_json != item_jsons[key]:
+                changed.append(entry)
+        if len(added) + len(changed) > len(value) / 2:
+            return None
+        delta = {
+            'message_type': 'delta',
+            'source_id': self.source_id,
+            'base_version': self.version,
+            'version': self.version + 1,
+            'key_field': self.key_field,
+            'added': added,
+            'changed': changed,
+            'removed': [key for key in self.item_jsons if key not in item_jsons],
+        }
+        if list(item_jsons) != list(self.item_jsons):
+            delta['order'] = list(item_jsons)
+        return delta
+
     async def update(self):
         # get the latest value using get_func and then advertize it if it changed
         if self.source_type == 'provider':
@@ -101,24 +234,36 @@ class NSDataSource:
             try:
                 # logging.debug('updating data source: %s' % self.name)
                 value = self.the_function()
-                if value != '':
-                    try:
-                        value_json = json.dumps(value)
-                    except json.JSONDecodeError:
-                        logging.warning('JSONDecodeError while json encoding data source value, defaulting to empty string')
+                item_jsons = self.get_item_jsons(value)
+                if item_jsons is not None:
+                    if item_jsons == self.item_jsons and list(item_jsons) == list(self.item_jsons):
+                        return
+                    delta = self.get_delta(value, item_jsons)
+                    value_json = None
+                else:
+                    delta = None
+                    if value != '':
+                        try:
+                            value_json = json_dumps(value)
+                        except (TypeError, ValueError):
+                            logging.warning('Exception while json encoding data source value, defaulting to empty string')
+                            value_json = ''
+                    else:
                         value_json = ''
+                    if value_json == self.value_json:
+                        return
+                # value changed
+                logging.debug('updating data source: %s' % self.name)
+                self.value = value
+                self.value_json = value_json
+                self.item_jsons = item_jsons
+                if delta is not None:
+                    self.version = delta['version']
+                    # deltas are what a busy provider sends most, so these wait for the hub to catch up if it is behind
+                    await self.mqtt_client.publish_async(self.mqtt_topic, payload_dumps(delta))
                 else:
-                    value_json = ''
-                if value_json != self.value_json:
-                    # value changed
-                    logging.debug('updating data source: %s' % self.name)
-                    self.value = value
-                    self.value_json = value_json
-                    update_message = {
-                        'message_type': 'new_value',
-                        'value': value,
-                    }
-                    self.mqtt_client.publish(self.mqtt_topic, json.dumps(update_message))
+                    self.version += 1
+                    self.publish_value('new_value')
             except Exception as ex:
                 logging.exception('execeptions while updating a data_source named %s: %s' % (self.name, ex))
         else:
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: File Cache
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# some files are read and parsed on every request (ex: boot image metadata and stage2 scripts), but rarely change
+#   NSFileCache keeps whatever the loader made from a file, keyed by path, and re-runs the loader only when the file changes
+#   checking for a change costs a single stat(), which is much cheaper than opening and parsing the file again
+#   a file is considered changed if its inode, mtime or size changed, so a file atomically replaced by rename is noticed too
+#   from async code use get_async, which runs the loader in the loop's default executor (a thread pool) on a cache miss
+# build_metadata_cache and boot_image_metadata_cache are shared by everything in a process, and hold metadata already validated
+#   invalid metadata is cached as None, so it is not parsed again until the file changes
+
+import json
+import yaml
+import logging
+import pathlib
+
+from threading import Lock
+
+from NSCommon import validate_boot_image_metadata
+
+
+class NSFileCache:
+    """
+    Cache of values loaded from files, invalidated when mtime or size of the file changes
+    """
+
+    def __init__(self, name, loader, max_entries=256, max_file_size=None):
+        """
+        File Cache
+        :param name: name of this cache, for logging
+        :type name: str
+        :param loader: function which takes a path and returns the value to cache for it
+        :type loader: Callable[[pathlib.Path], Any]
+        :param max_entries: when full, the oldest entry is dropped
+        :type max_entries: int
+        :param max_file_size: files larger than this many bytes are loaded every time instead of cached, None for no limit
+        :type max_file_size: int
+        """
+        self.name = name
+        self.loader = loader
+        self.max_entries = max_entries
+        self.max_file_size = max_file_size
+        self.entries = {}  # path -> (stamp, value)
+        self.lock = Lock()  # the shared caches are used from more than one thread
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_stamp(file_path):
+        # raises FileNotFoundError if the file is gone
+        stat = file_path.stat()
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def get(self, file_path):
+        """
+        Get the value for a file, loading it if not cached or if the file changed since
+        :param file_path: path to file
+        :type file_path: pathlib.Path
+        :return: value returned by loader
+        :rtype: Any
+        """
+        file_path = pathlib.Path(file_path)
+        stamp = self.get_stamp(file_path)
+        entry = self.entries.get(file_path)
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        logging.debug('%s cache loading: %s' % (self.name, file_path))
+        value = self.loader(file_path)
+        self.store(file_path, stamp, value)
+        return value
+
+    async def get_async(self, file_path, loop):
+        """
+        Same as get, but a cache miss is loaded in a thread so the event loop is never blocked reading the file
+        :param file_path: path to file
+        :type file_path: pathlib.Path
+        :param loop: asyncio loop
+        :type loop: AbstractEventLoop
+        :return: value returned by loader
+        :rtype: Any
+        """
+        file_path = pathlib.Path(file_path)
+        stamp = self.get_stamp(file_path)
+        entry = self.entries.get(file_path)
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        logging.debug('%s cache loading: %s' % (self.name, file_path))
+        value = await loop.run_in_executor(None, self.loader, file_path)
+        self.store(file_path, stamp, value)
+        return value
+
+    def store(self, file_path, stamp, value):
+        if self.max_file_size is not None and stamp[2] > self.max_file_size:
+            return
+        with self.lock:
+            if file_path not in self.entries and len(self.entries) >= self.max_entries:
+                del self.entries[next(iter(self.entries))]
+                self.evictions += 1
+            self.entries[file_path] = (stamp, value)
+
+    def invalidate(self, file_path=None):
+        """
+        Drop a single file from the cache, or everything if file_path is None
+        :param file_path: path to file
+        :type file_path: pathlib.Path
+        """
+        if file_path is None:
+            self.entries = {}
+        else:
+            self.entries.pop(pathlib.Path(file_path), None)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+            'evictions': self.evictions,
+        }
+
+
+def read_text_file(file_path):
+    # a loader for text files
+    with open(file_path, 'r') as text_f:
+        return text_f.read()
+
+
+def load_build_metadata(file_path):
+    # a loader for metadata.json of ipxe and wimboot builds, None if it is not valid
+    try:
+        with open(file_path, 'r', encoding='utf-8') as mf:
+            metadata = json.load(mf)
+        if metadata['build_id'] == '':
+            logging.error('woah, the build_id is empty')
+    except (KeyError, TypeError, ValueError):
+        # ValueError includes a half-written file, which will have a new stamp when it is complete
+        logging.error('unable to parse build metadata file: %s' % file_path)
+        return None
+    return metadata
+
+
+def load_boot_image_metadata(file_path):
+    # a loader for metadata.yaml of boot image folders, None if it is not valid
+    boot_image_name = str(file_path.parent.name)
+    logging.debug('parsing boot image metadata: %s' % file_path)
+    try:
+        with open(file_path, 'r') as mf:
+            metadata = yaml.full_load(mf)
+        metadata['boot_image_name'] = boot_image_name
+    except Exception as ex:
+        logging.error('unable to parse boot image metadata file: %s, %s' % (file_path, ex))
+        return None
+    if not validate_boot_image_metadata(metadata):
+        logging.error('metadata validation failed for boot image: %s' % boot_image_name)
+        return None
+    return metadata
+
+
+build_metadata_cache = NSFileCache('build metadata', load_build_metadata, max_entries=512)
+boot_image_metadata_cache = NSFileCache('boot image metadata', load_boot_image_metadata, max_entries=512)
+
+
+def get_build_metadata(build_path):
+    """
+    Get the validated metadata of an ipxe or wimboot build
+    :param build_path: path to build folder
+    :type build_path: pathlib.Path
+    :return: metadata, or None if there is no such build or its metadata is not valid
+    :rtype: dict
+    """
+    try:
+        return build_metadata_cache.get(pathlib.Path(build_path).joinpath('metadata.json'))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
@@ -20,6 +20,7 @@ import pathlib
 from aiohttp import web
 
 from NSCommon import NSMessage
+from NSBootImageCatalog import NSBootImageCatalog
 
 
 class NSMessageProcessor:
@@ -102,13 +103,15 @@ class NSMessageProcessor:
         ],
     }
 
-    def __init__(self, config, paths, q_staging, client_mgr, file_mgr, task_mgr):
+    def __init__(self, config, paths, q_staging, client_mgr, file_mgr, task_mgr, sessions=None):
         self.config = config  # unused
         self.paths = paths
+        self.sessions = sessions  # picks the reply topic of requests from the broker, see NSAPISessions
         self.q_staging = q_staging
         self.client_manager = client_mgr
         self.file_manager = file_mgr
         self.task_manager = task_mgr
+        self.boot_image_catalog = NSBootImageCatalog(paths)
         self.endpoint_methods = {
             'get_ipxe_builds': self.get_ipxe_builds,
             'get_stage1_files': self.get_stage1_files,
@@ -117,8 +120,13 @@ class NSMessageProcessor:
             'get_unattended_configs': self.get_unattended_configs,
             'get_client': self.get_client,
             'get_clients': self.get_clients,
+            'query_clients': self.query_clients,
             'set_client_config': self.set_client_config,
             'set_client_info': self.set_client_info,
+            'patch_client': self.patch_client,
+            'set_clients_config': self.set_clients_config,
+            'import_clients': self.import_clients,
+            'export_clients': self.export_clients,
             'create_task': self.create_task,
             'delete_client': self.delete_client,
             'delete_boot_image': self.delete_boot_image,
@@ -160,6 +168,7 @@ class NSMessageProcessor:
         req_id = None
         payload = None
         endpoint = None
+        content = {}
         try:
             origin = request_message.get('origin')
             content = request_message.get('content')
@@ -186,12 +195,15 @@ class NSMessageProcessor:
                 # need to return a web.Response object
                 return web.Response(text=json.dumps(response), status=response['status'])
             elif origin == 'broker':
-                # came from mqtt broker, we need to respond with an NSMessage (as json string)
+                # came from mqtt broker, we need to respond with an NSMessage, on the reply topic of the session that asked
                 response_msg = NSMessage()
-                response_msg.set('topic', 'api_response')
+                if self.sessions is not None and isinstance(content, dict):
+                    response_msg.set('topic', self.sessions.get_reply_topic(content))
+                else:
+                    response_msg.set('topic', 'api_response')
                 response_msg.set('origin', 'NSMessageProcessor')
                 response_msg.set('content', response)
-                return response_msg.to_json()
+                return response_msg
             else:
                 logging.warning('dont know how to respond when origin = %s' % response['origin'])
                 return False
@@ -209,6 +221,15 @@ class NSMessageProcessor:
                     'result': result
                 },
             }
+        elif response_type == 'conflict':
+            # the client was changed by someone else, result is the current client so the caller can retry
+            response = {
+                'status': 409,
+                'api_payload': {
+                    'error': 'version conflict, client was changed by someone else',
+                    'client': result,
+                },
+            }
         else:
             response = {
                 'status': 500,
@@ -224,6 +245,18 @@ class NSMessageProcessor:
     def build_error(self, error):
         return self.build_response('error', error)
 
+    def build_conflict(self, client):
+        return self.build_response('conflict', client)
+
+    def build_write_result(self, result):
+        # turn a result object from compare_and_set_client or patch_client into a response
+        client = result['client'].to_dict() if result['client'] else None
+        if result['conflict']:
+            return self.build_conflict(client)
+        if result['success']:
+            return self.build_success(client)
+        return self.build_error('failed to update client')
+
     # these are endpoint_methods
     def get_stage1_files(self, payload):
         if len(dict(payload)) > 0:
@@ -266,6 +299,9 @@ class NSMessageProcessor:
             response = self.build_error('missing needed keys in payload')
         else:
             try:
+                if 'version' in payload:
+                    # only replace if nobody else changed the client since the caller read it
+                    return self.build_write_result(self.client_manager.compare_and_set_client(client_mac, 'config', config_dict, payload['version']))
                 self.client_manager.set_client_config(client_mac, config_dict)
             except Exception:
                 logging.exception('unexpected exception while set_client_config')
@@ -286,6 +322,9 @@ class NSMessageProcessor:
             response = self.build_error('missing needed keys in payload')
         else:
             try:
+                if 'version' in payload:
+                    # only replace if nobody else changed the client since the caller read it
+                    return self.build_write_result(self.client_manager.compare_and_set_client(client_mac, 'info', info_dict, payload['version']))
                 self.client_manager.set_client_info(client_mac, info_dict)
             except Exception:
                 logging.exception('unexpected exception while set_client_info')
@@ -295,6 +334,82 @@ class NSMessageProcessor:
                 response = self.build_success('Success')
         return response
 
+    def patch_client(self, payload):
+        # change individual keys of info, config, or state using a json merge patch, optionally only if version matches
+        try:
+            payload = dict(payload)
+            client_mac = payload['mac']
+            field = payload['field']
+            patch = dict(payload['patch'])
+            version = payload.get('version')
+            logging.debug('patching client %s for mac: %s' % (field, client_mac))
+        except (KeyError, TypeError, ValueError):
+            logging.error('api call to patch_client missing needed keys in payload: %s' % json.dumps(payload))
+            response = self.build_error('missing needed keys in payload')
+        else:
+            if field not in self.client_manager.client_json_fields:
+                return self.build_error('field must be one of: %s' % ', '.join(self.client_manager.client_json_fields))
+            try:
+                response = self.build_write_result(self.client_manager.patch_client(client_mac, field, patch, version))
+            except Exception:
+                logging.exception('unexpected exception while patch_client')
+                response = self.build_error('unexpected exception in patch_client')
+        return response
+
+    def set_clients_config(self, payload):
+        # apply the same config keys to many clients at once, by list of macs and/or a selector
+        try:
+            payload = dict(payload)
+            config_dict = payload['config']
+            client_macs = payload.get('macs', None)
+            selector = payload.get('selector', None)
+            if client_macs is None and selector is None:
+                raise KeyError('macs or selector')
+        except KeyError:
+            logging.error('api call to set_clients_config missing needed keys in payload: %s' % json.dumps(payload))
+            response = self.build_error('missing needed keys in payload')
+        else:
+            try:
+                changed = self.client_manager.set_clients_config(config_dict, client_macs=client_macs, selector=selector)
+            except Exception:
+                logging.exception('unexpected exception while set_clients_config')
+                response = self.build_error('unexpected exception in set_clients_config')
+            else:
+                logging.debug('successfully updated config for %s clients' % len(changed))
+                response = self.build_success(changed)
+        return response
+
+    def import_clients(self, payload):
+        # create or update many clients at once, from csv text or a list of client records
+        try:
+            payload = dict(payload)
+            import_format = payload.get('format', 'json')
+            data = payload['data']
+            if import_format == 'csv':
+                records = self.client_manager.parse_clients_csv(data)
+            elif import_format == 'json':
+                if isinstance(data, str):
+                    data = json.loads(data)
+                records = list(data)
+            else:
+                raise Exception('unknown import format: %s' % import_format)
+            summary = self.client_manager.import_clients(records)
+            return self.build_success(summary)
+        except Exception as ex:
+            logging.exception('exception while import_clients: %s' % ex)
+            return self.build_error('unexpected exception in import_clients')
+
+    def export_clients(self, payload):
+        # export all clients as csv or json text. for large lists, the api server also provides a streaming http endpoint
+        try:
+            payload = dict(payload)
+            export_format = payload.get('format', 'csv')
+            content = ''.join(self.client_manager.export_clients(export_format))
+            return self.build_success(content)
+        except Exception as ex:
+            logging.exception('exception while export_clients: %s' % ex)
+            return self.build_error('unexpected exception in export_clients')
+
     def get_client(self, payload):
         # get all client information and config
         try:
@@ -302,6 +417,8 @@ class NSMessageProcessor:
             client_mac = payload['mac']
             logging.debug('getting client config for mac: %s' % client_mac)
             all_props = self.client_manager.get_client(client_mac)
+            if all_props:
+                all_props = all_props.to_dict()
         except Exception as ex:
             logging.exception('unexpected exception while get_client_config: %s' % ex)
             response = self.build_error('error while get_client_config')
@@ -312,7 +429,21 @@ class NSMessageProcessor:
     def get_clients(self, payload):
         if len(dict(payload)) > 0:
             logging.warning('this endpoint does not take any payload keys')
-        result = self.client_manager.get_clients()
+        result = [client.to_dict() for client in self.client_manager.get_clients()]
+        return self.build_success(result)
+
+    def query_clients(self, payload):
+        # one page of clients matching filters, see NSClientQueryIndex.query. keys: filters, sort, cursor, limit, fields, all optional
+        try:
+            payload = dict(payload)
+            result = self.client_manager.query_clients(filters=payload.get('filters'), sort=payload.get('sort', 'mac'), cursor=payload.get('cursor'),
+                                                       limit=payload.get('limit', 100), fields=payload.get('fields'))
+        except ValueError as ex:
+            # a bad filter, sort, cursor or limit
+            return self.build_error(str(ex))
+        except Exception as ex:
+            logging.exception('exception while query_clients: %s' % ex)
+            return self.build_error('unexpected exception in query_clients')
         return self.build_success(result)
 
     def create_task(self, payload):
@@ -382,14 +513,16 @@ class NSMessageProcessor:
             for this_builtin in self.builtin_files['boot_images']:
                 if this_builtin['boot_image_name'] == boot_image_name:
                     raise Exception('cannot delete builtins')
-            if '.ipxe' in boot_image_name:
-                fullpath = pathlib.Path(self.paths['boot_images']).joinpath(boot_image_name)
+            boot_image = self.boot_image_catalog.lookup(boot_image_name)
+            if boot_image is None:
+                raise Exception('no such boot image: %s' % boot_image_name)
+            fullpath = pathlib.Path(self.paths['boot_images']).joinpath(boot_image_name)
+            if boot_image['kind'] == 'file':
                 self.delete_file(fullpath)
-                return self.build_success('Success')
             else:
-                fullpath = pathlib.Path(self.paths['boot_images']).joinpath(boot_image_name)
                 self.delete_folder(fullpath)
-                return self.build_success('Success')
+            self.boot_image_catalog.discard(boot_image_name)
+            return self.build_success('Success')
         except Exception as ex:
             logging.exception('exception while delete_boot_image: %s' % ex)
             return self.build_error('unexpected exception in delete_boot_image')
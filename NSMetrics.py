@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: Metrics
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# request metrics for an aiohttp server, recorded by a middleware: count, status codes, bytes sent, and a latency histogram per route
+#   handlers can also time the sub-phases of a request (ex: db, arp, dns, file) using: with metrics.phase('arp'):
+#   latency is measured until the response is completely sent, so for files it includes the transfer
+#   percentiles are estimated from histogram buckets, so they are the upper bound of the bucket the percentile falls in
+#   everything happens on the event loop, so no locking is needed
+
+import time
+import bisect
+import contextlib
+
+from aiohttp import web
+
+# seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class NSHistogram:
+    """
+    Histogram of durations, in seconds
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile
+        :param q: quantile, between 0 and 1
+        :type q: float
+        :return: upper bound of the bucket where the quantile falls, max if in the last bucket, 0 if empty
+        :rtype: float
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count > 0:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total * 1000, 3),
+            'mean_ms': round(self.total * 1000 / self.count, 3) if self.count else 0,
+            'p50_ms': round(self.quantile(0.5) * 1000, 3),
+            'p95_ms': round(self.quantile(0.95) * 1000, 3),
+            'p99_ms': round(self.quantile(0.99) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+            'buckets': {str(bound): bucket_count for bound, bucket_count in zip(self.bounds + ('+Inf', ), self.counts)},
+        }
+
+
+class NSRouteMetrics:
+    """
+    Metrics for a single route
+    """
+    __slots__ = ('count', 'errors', 'statuses', 'bytes', 'latency')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0  # responses with status 500 and higher
+        self.statuses = {}  # status code -> count
+        self.bytes = 0
+        self.latency = NSHistogram()
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'statuses': {str(status): status_count for status, status_count in sorted(self.statuses.items())},
+            'bytes': self.bytes,
+            'latency': self.latency.to_dict(),
+        }
+
+
+class NSMetrics:
+    """
+    Request and sub-phase metrics for an aiohttp server
+    """
+
+    def __init__(self, name):
+        """
+        Metrics
+        :param name: name of the server, included in the output
+        :type name: str
+        """
+        self.name = name
+        self.started = time.time()
+        self.routes = {}  # 'METHOD /canonical/path' -> NSRouteMetrics
+        self.phases = {}  # phase name -> NSHistogram
+
+    @staticmethod
+    def get_route_name(request):
+        # use the route pattern rather than the path, so that /packages/{filename} is one route and not one per file
+        resource = request.match_info.route.resource
+        if resource is None:
+            return '%s unmatched' % request.method
+        return '%s %s' % (request.method, resource.canonical)
+
+    @staticmethod
+    def get_response_bytes(request, response):
+        # file responses are sent with sendfile, which the payload writer does not count, so prefer content length
+        if request.method == 'HEAD':
+            return 0
+        if response.content_length is not None:
+            return response.content_length
+        return response.body_length
+
+    def observe_request(self, route_name, status, num_bytes, seconds):
+        """
+        Record a finished request
+        :param route_name: route, as returned by get_route_name
+        :type route_name: str
+        :param status: http status code
+        :type status: int
+        :param num_bytes: bytes sent
+        :type num_bytes: int
+        :param seconds: time taken
+        :type seconds: float
+        """
+        route = self.routes.get(route_name)
+        if route is None:
+            route = self.routes[route_name] = NSRouteMetrics()
+        route.count += 1
+        route.statuses[status] = route.statuses.get(status, 0) + 1
+        if status >= 500:
+            route.errors += 1
+        route.bytes += num_bytes
+        route.latency.observe(seconds)
+
+    def observe_phase(self, phase_name, seconds):
+        histogram = self.phases.get(phase_name)
+        if histogram is None:
+            histogram = self.phases[phase_name] = NSHistogram()
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, phase_name):
+        """
+        Time a sub-phase of a request, ex: with metrics.phase('db'):
+        :param phase_name: name of the phase
+        :type phase_name: str
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase_name, time.perf_counter() - start)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """
+        aiohttp middleware which records metrics for every request
+        :param request: web request
+        :type request: web.Request
+        :param handler: next handler
+        :type handler: Callable
+        :return: web response
+        :rtype: web.StreamResponse
+        """
+        start = time.perf_counter()
+        route_name = self.get_route_name(request)
+        try:
+            response = await handler(request)
+            if not response.prepared:
+                # send it now, so that latency and bytes cover the whole response. aiohttp skips responses which are already sent
+                await response.prepare(request)
+                await response.write_eof()
+        except web.HTTPException as ex:
+            self.observe_request(route_name, ex.status, 0, time.perf_counter() - start)
+            raise
+        except Exception:
+            self.observe_request(route_name, 500, 0, time.perf_counter() - start)
+            raise
+        self.observe_request(route_name, response.status, self.get_response_bytes(request, response), time.perf_counter() - start)
+        return response
+
+    def get_metrics(self):
+        """
+        Get all metrics
+        :return: metrics
+        :rtype: dict
+        """
+        return {
+            'name': self.name,
+            'uptime': round(time.time() - self.started, 3),
+            'routes': {route_name: route.to_dict() for route_name, route in sorted(self.routes.items())},
+            'phases': {phase_name: histogram.to_dict() for phase_name, histogram in sorted(self.phases.items())},
+        }
+
+    def get_summary(self):
+        """
+        Get a row per route and per phase, without histogram buckets. This is the value of the DataSource for the web ui
+        :return: list of rows
+        :rtype: List[dict]
+        """
+        rows = []
+        for route_name, route in sorted(self.routes.items()):
+            latency = route.latency.to_dict()
+            del latency['buckets']
+            rows.append(dict(latency, kind='route', name=route_name, errors=route.errors, bytes=route.bytes,
+                             statuses={str(status): status_count for status, status_count in sorted(route.statuses.items())}))
+        for phase_name, histogram in sorted(self.phases.items()):
+            latency = histogram.to_dict()
+            del latency['buckets']
+            rows.append(dict(latency, kind='phase', name=phase_name))
+        return rows
+
+    def to_prometheus(self):
+        """
+        Get all metrics in the prometheus text exposition format
+        :return: metrics text
+        :rtype: str
+        """
+        prefix = 'netbootstudio_%s' % self.name
+        route_labels = {}
+        for route_name in self.routes:
+            method, path = route_name.split(' ', 1)
+            route_labels[route_name] = 'method="%s",route="%s"' % (method, path.replace('\\', '\\\\').replace('"', '\\"'))
+        # every sample of a metric must be in one group, after its TYPE line
+        lines = ['# TYPE %s_requests_total counter' % prefix]
+        for route_name, route in sorted(self.routes.items()):
+            for status, status_count in sorted(route.statuses.items()):
+                lines.append('%s_requests_total{%s,status="%s"} %s' % (prefix, route_labels[route_name], status, status_count))
+        lines.append('# TYPE %s_response_bytes_total counter' % prefix)
+        for route_name, route in sorted(self.routes.items()):
+            lines.append('%s_response_bytes_total{%s} %s' % (prefix, route_labels[route_name], route.bytes))
+
+        def add_histogram(metric, labels, histogram):
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.bounds + ('+Inf', ), histogram.counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket{%s,le="%s"} %s' % (metric, labels, bound, cumulative))
+            lines.append('%s_sum{%s} %s' % (metric, labels, histogram.total))
+            lines.append('%s_count{%s} %s' % (metric, labels, histogram.count))
+
+        lines.append('# TYPE %s_request_duration_seconds histogram' % prefix)
+        for route_name, route in sorted(self.routes.items()):
+            add_histogram('%s_request_duration_seconds' % prefix, route_labels[route_name], route.latency)
+        lines.append('# TYPE %s_phase_duration_seconds histogram' % prefix)
+        for phase_name, histogram in sorted(self.phases.items()):
+            add_histogram('%s_phase_duration_seconds' % prefix, 'phase="%s"' % phase_name, histogram)
+        return '\n'.join(lines) + '\n'
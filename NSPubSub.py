@@ -6,68 +6,493 @@ Netboot Studio Library: Pub Sub Messaging
 #    This file is part of Netboot Studio, a system for managing netboot clients
 #    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
 
+# a service has many parts which talk over mqtt (DataSources, ClientManager, TaskManager...), each with its own NSMQTTClient
+#   rather than each of them opening a TLS connection with its own paho network thread, they all share one NSMQTTHub per process
+#   the hub subscribes to the union of their topics, and hands each message to every client subscribed to its topic
+#   the broker sends one copy of a message per connection, so every client still gets exactly one copy, including of its own messages
+#   the hub disconnects when its last client stops, and a new one is created if another client starts after that
+# there is no paho network thread: the socket is watched by the service's asyncio loop (add_reader / add_writer), like paho's loop_asyncio example
+#   so callbacks run on the loop, one after another, and can safely use everything else that lives on the loop. they should not block for long
+#   a callback which is a coroutine function is scheduled as a task for each message
+#   publish() from another thread is handed to the loop, so paho is only ever used from the loop thread
+#   publish_async() waits while too many messages are still waiting to be written to the socket (backpressure)
+#   messages published with qos 1 are kept by paho until the broker acknowledges them, and sent again after a reconnect
+#     flush() waits for those acknowledgements too, so they are not lost when shutting down
+#   keepalive and reconnecting, which the paho thread used to do, are done by a task on the loop
+#   connecting (TCP connect and TLS handshake) blocks for as long as the broker takes, so it runs on the hub's own executor thread instead of the loop
+#     paho calls the socket callbacks from that thread, they hand the socket to the loop
+#     paho must queue CONNECT before anything else, so publishes made meanwhile are held until the broker answers, and published once we are subscribed
+
+import time
+import uuid
+import socket
 import asyncio
 import logging
+import concurrent.futures
 import paho.mqtt.client as mqtt
 
+from threading import Lock
 
-class NSMQTTClient:
-    # Listens on a given list of mqtt topics, returns messages to a callback(msg, topic)
+_hub = None
+_hub_lock = Lock()
 
-    def __init__(self, name, config, paths, topics, callback, loop):
-        self.name = name
+
+def get_mqtt_hub(config, paths, loop):
+    """
+    Get the mqtt hub for this process, connecting it if needed
+    :param config: config object
+    :type config: RawConfigParser
+    :param paths: paths object
+    :type paths: dict
+    :param loop: asyncio loop of the service
+    :type loop: AbstractEventLoop
+    :return: mqtt hub
+    :rtype: NSMQTTHub
+    """
+    global _hub
+    with _hub_lock:
+        if _hub is None or _hub.stopped:
+            _hub = NSMQTTHub(config, paths, loop)
+        return _hub
+
+
+class NSMQTTHub:
+    """
+    A single mqtt connection, shared by all the NSMQTTClients in a process, driven by the asyncio loop
+    """
+    misc_cycle = 1  # seconds, how often paho needs to check keepalive
+    max_reconnect_delay = 60  # seconds
+    max_unsent = 1000  # publish_async waits while this many messages are waiting to be written
+    low_unsent = 500  # and carries on once it is down to this many
+
+    def __init__(self, config, paths, loop):
+        """
+        MQTT Hub
+        :param config: config object
+        :type config: RawConfigParser
+        :param paths: paths object
+        :type paths: dict
+        :param loop: asyncio loop of the service
+        :type loop: AbstractEventLoop
+        """
         self.config = config
         self.paths = paths
-        self.callback = callback
         self.loop = loop
-        self.topics = topics
+        self.name = 'NSMQTTHub_%s' % uuid.uuid4()
+        self.clients = []  # registered NSMQTTClients
+        self.lock = Lock()  # clients may be created from other threads
+        self.connected = False
+        self.stopped = False
+        self.sock = None
+        self.misc_task = None
+        self.reconnect_delay = 1
+        self.reconnect_handle = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+        self.connecting = False  # from starting a connect until the broker answers it
+        self.connect_future = None  # while connecting on the executor
+        self.deferred = []  # (topic, payload, qos) published while connecting
+        self.unsent = set()  # mids of messages not yet written to the socket, or for qos > 0, not yet acknowledged
+        self.unacked = set()  # mids of messages with qos > 0 not yet acknowledged, which survive a reconnect
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.published = 0
+        self.received = 0
         try:
             self.host = self.config.get('main', 'netboot_server_hostname')
             self.port = int(self.config.get('broker', 'port'))
             self.username = self.config.get('broker', 'user')
             self.password = self.config.get('broker', 'password')
-            logging.debug('Starting MQTT Client named: %s, broker: %s:%s' % (self.name, self.host, self.port))
+            logging.debug('Starting MQTT Hub named: %s, broker: %s:%s' % (self.name, self.host, self.port))
             self.client = mqtt.Client(self.name)
             self.client.on_message = self.on_message
             self.client.username_pw_set(username=self.username, password=self.password)
             self.client.tls_set(self.paths['ssl_full_chain'])
             self.client.tls_insecure_set(False)
             self.client.on_connect = self.on_connect
-            self.client.on_connect_fail = self.on_connect_fail
-            self.client.connect(self.host, self.port)
-            self.loop.run_until_complete(self.do_client())
+            self.client.on_disconnect = self.on_disconnect
+            self.client.on_publish = self.on_publish
+            self.client.on_socket_open = self.on_socket_open
+            self.client.on_socket_close = self.on_socket_close
+            self.client.on_socket_register_write = self.on_socket_register_write
+            self.client.on_socket_unregister_write = self.on_socket_unregister_write
+            self.client.connect_async(self.host, self.port)
+            # the hub may be created from another thread, and the executor is started from the loop
+            self.loop.call_soon_threadsafe(self.reconnect)
         except Exception as ex:
-            logging.error('Unexpected Exception while setting up MQTT Client: %s', ex)
+            logging.error('Unexpected Exception while setting up MQTT Hub: %s', ex)
+            self.schedule_reconnect()
+
+    def on_loop(self, callback, *args):
+        # paho calls the socket callbacks from the executor while connecting, and from the loop otherwise
+        if self.in_loop_thread():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.on_loop(self.watch_socket, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        # by the time the loop gets to it, paho has closed the socket, so use its fd
+        self.on_loop(self.unwatch_socket, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.on_loop(self.watch_write, sock)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.on_loop(self.loop.remove_writer, sock.fileno())
+
+    def watch_socket(self, sock):
+        if sock.fileno() == -1:
+            # already closed again, ex: by flush() while shutting down
+            return
+        self.sock = sock
+        self.loop.add_reader(sock, self.handle_read)
+        if self.misc_task is None:
+            self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def watch_write(self, sock):
+        if sock.fileno() != -1:
+            self.loop.add_writer(sock, self.handle_write)
+
+    def unwatch_socket(self, fd):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        if self.sock is not None and self.sock.fileno() in (fd, -1):
+            self.sock = None
+
+    def handle_read(self):
+        self.client.loop_read()
+        # tls may have already decrypted more than one packet, which select would not tell us about
+        while self.sock is not None and getattr(self.sock, 'pending', None) is not None and self.sock.pending():
+            self.client.loop_read()
+
+    def handle_write(self):
+        self.client.loop_write()
+
+    async def misc_loop(self):
+        # keepalive pings, and retries of messages with qos > 0
+        while not self.stopped:
+            if self.connect_future is None:
+                self.client.loop_misc()
+            await asyncio.sleep(self.misc_cycle)
+
+    def on_disconnect(self, client, userdata, rc):
+        with self.lock:
+            self.connected = False
+        if self.connecting and self.connect_future is None:
+            # refused, or lost before the broker answered
+            self.connect_done()
+        # qos 0 messages still waiting were dropped with the connection, paho sends the others again once we reconnect
+        self.unsent.intersection_update(self.unacked)
+        if len(self.unsent) <= self.low_unsent:
+            self.writable.set()
+        if not self.stopped:
+            logging.warning('MQTT Hub named: %s, lost connection to broker, rc: %s' % (self.name, rc))
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self.stopped or self.reconnect_handle is not None:
+            return
+        self.reconnect_handle = self.loop.call_later(self.reconnect_delay, self.reconnect)
+        self.reconnect_delay = min(self.reconnect_delay * 2, self.max_reconnect_delay)
+
+    def reconnect(self):
+        self.reconnect_handle = None
+        if self.stopped or self.connecting:
+            return
+        logging.debug('MQTT Hub named: %s, reconnecting to %s:%s' % (self.name, self.host, self.port))
+        self.connecting = True
+        future = self.executor.submit(self.connect_blocking)
+        self.connect_future = future
+        asyncio.wrap_future(future, loop=self.loop).add_done_callback(lambda _: self.reconnect_finished(future))
+
+    def connect_blocking(self):
+        # runs on the executor, returns the error if it failed
+        try:
+            self.client.reconnect()
+        except (socket.error, OSError, ValueError) as ex:
+            return ex
+        return None
+
+    def reconnect_finished(self, future):
+        # on the loop, unless wait_reconnect already handled it
+        if self.reconnect_done(future) and self.stopped:
+            # stopped while connecting, and unregister could not wait that long to disconnect
+            self.client.disconnect()
 
-    async def do_client(self):
-        self.client.loop_start()
-        await asyncio.sleep(0.01)
+    def reconnect_done(self, future):
+        """
+        Handle the outcome of a connect on the executor
+        :param future: future of connect_blocking
+        :type future: concurrent.futures.Future
+        :return: True if paho has queued CONNECT, and we now wait for the broker to answer
+        :rtype: bool
+        """
+        if future is not self.connect_future:
+            return False
+        self.connect_future = None
+        error = future.result()
+        if error is None:
+            return True
+        logging.error('MQTT Hub named: %s, failed to reconnect: %s' % (self.name, error))
+        self.connect_done()
+        self.schedule_reconnect()
+        return False
+
+    def connect_done(self):
+        # publish what was held while connecting, paho keeps messages with qos > 0 if we did not get connected after all
+        self.connecting = False
+        deferred, self.deferred = self.deferred, []
+        for topic, payload, qos in deferred:
+            self.publish(topic, payload, qos)
+        if len(self.unsent) <= self.low_unsent:
+            self.writable.set()
+
+    def wait_reconnect(self, timeout):
+        """
+        Wait for a connect in progress to finish, without the loop running, ex: while shutting down
+        :param timeout: seconds to wait
+        :type timeout: float
+        :return: True if no connect is in progress anymore
+        :rtype: bool
+        """
+        future = self.connect_future
+        if future is None:
+            return True
+        concurrent.futures.wait([future], timeout)
+        if not future.done():
+            return False
+        self.reconnect_done(future)
+        return True
+
+    def on_publish(self, client, userdata, mid):
+        # qos 0: written to the socket, qos 1: acknowledged by the broker
+        self.unsent.discard(mid)
+        self.unacked.discard(mid)
+        if len(self.unsent) <= self.low_unsent:
+            self.writable.set()
+
+    def flush(self, timeout=5):
+        """
+        Write everything waiting to be sent, and wait for messages with qos > 0 to be acknowledged, without the loop running, ex: while shutting down
+        :param timeout: seconds to wait
+        :type timeout: float
+        :return: True if everything was written and acknowledged
+        :rtype: bool
+        """
+        deadline = time.monotonic() + timeout
+        if not self.wait_reconnect(timeout):
+            logging.warning('MQTT Hub named: %s, still connecting to the broker, nothing was flushed' % self.name)
+            return False
+        while self.client.want_write() and time.monotonic() < deadline:
+            if self.client.loop_write() != mqtt.MQTT_ERR_SUCCESS:
+                break
+        while self.unacked and time.monotonic() < deadline:
+            # reads the acknowledgements, calling on_publish, and writes anything sent again after a reconnect
+            if self.client.loop(timeout=min(0.1, max(deadline - time.monotonic(), 0))) != mqtt.MQTT_ERR_SUCCESS:
+                break
+        if self.unacked:
+            logging.warning('MQTT Hub named: %s, %s messages were not acknowledged by the broker' % (self.name, len(self.unacked)))
+        return not self.client.want_write() and not self.unacked
+
+    def get_topics(self):
+        # every topic any client is subscribed to, with the highest qos any of them asked for
+        topics = {}
+        for mqtt_client in self.clients:
+            for topic, qos in mqtt_client.topics:
+                topics[topic] = max(qos, topics.get(topic, 0))
+        return list(topics.items())
+
+    def register(self, mqtt_client):
+        """
+        Start delivering messages to a client, subscribing to any of its topics we are not subscribed to yet
+        :param mqtt_client: client
+        :type mqtt_client: NSMQTTClient
+        """
+        with self.lock:
+            known_topics = {topic for topic, _ in self.get_topics()}
+            self.clients.append(mqtt_client)
+            new_topics = [(topic, qos) for topic, qos in mqtt_client.topics if topic not in known_topics]
+            connected = self.connected
+        if connected:
+            # otherwise, on_connect will subscribe to everything, and then call connect_callback
+            if new_topics:
+                self.subscribe(new_topics)
+            if mqtt_client.connect_callback is not None:
+                # not right here, as the owner of mqtt_client is still in the middle of creating it
+                self.loop.call_soon_threadsafe(mqtt_client.connect_callback)
+
+    def unregister(self, mqtt_client):
+        """
+        Stop delivering messages to a client, and disconnect if it was the last one
+        :param mqtt_client: client
+        :type mqtt_client: NSMQTTClient
+        """
+        with self.lock:
+            if mqtt_client in self.clients:
+                self.clients.remove(mqtt_client)
+            remaining_topics = {topic for topic, _ in self.get_topics()}
+            unused_topics = [topic for topic, _ in mqtt_client.topics if topic not in remaining_topics]
+            last_client = not self.clients
+            if last_client:
+                self.stopped = True
+        if last_client:
+            logging.info('shutting down MQTT Hub...')
+            if self.reconnect_handle is not None:
+                self.reconnect_handle.cancel()
+            # the loop may not run again, so send the disconnect ourselves, once paho has queued the connect
+            #   and after the broker acknowledged what we sent, as paho closes the socket as soon as the disconnect is written
+            if self.wait_reconnect(timeout=1):
+                if self.connecting:
+                    self.connect_done()
+                self.flush(timeout=1)
+                self.client.disconnect()
+                self.flush(timeout=1)
+            self.executor.shutdown(wait=False)
+            if self.misc_task is not None:
+                self.misc_task.cancel()
+        elif unused_topics and self.connected:
+            # otherwise, on_connect will subscribe to only the remaining topics
+            self.client.unsubscribe(unused_topics)
 
     def on_message(self, client, userdata, message):
         msg = str(message.payload.decode('utf-8'))
         topic = str(message.topic)
-        self.callback(topic, msg)
+        self.received += 1
+        with self.lock:
+            receivers = [mqtt_client for mqtt_client in self.clients if mqtt_client.wants(topic)]
+        for mqtt_client in receivers:
+            try:
+                if asyncio.iscoroutinefunction(mqtt_client.callback):
+                    self.loop.create_task(mqtt_client.callback(topic, msg))
+                else:
+                    mqtt_client.callback(topic, msg)
+            except Exception as ex:
+                logging.exception('exception in mqtt callback of: %s, %s' % (mqtt_client.name, ex))
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
-            logging.debug('MQTT Client named: %s, successfully connected to %s:%s' % (self.name, self.host, self.port))
-            self.subscribe(self.topics)
+            logging.debug('MQTT Hub named: %s, successfully connected to %s:%s' % (self.name, self.host, self.port))
+            self.reconnect_delay = 1
+            with self.lock:
+                self.connected = True
+                topics = self.get_topics()
+                connect_callbacks = [mqtt_client.connect_callback for mqtt_client in self.clients if mqtt_client.connect_callback is not None]
+            if topics:
+                self.subscribe(topics)
+            for connect_callback in connect_callbacks:
+                connect_callback()
+            self.connect_done()
         elif rc == 5:
             logging.error('MQTT Client failed to connect: Authentication Error')
         else:
             logging.error('MQTT Client failed to connect, rc: %s' % rc)
 
-    def on_connect_fail(self):
-        logging.error('MQTT Client named: %s, failed to connect to %s:%s' % (self.name, self.host, self.port))
+    def in_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            # no loop running in this thread, which is fine unless our loop is running somewhere else
+            return not self.loop.is_running()
+
+    def publish(self, topic, payload, qos=0):
+        """
+        Publish a message
+        :param topic: mqtt topic
+        :type topic: str
+        :param payload: message
+        :type payload: str
+        :param qos: 0 to send it once, 1 to send it until the broker acknowledges it
+        :type qos: int
+        :return: message info, or None when called from another thread or while connecting, in which case the message is published later
+        :rtype: MQTTMessageInfo
+        """
+        if not self.in_loop_thread():
+            self.loop.call_soon_threadsafe(self.publish, topic, payload, qos)
+            return None
+        if self.connecting:
+            self.deferred.append((topic, payload, qos))
+            if len(self.unsent) + len(self.deferred) >= self.max_unsent:
+                self.writable.clear()
+            return None
+        message_info = self.client.publish(topic, payload, qos)
+        self.published += 1
+        if qos > 0 and message_info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            # while disconnected, paho keeps it and sends it once we reconnect
+            self.unacked.add(message_info.mid)
+            self.unsent.add(message_info.mid)
+        elif message_info.rc == mqtt.MQTT_ERR_SUCCESS and not message_info.is_published():
+            self.unsent.add(message_info.mid)
+        if len(self.unsent) >= self.max_unsent:
+            self.writable.clear()
+        return message_info
 
-    def publish(self, topic, payload):
-        # publish a message on a topic
-        self.client.publish(topic, payload)
+    async def publish_async(self, topic, payload, qos=0):
+        # like publish, but first wait until the broker has caught up if we are too far ahead of it
+        await self.writable.wait()
+        return self.publish(topic, payload, qos)
 
     def subscribe(self, topics):
+        if not self.connected:
+            # on_connect will subscribe to everything
+            return
         logging.debug('subscribing to topics: %s' % topics)
         self.client.subscribe(topics)
 
+    def get_stats(self):
+        return {
+            'clients': len(self.clients),
+            'connected': self.connected,
+            'published': self.published,
+            'received': self.received,
+            'unsent': len(self.unsent),
+            'unacked': len(self.unacked),
+        }
+
+
+class NSMQTTClient:
+    # Listens on a given list of mqtt topics, returns messages to a callback(msg, topic)
+    #   connect_callback, if given, is called on the loop after every successful connect once we are subscribed, or soon after starting if already connected
+    #   the connection itself belongs to the NSMQTTHub of this process, see top of file
+
+    def __init__(self, name, config, paths, topics, callback, loop, connect_callback=None):
+        self.name = name
+        self.config = config
+        self.paths = paths
+        self.callback = callback
+        self.connect_callback = connect_callback
+        self.loop = loop
+        self.topics = topics
+        logging.debug('Starting MQTT Client named: %s' % self.name)
+        self.hub = get_mqtt_hub(self.config, self.paths, self.loop)
+        self.hub.register(self)
+
+    def wants(self, topic):
+        # subscriptions may use wildcards
+        for subscription, _ in self.topics:
+            if mqtt.topic_matches_sub(subscription, topic):
+                return True
+        return False
+
+    def publish(self, topic, payload, qos=0):
+        # publish a message on a topic, returns MQTTMessageInfo (None if called from another thread)
+        return self.hub.publish(topic, payload, qos)
+
+    async def publish_async(self, topic, payload, qos=0):
+        # publish a message on a topic, waiting first if too many messages are still waiting to be sent
+        return await self.hub.publish_async(topic, payload, qos)
+
+    def flush(self, timeout=5):
+        # make sure everything published so far was written, and acknowledged if qos > 0, ex: before shutting down
+        return self.hub.flush(timeout)
+
+    def subscribe(self, topics):
+        # add topics to this client
+        new_topics = [(topic, qos) for topic, qos in topics if (topic, qos) not in self.topics]
+        self.topics = list(self.topics) + new_topics
+        self.hub.subscribe(new_topics)
+
     def stop(self):
-        logging.info('shutting down MQTT Client...')
-        self.client.loop_stop()
+        logging.info('shutting down MQTT Client: %s' % self.name)
+        self.hub.unregister(self)
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: Static File Serving
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# boot images and isos are often several GB, and clients on flaky networks need to resume them instead of starting over
+#   NSStaticFiles serves a folder with range requests (including multiple ranges), conditional requests, and download counters
+#   strong ETags come from NSChecksumIndex, which hashes files in a background thread and remembers them across restarts
+#   until a file has been hashed, it gets a weak ETag, which is good enough for If-None-Match but not for If-Range
+#   full and single-range responses are handed to aiohttp's FileResponse, which uses sendfile
+
+import os
+import json
+import queue
+import hashlib
+import logging
+import pathlib
+import mimetypes
+
+from threading import Thread
+from email.utils import formatdate, parsedate_to_datetime
+
+from aiohttp import web
+from multidict import CIMultiDict
+
+
+class NSChecksumIndex:
+    """
+    Index of sha256 checksums of files, keyed by path and invalidated when mtime or size changes
+    """
+    chunk_size = 1024 * 1024
+    save_every = 50  # files hashed between saves of the index
+
+    def __init__(self, index_file):
+        """
+        Checksum Index
+        :param index_file: where to keep the index between restarts
+        :type index_file: pathlib.Path
+        """
+        self.index_file = pathlib.Path(index_file)
+        self.checksums = {}  # str(path) -> [mtime_ns, size, sha256]
+        self.pending = set()
+        self.queue = queue.Queue()
+        self.stopping = False
+        self.load()
+        self.worker = Thread(target=self.work, name='NSChecksumIndex', daemon=True)
+        self.worker.start()
+
+    def load(self):
+        try:
+            if self.index_file.is_file():
+                with open(self.index_file, 'r') as index_f:
+                    self.checksums = json.load(index_f)
+        except Exception as ex:
+            logging.error('unable to load checksum index: %s, %s' % (self.index_file, ex))
+
+    def save(self):
+        temp_file = self.index_file.with_name(self.index_file.name + '.tmp')
+        try:
+            with open(temp_file, 'w') as index_f:
+                json.dump(dict(self.checksums), index_f)
+            os.replace(temp_file, self.index_file)
+        except Exception as ex:
+            logging.error('unable to save checksum index: %s, %s' % (self.index_file, ex))
+
+    def stop(self):
+        self.stopping = True
+        self.queue.put(None)
+
+    def get(self, file_path, stat=None):
+        """
+        Get the checksum for a file, if it has been computed since the file last changed. Otherwise, queue it to be hashed
+        :param file_path: path to file
+        :type file_path: pathlib.Path
+        :param stat: result of stat() on the file, if you already have it
+        :type stat: os.stat_result
+        :return: sha256 hex digest, or None if not ready yet
+        :rtype: str
+        """
+        if stat is None:
+            stat = file_path.stat()
+        entry = self.checksums.get(str(file_path))
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2]
+        self.request(file_path)
+        return None
+
+    def request(self, file_path):
+        # queue a file to be hashed, unless it already is
+        key = str(file_path)
+        if key not in self.pending:
+            self.pending.add(key)
+            self.queue.put(file_path)
+
+    def scan(self, folders):
+        """
+        Queue every file within the given folders that does not have a current checksum. Walking the folders happens in its own thread
+        :param folders: folders to scan recursively
+        :type folders: List[pathlib.Path]
+        """
+        Thread(target=self.scan_folders, args=(folders,), name='NSChecksumIndexScan', daemon=True).start()
+
+    def scan_folders(self, folders):
+        for folder in folders:
+            for file_path in pathlib.Path(folder).rglob('*'):
+                if self.stopping:
+                    return
+                try:
+                    if file_path.is_file():
+                        self.get(file_path)
+                except OSError:
+                    pass
+
+    def hash_file(self, file_path):
+        stat_before = file_path.stat()
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as hash_f:
+            while not self.stopping:
+                chunk = hash_f.read(self.chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        stat_after = file_path.stat()
+        if self.stopping or stat_before.st_mtime_ns != stat_after.st_mtime_ns or stat_before.st_size != stat_after.st_size:
+            # changed while we were reading it, it will be queued again on next request
+            return
+        self.checksums[str(file_path)] = [stat_after.st_mtime_ns, stat_after.st_size, digest.hexdigest()]
+
+    def work(self):
+        # runs in its own thread; hashing a multi-GB file takes a while, and must not block the event loop
+        unsaved = 0
+        while not self.stopping:
+            try:
+                file_path = self.queue.get(timeout=5)
+            except queue.Empty:
+                if unsaved > 0:
+                    self.save()
+                    unsaved = 0
+                continue
+            if file_path is None:
+                break
+            try:
+                self.hash_file(file_path)
+                unsaved += 1
+            except OSError as ex:
+                logging.debug('unable to hash file: %s, %s' % (file_path, ex))
+            finally:
+                self.pending.discard(str(file_path))
+            if unsaved >= self.save_every:
+                self.save()
+                unsaved = 0
+        if unsaved > 0:
+            self.save()
+
+
+class NSFileResponse(web.FileResponse):
+    """
+    FileResponse which is prepared using a copy of the request, with the headers we already handled removed
+    """
+
+    def __init__(self, path, forwarded_request, **kwargs):
+        super().__init__(path, **kwargs)
+        self.forwarded_request = forwarded_request
+        self.started = False
+
+    async def prepare(self, request):
+        if self.started:
+            # FileResponse.prepare sends the file every time it is called, and the metrics middleware may have sent it already
+            return None
+        self.started = True
+        return await super().prepare(self.forwarded_request)
+
+
+class NSStaticFiles:
+    """
+    Serve files from a folder, with support for ETag, conditional requests, and single or multiple byte ranges
+    """
+    max_ranges = 16  # more ranges than this is probably abuse, we serve the whole file instead
+    multipart_chunk_size = 256 * 1024
+
+    def __init__(self, name, root, checksum_index, loop):
+        """
+        Static Files
+        :param name: name used for download counters and logging, ex: boot_images
+        :type name: str
+        :param root: folder to serve
+        :type root: pathlib.Path
+        :param checksum_index: shared checksum index
+        :type checksum_index: NSChecksumIndex
+        :param loop: asyncio loop
+        :type loop: AbstractEventLoop
+        """
+        self.name = name
+        self.root = pathlib.Path(root)
+        self.checksum_index = checksum_index
+        self.loop = loop
+        self.downloads = {}  # relative path -> counters, see count_download
+
+    def resolve(self, filename):
+        # resolve filename within root, refusing anything that escapes it
+        try:
+            root = self.root.resolve()
+            file_path = root.joinpath(filename).resolve()
+            file_path.relative_to(root)
+        except (ValueError, OSError, RuntimeError):
+            return None
+        if not file_path.is_file():
+            return None
+        return file_path
+
+    def count_download(self, file_path, response_type, num_bytes):
+        """
+        Count a response for a file
+        :param file_path: path to file
+        :type file_path: pathlib.Path
+        :param response_type: full, partial, or not_modified
+        :type response_type: str
+        :param num_bytes: number of bytes in the response body
+        :type num_bytes: int
+        """
+        key = str(file_path.relative_to(self.root.resolve()))
+        if key not in self.downloads:
+            self.downloads[key] = {
+                'full': 0,
+                'partial': 0,
+                'not_modified': 0,
+                'bytes': 0,
+            }
+        self.downloads[key][response_type] += 1
+        self.downloads[key]['bytes'] += num_bytes
+
+    def get_downloads(self):
+        return self.downloads
+
+    @staticmethod
+    def etag_matches(header, etag, weak_ok):
+        # check an If-None-Match or If-Range value against our etag
+        if etag is None:
+            return False
+        if header.strip() == '*':
+            return True
+        for candidate in header.split(','):
+            candidate = candidate.strip()
+            if weak_ok:
+                if candidate.startswith('W/'):
+                    candidate = candidate[2:]
+                if candidate == etag.replace('W/', '', 1):
+                    return True
+            elif candidate == etag and not etag.startswith('W/'):
+                return True
+        return False
+
+    @staticmethod
+    def parse_http_date(value):
+        try:
+            return parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    @staticmethod
+    def parse_ranges(header, file_size):
+        """
+        Parse a Range header
+        :param header: value of Range header
+        :type header: str
+        :param file_size: size of file in bytes
+        :type file_size: int
+        :return: list of (start, end) inclusive, empty list if none are satisfiable, or None if the header is invalid
+        :rtype: List[Tuple[int, int]]
+        """
+        unit, _, range_set = header.partition('=')
+        if unit.strip().lower() != 'bytes' or not range_set:
+            return None
+        ranges = []
+        for range_spec in range_set.split(','):
+            start_str, sep, end_str = range_spec.strip().partition('-')
+            if not sep:
+                return None
+            try:
+                if start_str == '':
+                    # suffix range: last n bytes
+                    suffix = int(end_str)
+                    if suffix <= 0:
+                        continue
+                    start = max(file_size - suffix, 0)
+                    end = file_size - 1
+                else:
+                    start = int(start_str)
+                    if end_str:
+                        end = int(end_str)
+                        if end < start:
+                            return None
+                        end = min(end, file_size - 1)
+                    else:
+                        end = file_size - 1
+            except ValueError:
+                return None
+            if start < file_size:
+                ranges.append((start, end))
+        # coalesce overlapping and adjacent ranges
+        ranges.sort()
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    async def handle(self, request):
+        """
+        Handle a GET or HEAD request for a file
+        :param request: web request, with filename in match_info
+        :type request: web.Request
+        :return: web response
+        :rtype: web.StreamResponse
+        """
+        file_path = self.resolve(request.match_info['filename'])
+        if file_path is None:
+            raise web.HTTPNotFound()
+        return await self.serve(request, file_path)
+
+    async def serve(self, request, file_path):
+        """
+        Respond to a GET or HEAD request with a file that was already chosen, ex: by client config
+        :param request: web request
+        :type request: web.Request
+        :param file_path: resolved path to a file within root
+        :type file_path: pathlib.Path
+        :return: web response
+        :rtype: web.StreamResponse
+        """
+        stat = file_path.stat()
+        checksum = self.checksum_index.get(file_path, stat)
+        if checksum is not None:
+            etag = '"%s"' % checksum
+        else:
+            etag = 'W/"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': last_modified,
+            'Accept-Ranges': 'bytes',
+        }
+        # conditional requests
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            not_modified = self.etag_matches(if_none_match, etag, weak_ok=True)
+        else:
+            if_modified_since = self.parse_http_date(request.headers.get('If-Modified-Since'))
+            not_modified = if_modified_since is not None and int(stat.st_mtime) <= if_modified_since
+        if not_modified:
+            self.count_download(file_path, 'not_modified', 0)
+            return web.Response(status=304, headers=headers)
+        # range requests
+        ranges = None
+        range_header = request.headers.get('Range')
+        if range_header is not None:
+            if_range = request.headers.get('If-Range')
+            if if_range is not None:
+                if_range = if_range.strip()
+                if if_range.startswith('"') or if_range.startswith('W/'):
+                    range_ok = self.etag_matches(if_range, etag, weak_ok=False)
+                else:
+                    range_ok = self.parse_http_date(if_range) == int(stat.st_mtime)
+            else:
+                range_ok = True
+            if range_ok:
+                ranges = self.parse_ranges(range_header, stat.st_size)
+        if ranges is not None and len(ranges) == 0:
+            headers['Content-Range'] = 'bytes */%s' % stat.st_size
+            return web.Response(status=416, headers=headers)
+        if ranges is not None and len(ranges) > self.max_ranges:
+            ranges = None
+        if ranges is not None and len(ranges) > 1:
+            return await self.send_multiple_ranges(request, file_path, stat, ranges, headers)
+        # full or single range, let FileResponse do it with sendfile, but only after we have handled the conditions ourselves
+        forwarded_headers = CIMultiDict((key, value) for key, value in request.headers.items() if key.lower() not in ['range', 'if-range', 'if-modified-since', 'if-unmodified-since', 'if-none-match'])
+        has_body = request.method != 'HEAD'
+        if ranges is not None:
+            start, end = ranges[0]
+            forwarded_headers['Range'] = 'bytes=%s-%s' % (start, end)
+            self.count_download(file_path, 'partial', end - start + 1 if has_body else 0)
+        else:
+            self.count_download(file_path, 'full', stat.st_size if has_body else 0)
+        return NSFileResponse(file_path, request.clone(headers=forwarded_headers), headers=headers)
+
+    async def send_multiple_ranges(self, request, file_path, stat, ranges, headers):
+        # multipart/byteranges can not use sendfile, so parts are read in the default executor to keep the loop free
+        boundary = 'NetbootStudio%s' % os.urandom(8).hex()
+        content_type = mimetypes.guess_type(str(file_path))[0] or 'application/octet-stream'
+        part_headers = []
+        content_length = 0
+        for start, end in ranges:
+            part_header = ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %s-%s/%s\r\n\r\n' % (boundary, content_type, start, end, stat.st_size)).encode('utf-8')
+            part_headers.append(part_header)
+            content_length += len(part_header) + end - start + 1
+        closing = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        content_length += len(closing)
+        response = web.StreamResponse(status=206, headers=headers)
+        response.content_type = 'multipart/byteranges; boundary=%s' % boundary
+        response.content_length = content_length
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+        self.count_download(file_path, 'partial', sum(end - start + 1 for start, end in ranges))
+        with open(file_path, 'rb') as range_f:
+            for (start, end), part_header in zip(ranges, part_headers):
+                await response.write(part_header)
+                position = start
+                while position <= end:
+                    chunk = await self.loop.run_in_executor(None, self.read_chunk, range_f, position, min(self.multipart_chunk_size, end - position + 1))
+                    if not chunk:
+                        break
+                    await response.write(chunk)
+                    position += len(chunk)
+        await response.write(closing)
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    def read_chunk(file_obj, position, size):
+        file_obj.seek(position)
+        return file_obj.read(size)
+
@@ -83,6 +83,7 @@ class NSTaskManager:
         self.queue_tasks = NSSafeQueue(loop=self.loop, maxsize=self.queue_maxsize)
         self.task_status = []  # store task status here, and let the datasource publish it. we need it as an array so we can use an NSDataSourceTable on the js side
         self.task_index = {}  # track task objects by task_id, until they are cleared
+        self.change_listeners = []  # called whenever task_status changed, see add_change_listener
         self.start_task_workers()
         self.start_staging_workers()
 
@@ -170,6 +171,18 @@ class NSTaskManager:
         if not found_existing:
             new_task_status.insert(0, task_status)
         self.task_status = new_task_status
+        self.notify_change_listeners()
+
+    def add_change_listener(self, callback):
+        # callback() is called whenever task_status changed, from whichever thread changed it
+        self.change_listeners.append(callback)
+
+    def notify_change_listeners(self):
+        for callback in self.change_listeners:
+            try:
+                callback()
+            except Exception as ex:
+                logging.exception('exception in task manager change listener: %s' % ex)
 
     def execute_task(self, task_object):
         # run task, reporting running status, and then complete status
@@ -207,6 +220,7 @@ class NSTaskManager:
                     if existing_task['task_id'] == task_id:
                         self.task_status.pop(index)
                         break
+                self.notify_change_listeners()
             elif action == 'stop':
                 logging.info(f'Stopping task: {task_id}')
                 self.task_index[task_id].stop()
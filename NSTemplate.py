@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Library: Templates
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# unattended configs can use client variables, like this:  d-i netcfg/get_hostname string {{ hostname }}
+#   a template is compiled once into a %-format string, so rendering is a single string formatting operation
+#   placeholders for unknown variables are left exactly as they were, so files that were never meant as templates are served unchanged
+#   a literal {{ can not be escaped, but it only matters if it is followed by a known variable name and }}
+
+import re
+
+TEMPLATE_PLACEHOLDER = re.compile(r'{{\s*([A-Za-z_][A-Za-z0-9_.-]*)\s*}}')
+
+
+class NSTemplate:
+    """
+    A compiled template
+    """
+    __slots__ = ('format_string', 'variable_names', 'placeholders')
+
+    def __init__(self, source):
+        """
+        Compile a template
+        :param source: template text
+        :type source: str
+        """
+        parts = []
+        self.placeholders = {}  # variable name -> placeholder as written, for rendering unknown variables
+        position = 0
+        for match in TEMPLATE_PLACEHOLDER.finditer(source):
+            parts.append(source[position:match.start()].replace('%', '%%'))
+            parts.append('%%(%s)s' % match.group(1))
+            self.placeholders.setdefault(match.group(1), match.group(0))
+            position = match.end()
+        parts.append(source[position:].replace('%', '%%'))
+        self.variable_names = frozenset(self.placeholders)
+        if self.variable_names:
+            self.format_string = ''.join(parts)
+        else:
+            # not really a template, render returns it as-is
+            self.format_string = source
+
+    def render(self, variables):
+        """
+        Render this template
+        :param variables: values for variables
+        :type variables: dict
+        :return: rendered text
+        :rtype: str
+        """
+        if not self.variable_names:
+            return self.format_string
+        if not self.variable_names <= variables.keys():
+            variables = dict(self.placeholders, **variables)
+        return self.format_string % variables
+
+    def select(self, variables):
+        # only the variables this template uses, so that cached output is only invalidated when one of those changes
+        return tuple((name, variables.get(name)) for name in sorted(self.variable_names))
+
+
+def load_template(file_path):
+    # a loader for NSFileCache
+    with open(file_path, 'r') as template_f:
+        return NSTemplate(template_f.read())
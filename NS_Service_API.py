@@ -21,7 +21,8 @@ from collections import OrderedDict
 
 from NSPubSub import NSMQTTClient
 from NSTaskManager import NSTaskManager
-from NSCommon import NSSafeQueue, get_version, NSMessage
+from NSCommon import NSSafeQueue, get_version
+from NSAPISessions import NSAPISessions
 from NSMessageProcessor import NSMessageProcessor
 from NSClientManager import NSClientManager
 from NSLogger import get_logger
@@ -51,15 +52,29 @@ class NSAPIService(NSService):
             'tasks': self.ds_tasks,
             'architectures': self.ds_architectures,
         }
+        # these tell their DataSource when they change, so it only needs a slow heartbeat instead of polling
+        self.data_source_cycles = {
+            'clients': 60,
+            'tasks': 60,
+            'architectures': None,  # never changes
+        }
+        # entries of these lists are identified by this key, so changes are published as deltas
+        self.data_source_keys = {
+            'clients': 'mac',
+            'tasks': 'task_id',
+            'architectures': 'name',
+        }
         self.data_source_objects = dict()
         self.q_staging = NSSafeQueue(loop=self.loop, maxsize=self.queue_maxsize)
         self.client_manager = NSClientManager(self.config, self.paths, 'NSAPIService', self.loop)
         self.mqtt_client = NSMQTTClient(self.mqtt_client_name, self.config, self.paths, self.mqtt_topics, self.mqtt_receive, self.loop)
         self.file_manager = NSFileManager(self.config, self.paths, self.loop)
         self.task_manager = NSTaskManager(self.config, self.paths, self.q_staging, self.loop)
-        self.msg_processor = NSMessageProcessor(self.config, self.paths, self.q_staging, self.client_manager, self.file_manager, self.task_manager)
+        self.api_sessions = NSAPISessions(self.loop)
+        self.msg_processor = NSMessageProcessor(self.config, self.paths, self.q_staging, self.client_manager, self.file_manager, self.task_manager, self.api_sessions)
         self.apiserver = NSAPIServer(self.config, self.paths, self.msg_processor, self.client_manager, self.loop)
         self.stopabbles['mqtt_client'] = self.mqtt_client
+        self.stopabbles['api_sessions'] = self.api_sessions
         self.stopabbles['client_manager'] = self.client_manager
         self.setup_data_sources()
         logging.info('API Server is ready')
@@ -73,16 +88,15 @@ class NSAPIService(NSService):
         :param msg: message
         :type msg: str
         """
-        # TODO messageprocessor should take and return NSMessage objects only
+        # TODO messageprocessor should take NSMessage objects only
         # logging.debug('received an mqtt messaage on topic: %s' % topic)
         try:
-            # result is an NSMessage as json
+            # result is an NSMessage, addressed to the reply topic of the session that asked
             origin = 'broker'
             if topic == 'api_request':
                 result = self.msg_processor.handle(msg, origin, topic=topic)
-                result_message = NSMessage(result)
-                topic = result_message.get('topic')
-                self.mqtt_client.publish(topic, result)
+                if result:
+                    self.mqtt_client.publish(result.get('topic'), result.to_json())
         except Exception as ex:
             logging.error('Unexpected Exception while mqtt_receive: %s', ex)
 
@@ -90,12 +104,15 @@ class NSAPIService(NSService):
         logging.info('Setting up data sources')
         try:
             for source_name, source_func in self.data_sources.items():
-                self.data_source_objects[source_name] = NSDataSource(self.config, self.paths, self.loop, source_name, 'provider', source_func)
+                self.data_source_objects[source_name] = NSDataSource(self.config, self.paths, self.loop, source_name, 'provider', source_func,
+                                                                    self.data_source_cycles.get(source_name, 4), self.data_source_keys.get(source_name))
+            self.client_manager.add_change_listener(self.data_source_objects['clients'].notify)
+            self.task_manager.add_change_listener(self.data_source_objects['tasks'].notify)
         except Exception as ex:
             logging.exception('failed to setup_data_sources: %s' % ex)
 
     def ds_clients(self):
-        return self.client_manager.get_clients()
+        return [client.to_dict() for client in self.client_manager.get_clients()]
 
     def ds_tasks(self):
         return self.task_manager.get_tasks()
@@ -221,6 +238,7 @@ class NSAPIServer:
         Setup webserver routes
         """
         self.app.add_routes([web.post('/auth', self.post_auth)])
+        self.app.add_routes([web.get('/clients/export', self.get_clients_export)])
 
     def setup_ssl_context(self):
         """
@@ -270,6 +288,35 @@ class NSAPIServer:
         response_content = '{}'
         return web.Response(text=response_content, status=200)
 
+    async def get_clients_export(self, request):
+        """
+        Handle requests to the '/clients/export' endpoint (GET only), streaming all clients as csv or json
+        :param request: request object
+        :type request:
+        :return: response object
+        :rtype:
+        """
+        # auth_token only as a header: in the url, it would end up in logs and browser history. the web ui downloads with fetch instead of a link
+        auth_token = request.headers.get('auth_token', '')
+        is_valid = await self.validate_auth_token(auth_token)
+        if not is_valid:
+            logging.warning('Refused clients export request from: %s' % request.remote)
+            return web.Response(text='{}', status=403)
+        export_format = request.rel_url.query.get('format', 'csv')
+        if export_format == 'csv':
+            content_type = 'text/csv'
+        elif export_format == 'json':
+            content_type = 'application/json'
+        else:
+            return web.Response(text='unknown format: %s' % export_format, status=400)
+        response = web.StreamResponse(status=200, headers={'Content-Disposition': 'attachment; filename="clients.%s"' % export_format})
+        response.content_type = content_type
+        await response.prepare(request)
+        for chunk in self.client_manager.export_clients(export_format):
+            await response.write(chunk.encode('utf-8'))
+        await response.write_eof()
+        return response
+
     async def generate_auth_token(self):
         """
         Generate an auth token
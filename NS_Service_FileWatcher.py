@@ -6,17 +6,25 @@ Netboot Studio Service: API Server
 #    This file is part of Netboot Studio, a system for managing netboot clients
 #    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
 
+import os
 import sys
-import json
-import yaml
+import asyncio
+import fnmatch
 import pathlib
 import logging
 import argparse
 
+from functools import partial
+from threading import Lock
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
 from NSLogger import get_logger
 from NSService import NSService
 from NSDataSource import NSDataSource
-from NSCommon import get_file_modified, validate_boot_image_metadata, sort_by_key
+from NSCommon import get_file_modified, sort_by_key
+from NSBootImageCatalog import NSBootImageCatalog
+from NSFileCache import get_build_metadata
 
 
 class NSFileWatcherService(NSService):
@@ -35,13 +43,34 @@ class NSFileWatcherService(NSService):
         super().__init__(args)
         logging.info('Netboot Studio File Watcher Server v%s', self.version)
         self.file_watcher = NSFileWatcher(self.config, self.paths, self.loop)
+        self.stopabbles['file_watcher'] = self.file_watcher
         logging.info('FileWatcher Server is ready')
         self.start()
 
 
 class NSFileWatcher(object):
-    # TODO use filesystem hooks to register changes
-    scan_cycle = 1  # seconds, how often our data sources should update
+    # each list is kept up to date from filesystem events (watchdog), looking again only at the files or folders an event was seen for
+    #   a full rescan every reconcile_cycle is the safety net for missed events, so when nothing changes we do (almost) nothing
+    #   if filesystem events are not available, we fall back to rescanning every poll_cycle
+    reconcile_cycle = 300  # seconds, how often to rescan everything
+    poll_cycle = 1  # seconds, how often to rescan everything without filesystem events
+    settle_time = 0.25  # seconds, wait after the first event of a burst before looking at what changed
+    # lists of plain files: list_name -> lowercase patterns
+    watched_files = {
+        'stage1_files': ['*.ipxe'],
+        'uboot_scripts': ['*.scr'],
+        'unattended_configs': ['*.cfg', '*.xml'],
+        'iso': ['*.iso'],
+        # TODO this lists everything, but our system isnt really setup for file path navigation
+        'tftp_root': ['*'],
+        'stage4': ['*.sh', '*.bat'],
+    }
+    ignored_files = {
+        'tftp_root': ['.metadata', '.resources'],  # hidden folders used by uploader
+        'stage4': ['stage4-entry-unix.sh', 'stage4-entry-windows.bat', 'none'],  # real files matching the builtin entrypoints
+    }
+    # lists of build folders, each with a metadata.json
+    watched_builds = ['ipxe_builds', 'wimboot_builds']
     builtin_files = {
         'stage1_files': [
             {
@@ -114,187 +143,250 @@ class NSFileWatcher(object):
     data_sources = {}
 
     def __init__(self, config, paths, loop):
+        """
+        File Watcher
+        :param config: config object
+        :type config: RawConfigParser
+        :param paths: paths object
+        :type paths: dict
+        :param loop: asyncio loop
+        :type loop: AbstractEventLoop
+        """
         self.config = config
         self.paths = paths
         self.loop = loop
-        self.list_names = {
-            'ipxe_builds': self.get_ipxe_builds,
-            'wimboot_builds': self.get_wimboot_builds,
-            'stage1_files': self.get_stage1_files,
-            'uboot_scripts': self.get_uboot_scripts,
-            'boot_images': self.get_boot_images,
-            'unattended_configs': self.get_unattended_configs,
-            'iso': self.get_iso,
-            'tftp_root': self.get_tftp_root,
-            'stage4': self.get_stage4,
-        }
+        self.boot_image_catalog = NSBootImageCatalog(self.paths)
+        self.boot_images_version = None
+        self.boot_images = []
+        self.list_names = list(self.watched_files) + self.watched_builds + ['boot_images']
+        self.folders = {list_name: pathlib.Path(self.paths[list_name]) for list_name in self.list_names}
+        self.entries = {list_name: {} for list_name in self.list_names}  # list_name -> entry name -> entry, boot_images live in the catalog
+        self.sorted_lists = {}  # list_name -> sorted list including builtins, dropped when entries change
+        self.pending = {}  # list_name -> set of entry names an event was seen for, shared with the watchdog thread
+        self.pending_lock = Lock()
+        self.events = 0
         logging.info('Starting FileWatcher')
-        for list_name, get_function in self.list_names.items():
-            self.data_sources[list_name] = NSDataSource(self.config, self.paths, self.loop, list_name, 'provider', get_function, self.scan_cycle)
+        for list_name in self.list_names:
+            self.scan_list(list_name)
+        self.observer = self.start_observer()
+        if self.observer is None:
+            logging.warning('Filesystem events are not available, FileWatcher will rescan every %s seconds instead' % self.poll_cycle)
+            self.reconcile_cycle = self.poll_cycle
+        for list_name in self.list_names:
+            self.data_sources[list_name] = NSDataSource(self.config, self.paths, self.loop, list_name, 'provider', partial(self.get_list, list_name), self.reconcile_cycle, self.get_key_field(list_name))
+        self.reconcile_task = self.loop.create_task(self.reconciler())
         logging.debug('FileWatcher is ready')
 
-    def get_stage1_files(self):
-        stage1_folder = pathlib.Path(self.paths['stage1_files'])
-        stage1_files = []
-        # add builtins
-        stage1_files += self.builtin_files['stage1_files']
-        # find files in folder
-        for this_file in stage1_folder.glob('*.[iI][pP][xX][eE]'):
-            this_modified = get_file_modified(this_file)
-            this_res = {'filename': str(this_file.name), 'modified': this_modified, 'description': ''}
-            stage1_files.append(this_res)
-        return sort_by_key(stage1_files, 'filename')
+    def start_observer(self):
+        """
+        Start watching all our folders for changes
+        :return: observer, or None if it could not be started
+        :rtype: Observer
+        """
+        observer = Observer()
+        try:
+            for list_name in self.list_names:
+                recursive = list_name not in self.watched_files  # boot images and builds are folders, we need to know about their metadata files
+                observer.schedule(NSFileEventHandler(self, list_name), str(self.folders[list_name]), recursive=recursive)
+            observer.start()
+        except Exception as ex:
+            logging.error('unable to watch for filesystem events: %s' % ex)
+            return None
+        return observer
+
+    def stop(self):
+        logging.info('Shutting down FileWatcher')
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        self.reconcile_task.cancel()
+        for data_source in self.data_sources.values():
+            data_source.stop()
 
-    def get_iso(self):
-        iso_folder = pathlib.Path(self.paths['iso'])
-        iso = []
-        # find files in folder
-        for this_file in iso_folder.glob('*.[iI][sS][oO]'):
-            this_modified = get_file_modified(this_file)
-            this_res = {'filename': str(this_file.name), 'modified': this_modified, 'description': ''}
-            iso.append(this_res)
-        return sort_by_key(iso, 'filename')
+    def path_changed(self, list_name, path):
+        """
+        Note that something changed at a path. Called from the watchdog thread
+        :param list_name: which list the path belongs to
+        :type list_name: str
+        :param path: path that was created, deleted, modified, or moved from or to
+        :type path: str
+        """
+        try:
+            relative = pathlib.PurePath(path).relative_to(self.folders[list_name])
+        except ValueError:
+            return
+        if not relative.parts:
+            return  # the folder itself, reconciliation will deal with it
+        with self.pending_lock:
+            first = not self.pending
+            self.pending.setdefault(list_name, set()).add(relative.parts[0])
+            self.events += 1
+        if first:
+            # a burst of events (ex: a file being copied) is handled once, after it settles
+            self.loop.call_soon_threadsafe(self.loop.call_later, self.settle_time, self.apply_pending)
 
-    def get_tftp_root(self):
-        tftp_folder = pathlib.Path(self.paths['tftp_root'])
-        tftp_root = []
-        # add builtins
-        tftp_root += self.builtin_files['tftp_root']
-        # find files in folder
-        # TODO this lists everything, but our system isnt really setup for file path navigation
-        for this_file in tftp_folder.glob('*'):
-            if str(this_file.name) == '.metadata' or str(this_file.name) == '.resources':
-                continue  # ignore hidden folders used by uploader
-            this_modified = get_file_modified(this_file)
-            this_res = {'filename': str(this_file.name), 'modified': this_modified, 'description': ''}
-            tftp_root.append(this_res)
-        return sort_by_key(tftp_root, 'filename')
+    def apply_pending(self):
+        # update only the entries an event was seen for, and publish the lists that actually changed
+        with self.pending_lock:
+            pending = self.pending
+            self.pending = {}
+        for list_name, entry_names in pending.items():
+            if self.update_entries(list_name, entry_names):
+                self.data_sources[list_name].notify()
 
-    def get_uboot_scripts(self):
-        uboot_scripts_folder = pathlib.Path(self.paths['uboot_scripts'])
-        uboot_scripts = []
-        # add builtins
-        uboot_scripts += self.builtin_files['uboot_scripts']
-        # find files in folder
-        for this_file in uboot_scripts_folder.glob('*.[sS][cC][rR]'):
-            this_modified = get_file_modified(this_file)
-            this_res = {'filename': str(this_file.name), 'modified': this_modified, 'description': ''}
-            uboot_scripts.append(this_res)
-        return sort_by_key(uboot_scripts, 'filename')
+    async def reconciler(self):
+        # safety net: a full rescan once in a while, in case an event was missed (ex: network filesystems do not report changes)
+        while True:
+            await asyncio.sleep(self.reconcile_cycle)
+            for list_name in self.list_names:
+                if self.scan_list(list_name):
+                    logging.debug('reconciliation found changes in: %s' % list_name)
+                    await self.data_sources[list_name].update()
 
-    def get_unattended_configs(self):
-        uc_folder = pathlib.Path(self.paths['unattended_configs'])
-        unattended_configs = []
-        unattended_configs += self.builtin_files['unattended_configs']
-        for this_file in uc_folder.glob('*.[cC][fF][gG]'):
-            this_modified = get_file_modified(this_file)
-            this_res = {'filename': str(this_file.name), 'modified': this_modified, 'description': ''}
-            unattended_configs.append(this_res)
-        for this_file in uc_folder.glob('*.[xX][mM][lL]'):
-            this_modified = get_file_modified(this_file)
-            this_res = {'filename': str(this_file.name), 'modified': this_modified, 'description': ''}
-            unattended_configs.append(this_res)
-        return sort_by_key(unattended_configs, 'filename')
+    def scan_list(self, list_name):
+        """
+        Rescan everything in a list
+        :param list_name: name of list
+        :type list_name: str
+        :return: True if the list changed
+        :rtype: bool
+        """
+        if list_name == 'boot_images':
+            return self.boot_image_catalog.refresh()
+        entry_names = set(self.entries[list_name])
+        folder = self.folders[list_name]
+        if folder.is_dir():
+            entry_names.update(str(this_file.name) for this_file in folder.iterdir())
+        return self.update_entries(list_name, entry_names)
 
-    def get_stage4(self):
-        stage4_folder = pathlib.Path(self.paths['stage4'])
-        stage4 = []
-        stage4_builtins = ['stage4-entry-unix.sh', 'stage4-entry-windows.bat', 'none']
-        stage4 += self.builtin_files['stage4']
-        for this_file in stage4_folder.glob('*.[sS][hH]'):
-            this_modified = get_file_modified(this_file)
-            if str(this_file.name) in stage4_builtins:
-                logging.warning('a real file matching one of the builtin stage4 entrypoints exists! It will be ignored. file: %s' % this_file.name)
-                continue  # skip anything that matches the builtins
-            this_res = {'filename': str(this_file.name), 'modified': this_modified, 'description': ''}
-            stage4.append(this_res)
-        for this_file in stage4_folder.glob('*.[bB][aA][tT]'):
-            this_modified = get_file_modified(this_file)
-            if str(this_file.name) in stage4_builtins:
-                logging.warning('a real file matching one of the builtin stage4 entrypoints exists! %s' % this_file.name)
-                continue  # skip anything that matches the builtins
-            this_res = {'filename': str(this_file.name), 'modified': this_modified, 'description': ''}
-            stage4.append(this_res)
-        return sort_by_key(stage4, 'filename')
+    def update_entries(self, list_name, entry_names):
+        """
+        Look at the given entries of a list again
+        :param list_name: name of list
+        :type list_name: str
+        :param entry_names: names of files or folders directly inside the folder of the list
+        :type entry_names: Iterable[str]
+        :return: True if the list changed
+        :rtype: bool
+        """
+        if list_name == 'boot_images':
+            return self.boot_image_catalog.refresh_entries(entry_names)
+        entries = self.entries[list_name]
+        changed = False
+        for entry_name in entry_names:
+            this_path = self.folders[list_name].joinpath(entry_name)
+            try:
+                if list_name in self.watched_files:
+                    entry = self.get_file_entry(list_name, this_path)
+                else:
+                    entry = self.get_build_entry(this_path)
+            except (FileNotFoundError, NotADirectoryError):
+                entry = None  # deleted while we were looking at it
+            if entry is None:
+                if entries.pop(entry_name, None) is not None:
+                    changed = True
+            elif entries.get(entry_name) != entry:
+                entries[entry_name] = entry
+                changed = True
+        if changed:
+            self.sorted_lists.pop(list_name, None)
+        return changed
+
+    def get_file_entry(self, list_name, this_file):
+        """
+        Get the entry for a file in one of the watched_files lists
+        :param list_name: name of list
+        :type list_name: str
+        :param this_file: path to file
+        :type this_file: pathlib.Path
+        :return: entry, or None if the file does not exist or does not belong in the list
+        :rtype: dict
+        """
+        file_name = str(this_file.name)
+        if not this_file.exists():
+            return None
+        if not any(fnmatch.fnmatchcase(file_name.lower(), pattern) for pattern in self.watched_files[list_name]):
+            return None
+        if file_name in self.ignored_files.get(list_name, []):
+            if list_name == 'stage4':
+                logging.warning('a real file matching one of the builtin stage4 entrypoints exists! It will be ignored. file: %s' % file_name)
+            return None
+        return {'filename': file_name, 'modified': get_file_modified(this_file), 'description': ''}
+
+    @staticmethod
+    def get_build_entry(build):
+        """
+        Get the metadata of a build in ipxe_builds or wimboot_builds
+        :param build: path to build folder
+        :type build: pathlib.Path
+        :return: metadata, or None if this is not a build
+        :rtype: dict
+        """
+        # parsed only when metadata.json changed, and shared with everything else in this process
+        return get_build_metadata(build)
+
+    def get_key_field(self, list_name):
+        # what identifies an entry of a list, so the DataSource can publish changes as deltas
+        if list_name == 'boot_images':
+            return 'boot_image_name'
+        if list_name in self.watched_builds:
+            return 'build_id'
+        return 'filename'
+
+    def get_list(self, list_name):
+        """
+        Get the current value of a list, this is what the DataSource publishes
+        :param list_name: name of list
+        :type list_name: str
+        :return: list of entries, sorted
+        :rtype: List[dict]
+        """
+        if list_name == 'boot_images':
+            return self.get_boot_images()
+        sorted_list = self.sorted_lists.get(list_name)
+        if sorted_list is None:
+            if list_name in self.watched_builds:
+                sorted_list = sort_by_key(list(self.entries[list_name].values()), 'build_name')
+            else:
+                sorted_list = sort_by_key(self.builtin_files.get(list_name, []) + list(self.entries[list_name].values()), 'filename')
+            self.sorted_lists[list_name] = sorted_list
+        return sorted_list
 
     def get_boot_images(self):
-        # parse metadata from all the available boot images
-        boot_images = []
-        # builtins first
-        boot_images += self.builtin_files['boot_images']
-        # a-la-carte images
-        for this_file in pathlib.Path(self.paths['boot_images']).glob('*.[iI][pP][xX][eE]'):
-            # TODO it makes more sense for files to have modified rather than created,
-            #  but we cannot rename the key because the schema needs to match on both file and folder
-            this_modified = get_file_modified(this_file)
-            metadata = {
-                'created': this_modified,
-                'image_type': 'a-la-carte',
-                'description': '%s, a file found in boot_images/' % this_file.name,
-                'release': 'none',
-                'arch': 'none',
-                'boot_image_name': this_file.name,
-                'stage2_filename': this_file.name,
-                'supports_unattended': 'false',
-                'stage2_unattended_filename': 'none',
-            }
-            if validate_boot_image_metadata(metadata):
-                boot_images.append(metadata)
-        # boot image folders
-        for boot_image in pathlib.Path(self.paths['boot_images']).iterdir():
-            if boot_image.is_dir():
-                image_name = str(boot_image.name)
-                metafile = boot_image.joinpath('metadata.yaml')
-                if metafile.is_file():
-                    try:
-                        with open(metafile, 'r') as mf:
-                            metadata = yaml.full_load(mf)
-                    except KeyError:
-                        logging.error('unable to parse build metadata file: %s' % metafile)
-                        continue
-                    metadata['boot_image_name'] = image_name
-                    if validate_boot_image_metadata(metadata):
-                        boot_images.append(metadata)
-        return sort_by_key(boot_images, 'boot_image_name')
+        # the catalog only parses metadata that changed, and writes the index used by the other services
+        if self.boot_image_catalog.version != self.boot_images_version:
+            self.boot_images = sort_by_key(self.builtin_files['boot_images'] + self.boot_image_catalog.get_boot_images(), 'boot_image_name')
+            self.boot_images_version = self.boot_image_catalog.version
+        return self.boot_images
 
-    def get_ipxe_builds(self):
-        # parse metadata from all the available builds in ipxe_builds
-        ipxe_builds = []
-        for build in pathlib.Path(self.paths['ipxe_builds']).iterdir():
-            if build.is_dir():
-                metafile = build.joinpath('metadata.json')
-                if metafile.is_file():
-                    try:
-                        with open(metafile, 'r') as mf:
-                            metadata = json.load(mf)
-                        build_id = metadata['build_id']
-                        if build_id == '':
-                            logging.error('woah, the build_id is empty')
-                    except KeyError:
-                        logging.error('unable to parse build metadata file: %s' % metafile)
-                        continue
-                    ipxe_builds.append(metadata)
-        return sort_by_key(ipxe_builds, 'build_name')
 
-    def get_wimboot_builds(self):
-        # parse metadata from all the available builds in wimboot_builds
-        wimboot_builds = []
-        for build in pathlib.Path(self.paths['wimboot_builds']).iterdir():
-            if build.is_dir():
-                metafile = build.joinpath('metadata.json')
-                if metafile.is_file():
-                    try:
-                        with open(metafile, 'r') as mf:
-                            metadata = json.load(mf)
-                        build_id = metadata['build_id']
-                        if build_id == '':
-                            logging.error('woah, the build_id is empty')
-                    except KeyError:
-                        logging.error('unable to parse build metadata file: %s' % metafile)
-                        continue
-                    wimboot_builds.append(metadata)
-        return sort_by_key(wimboot_builds, 'build_name')
+class NSFileEventHandler(FileSystemEventHandler):
+    """
+    Passes filesystem events for one list on to the FileWatcher. Runs in the watchdog thread
+    """
+    # inotify also reports files being read, which does not change anything
+    ignored_events = ['opened', 'closed_no_write']
+
+    def __init__(self, file_watcher, list_name):
+        """
+        File Event Handler
+        :param file_watcher: file watcher
+        :type file_watcher: NSFileWatcher
+        :param list_name: name of list
+        :type list_name: str
+        """
+        super().__init__()
+        self.file_watcher = file_watcher
+        self.list_name = list_name
 
+    def on_any_event(self, event):
+        if event.event_type in self.ignored_events:
+            return
+        self.file_watcher.path_changed(self.list_name, os.fsdecode(event.src_path))
+        dest_path = getattr(event, 'dest_path', '')
+        if dest_path:
+            # a move is a delete at src_path and a create at dest_path
+            self.file_watcher.path_changed(self.list_name, os.fsdecode(dest_path))
 
 if __name__ == "__main__":
     # this is the main entry point
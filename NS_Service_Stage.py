@@ -9,21 +9,29 @@ Netboot Studio Service: Stage Server (provides files to clients, based on config
 
 import sys
 import json
-import yaml
 import logging
 import argparse
 import pathlib
 import socket
+import urllib.parse
 import ssl
 import scapy.all
 
 from aiohttp import web
 from textwrap import dedent
 
-from NSClientManager import NSClientManager
+from NSClientManager import NSClientManagerFollower
+from NSClientStateQueue import NSClientStateQueue
+from NSAdmissionQueue import NSAdmissionQueue
 from NSLogger import get_logger
 from NSService import NSService
-from NSCommon import validate_boot_image_metadata
+from NSFileCache import NSFileCache, read_text_file, build_metadata_cache, boot_image_metadata_cache
+from NSTemplate import load_template
+from NSBootImageCatalog import NSBootImageCatalog
+from NSStaticFiles import NSStaticFiles, NSChecksumIndex
+from NSMetrics import NSMetrics
+from NSBootPlan import NSBootPlanner, render_stage2_variables
+from NSDataSource import NSDataSource
 
 
 class NSStageService(NSService):
@@ -39,9 +47,17 @@ class NSStageService(NSService):
         """
         super().__init__(args)
         logging.info('Netboot Studio Stage Server v%s', self.version)
-        self.client_manager = NSClientManager(self.config, self.paths, 'NSStageService', self.loop)
+        # we only need to read clients on the boot path, so follow the API service's client manager instead of using the database
+        self.client_manager = NSClientManagerFollower(self.config, self.paths, 'NSStageService', self.loop)
         self.stageserver = NSStageServer(self.config, self.paths, self.client_manager, self.loop)
+        # stopped before the client manager, so that queued state transitions are written first
+        self.stopabbles['client_state_queue'] = self.stageserver.client_state_queue
         self.stopabbles['client_manager'] = self.client_manager
+        self.stopabbles['boot_planner'] = self.stageserver.boot_planner
+        self.stopabbles['checksum_index'] = self.stageserver.checksum_index
+        # request latency, errors and sub-phase timings, for the web ui. the full metrics are at /metrics on the stage server
+        self.metrics_data_source = NSDataSource(self.config, self.paths, self.loop, 'stage_metrics', 'provider', self.stageserver.metrics.get_summary, 10, 'name')
+        self.stopabbles['metrics_data_source'] = self.metrics_data_source
         logging.info('Stage Server is ready')
         self.start()
 
@@ -177,12 +193,42 @@ class NSStageServer:
     set stage-2-url ${stage-server}/stage2.ipxe?mac=${mac}&buildarch=${arch}&platform=${platform}&manufacturer=${manufacturer}&chip=${chip}&ip=${ip}&uuid=${uuid}&serial=${serial}&product=${product}&version=${version}&unixtime=${unixtime}&asset=${asset}
     imgexec ${stage-2-url} || goto failed
     '''
-    # TODO dynamically generate menu from available boot_images
-    stage2_menu = '''
+    # the menu lists boot images compatible with the client arch, choosing one fetches stage2 again with boot_image set to the choice
+    #   items are labeled by index, because boot image names can contain characters that are not valid in an ipxe label
+    stage2_menu_header = '''
     # this is the menu generated by Netboot Studio
     :stage2-content
-    echo menu doesnt exist yet
-    goto failed
+    console
+    menu Netboot Studio: choose a boot image
+    item --gap -- ------ ip: ${ip} MAC: ${mac} arch: ${arch} -------
+    item --gap --
+    '''
+    stage2_menu_footer = '''
+    item --gap --
+    item menu-refresh Refresh this menu
+    item fallback-menu Troubleshooting menu
+    choose target && goto ${target} || goto fallback-menu
+
+    :menu-refresh
+    imgexec ${stage-2-url} || goto failed
+    goto fallback-menu
+    '''
+    # served instead of a boot image when too many clients are installing, variables: position, waiting, boot image, seconds, milliseconds, url suffix
+    stage2_admission_wait = '''
+    # this is the admission wait loop generated by Netboot Studio
+    :stage2-content
+    console
+    echo Netboot Studio
+    echo Too many clients are booting right now, this client is number %s of %s waiting
+    echo Waiting to boot: %s
+    echo will ask again in %s seconds
+    prompt --key 0x02 --timeout %s Press Ctrl-B for the troubleshooting menu... && goto fallback-menu ||
+    imgexec ${stage-2-url}%s || goto failed
+    '''
+    stage2_menu_choice = '''
+    :menu-choice-%s
+    imgexec ${stage-2-url}&boot_image=%s || goto failed
+    goto fallback-menu
     '''
 
     def __init__(self, config, paths, client_mgr, loop):
@@ -201,13 +247,49 @@ class NSStageServer:
         self.paths = paths
         self.client_manager = client_mgr
         self.loop = loop
+        # state transitions are written in the background, so handlers can respond as soon as their content is ready
+        self.client_state_queue = NSClientStateQueue(self.client_manager, self.loop)
+        # limits on how many clients may be installing at once, missing from older config files
+        self.admission_queue = NSAdmissionQueue(max_active=self.config.getint('stageserver', 'max_active_installs', fallback=0),
+                                                max_active_per_image=self.config.getint('stageserver', 'max_active_installs_per_image', fallback=0),
+                                                retry_seconds=self.config.getint('stageserver', 'admission_retry_seconds', fallback=30),
+                                                lease_seconds=self.config.getint('stageserver', 'admission_lease_seconds', fallback=900))
+        self.client_manager.add_change_listener(self.on_clients_changed)
         self.host = '0.0.0.0'
         self.port = int(config.get('stageserver', 'port'))
         # TODO remember this is http right now
         self.stage_server_url = 'http://%s:%s' % (self.config.get('main', 'netboot_server_hostname'), self.config.get('stageserver', 'port'))
+        # stage2 is requested by every client on every standby loop iteration, so everything except the per-client variables is cached
+        #   body here means stage2 content followed by the epilogue, ready to be appended after the variables
+        self.boot_image_catalog = NSBootImageCatalog(self.paths)
+        # what to serve each client is worked out once per change of its config, settings, or the files it uses
+        self.boot_planner = NSBootPlanner(self.config, self.paths, self.client_manager, self.boot_image_catalog, self.loop)
+        self.stage2_body_cache = NSFileCache('stage2 body', self.load_stage2_body)
+        # unattended configs and stage4 scripts are small and requested often, keep them in memory too
+        #   the stage4 entry scripts are part of the program, so they are loaded right away
+        self.text_file_cache = NSFileCache('stage text file', read_text_file, max_file_size=1048576)
+        for entry_script in ['stage4-entry-unix', 'stage4-entry-windows']:
+            self.text_file_cache.get(self.paths[entry_script])
+        # unattended configs are templates, compiled once per change, and rendered output is kept per client until its inputs change
+        self.unattended_template_cache = NSFileCache('unattended template', load_template, max_file_size=1048576)
+        self.unattended_rendered = {}  # client mac -> (template, selected variables, rendered content)
+        self.stage2_standby_loop_body = self.stage2_standby_loop + self.stage2_epilogue
+        self.stage2_menu_bodies = {}  # client arch -> (catalog version, menu body)
+        # large files are served with range and conditional request support, and the checksums for their ETags are computed in the background
+        self.checksum_index = NSChecksumIndex(self.paths['checksum_index'])
+        self.static_files = {
+            'packages': NSStaticFiles('packages', self.paths['packages'], self.checksum_index, self.loop),
+            'boot_images': NSStaticFiles('boot_images', self.paths['boot_images'], self.checksum_index, self.loop),
+            'iso': NSStaticFiles('iso', self.paths['iso'], self.checksum_index, self.loop),
+            # not routed directly, ipxe binaries are chosen by client config in get_ipxe_binary
+            'ipxe_builds': NSStaticFiles('ipxe_builds', self.paths['ipxe_builds'], self.checksum_index, self.loop),
+        }
+        self.checksum_index.scan([self.paths[static_name] for static_name in self.static_files])
+        # per-route request metrics are recorded by middleware, and handlers time their sub-phases: db, arp, dns, and file
+        self.metrics = NSMetrics('stage')
         try:
             logging.info('Starting HTTP Stage Server on port %s' % self.port)
-            self.app = web.Application()
+            self.app = web.Application(middlewares=[self.metrics.middleware])
             self.setup_routes()
             self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
             self.ssl_context.load_cert_chain(self.paths['ssl_cert'], self.paths['ssl_key'])
@@ -231,19 +313,19 @@ class NSStageServer:
         """
         Format log messages with info about client
         :param client_data: client data
-        :type client_data: dict
+        :type client_data: NSClientRecord
         :param message: message
         :type message: str
         :return: formatted message
         :rtype: str
         """
-        return 'Client: %s (ip: %s, arch: %s) -> %s' % (client_data['mac'], client_data['ip'], client_data['arch'], message)
+        return 'Client: %s (ip: %s, arch: %s) -> %s' % (client_data.mac, client_data.ip, client_data.arch, message)
 
     def log_info(self, client_data, message):
         """
         Format info-level messages
         :param client_data: client data
-        :type client_data: dict
+        :type client_data: NSClientRecord
         :param message: message
         :type message: str
         """
@@ -253,7 +335,7 @@ class NSStageServer:
         """
         Format warning-level messages
         :param client_data: client data
-        :type client_data: dict
+        :type client_data: NSClientRecord
         :param message: message
         :type message: str
         """
@@ -263,7 +345,7 @@ class NSStageServer:
         """
         Format error-level messages
         :param client_data: client data
-        :type client_data: dict
+        :type client_data: NSClientRecord
         :param message: message
         :type message: str
         """
@@ -274,23 +356,57 @@ class NSStageServer:
         Get client data by mac address, and update ip address and hostname
         :param client_ip: client ip address
         :type client_ip: str
-        :return: client data
-        :rtype: dict
+        :return: client record
+        :rtype: NSClientRecord
         """
-        client_mac = scapy.all.getmacbyip(client_ip)
-        client_hostname = self.get_hostname(client_ip)
+        with self.metrics.phase('arp'):
+            client_mac = scapy.all.getmacbyip(client_ip)
+        with self.metrics.phase('dns'):
+            client_hostname = self.get_hostname(client_ip)
         client_data = self.client_manager.get_client(client_mac)
         if client_data:
-            if client_data['ip'] != client_ip:
-                logging.warning('Client with mac: %s, arch: %s,  changed ip ( %s -> %s )' % (client_mac, client_data['arch'], client_data['ip'], client_ip))
-                client_data['ip'] = client_ip
-                self.client_manager.set_client_ip(client_mac, client_ip)
-            if client_data['hostname'] != client_hostname:
-                logging.warning('Client with mac: %s, arch: %s,  changed hostname ( %s -> %s )' % (client_mac, client_data['arch'], client_data['hostname'], client_hostname))
-                client_data['hostname'] = client_hostname
-                self.client_manager.set_client_hostname(client_mac, client_hostname)
+            if client_data.ip != client_ip:
+                logging.warning('Client with mac: %s, arch: %s,  changed ip ( %s -> %s )' % (client_mac, client_data.arch, client_data.ip, client_ip))
+                client_data.ip = client_ip
+                with self.metrics.phase('db'):
+                    self.client_manager.set_client_ip(client_mac, client_ip)
+            if client_data.hostname != client_hostname:
+                logging.warning('Client with mac: %s, arch: %s,  changed hostname ( %s -> %s )' % (client_mac, client_data.arch, client_data.hostname, client_hostname))
+                client_data.hostname = client_hostname
+                with self.metrics.phase('db'):
+                    self.client_manager.set_client_hostname(client_mac, client_hostname)
         return client_data
 
+    def set_client_state(self, mac, state, **kwargs):
+        """
+        Queue a client state transition, timed as part of the db phase. Takes the same arguments as NSClientManager.set_client_state
+        :param mac: mac address
+        :type mac: str
+        :param state: new state
+        :type state: str
+        """
+        if state in self.admission_queue.release_states:
+            self.admission_queue.release(mac)
+        with self.metrics.phase('db'):
+            self.client_state_queue.set_client_state(mac, state, **kwargs)
+
+    def on_clients_changed(self):
+        # the writer changes state on its own too, ex: stage2 expiring into complete, which must give up the client's admission slot
+        self.loop.call_soon_threadsafe(self.admission_queue.release_finished, self.client_manager.client_index)
+
+    async def read_cached(self, file_cache, file_path):
+        """
+        Get a file from one of our file caches, timed as part of the file phase
+        :param file_cache: file cache
+        :type file_cache: NSFileCache
+        :param file_path: path to file
+        :type file_path: pathlib.Path
+        :return: value from the cache
+        :rtype: Any
+        """
+        with self.metrics.phase('file'):
+            return await file_cache.get_async(file_path, self.loop)
+
     def wrap_stage2_error(self, error):
         content = '''
         echo An error occured: %s
@@ -299,27 +415,102 @@ class NSStageServer:
         final_content = self.stage2_preamble + content + self.stage2_epilogue
         return final_content
 
-    def wrap_stage2_content(self, image_name, client_data, content):
-        settings = self.client_manager.get_settings()
-        variables = '''
-        #### variables added by Netboot Studio
-        # boot-image-name will always be set to match the name of the boot image
-        set boot-image-name %s
-        set boot-image-path ${boot-images}/${boot-image-name}
-        set boot-image-path-nfs ${boot-images-nfs}/${boot-image-name}
-        set client-ip %s
-        # client-arch is set by the preamble
-        set client-mac %s
-        set client-hostname %s
-        set debian-mirror %s
-        set ubuntu-mirror %s
-        #### end variables
-        echo Booting ${boot-image-name}...
-        
-        ''' % (image_name, client_data['ip'], client_data['mac'], client_data['hostname'], settings['debian_mirror'], settings['ubuntu_mirror'])
-        final_content = self.stage2_preamble + variables + content + self.stage2_epilogue
+    def render_stage2(self, image_name, client_data, body):
+        """
+        Render stage2 for a client, only the variables are rendered per-request
+        :param image_name: name of boot image
+        :type image_name: str
+        :param client_data: client record
+        :type client_data: NSClientRecord
+        :param body: stage2 content followed by the epilogue
+        :type body: str
+        :return: stage2 script
+        :rtype: str
+        """
+        variables = render_stage2_variables(image_name, client_data, self.client_manager.get_settings())
+        final_content = self.stage2_preamble + variables + body
         return final_content
 
+    def get_template_variables(self, client_data):
+        """
+        Build the variables available to unattended config templates
+        :param client_data: client record
+        :type client_data: NSClientRecord
+        :return: variables
+        :rtype: dict
+        """
+        variables = {
+            'mac': client_data.mac,
+            'ip': client_data.ip,
+            'hostname': client_data.hostname,
+            'arch': client_data.arch,
+            'boot_image': client_data.config['boot_image'],
+            'unattended_config': client_data.config['unattended_config'],
+            'stage4': client_data.config['stage4'],
+            'stage_server': self.stage_server_url,
+            'netboot_server': self.config.get('main', 'netboot_server_hostname'),
+        }
+        for key, value in self.client_manager.get_settings().items():
+            variables['settings.%s' % key] = value
+        return {name: str(value) for name, value in variables.items()}
+
+    def render_unattended(self, client_data, template):
+        """
+        Render an unattended config template for a client, reusing the last result if nothing it depends on has changed
+        :param client_data: client record
+        :type client_data: NSClientRecord
+        :param template: compiled template
+        :type template: NSTemplate
+        :return: rendered content
+        :rtype: str
+        """
+        if not template.variable_names:
+            return template.render({})
+        variables = self.get_template_variables(client_data)
+        selected = template.select(variables)
+        cached = self.unattended_rendered.get(client_data.mac)
+        if cached is not None and cached[0] is template and cached[1] == selected:
+            return cached[2]
+        content = template.render(variables)
+        self.unattended_rendered[client_data.mac] = (template, selected, content)
+        return content
+
+    def get_stage2_menu_body(self, arch):
+        """
+        Get the stage2 menu for an arch, built from the boot image catalog, and rebuilt only when the catalog version changes
+        :param arch: client arch
+        :type arch: str
+        :return: menu content followed by the epilogue
+        :rtype: str
+        """
+        self.boot_image_catalog.sync()
+        version = self.boot_image_catalog.version
+        cached = self.stage2_menu_bodies.get(arch)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        items = []
+        choices = []
+        for metadata in self.boot_image_catalog.get_boot_images():
+            if metadata['arch'] != 'none' and metadata['arch'] != arch:
+                continue
+            index = len(items)
+            # neither item text nor url may contain newlines, and the url must survive being part of another url
+            description = ' '.join(str(metadata['description']).split())
+            items.append('item menu-choice-%s %s - %s' % (index, metadata['boot_image_name'], description))
+            choices.append(self.stage2_menu_choice % (index, urllib.parse.quote(metadata['boot_image_name'], safe='')))
+        if not items:
+            items.append('item --gap -- no boot images available for arch: %s' % arch)
+        body = self.stage2_menu_header + '\n    '.join(items) + self.stage2_menu_footer + ''.join(choices) + self.stage2_epilogue
+        self.stage2_menu_bodies[arch] = (version, body)
+        logging.debug('built stage2 menu for arch: %s, with %s boot images, catalog version: %s' % (arch, len(choices), version))
+        return body
+
+    def load_stage2_body(self, file_path):
+        # loader for stage2_body_cache
+        with open(file_path, 'r') as bpf:
+            file_content = bpf.read()
+        return file_content + self.stage2_epilogue
+
     @staticmethod
     def get_hostname(client_ip):
         """
@@ -361,9 +552,73 @@ class NSStageServer:
         self.app.add_routes([web.get('/stage4.bat', self.get_stage4_windows)])
         self.app.add_routes([web.get('/client_state', self.get_client_state)])
         self.app.add_routes([web.get('/mount.cmd', self.get_windows_mountcmd)])
-        self.app.add_routes([web.static('/packages/', self.paths['packages'])])
-        self.app.add_routes([web.static('/boot_images/', self.paths['boot_images'])])
-        self.app.add_routes([web.static('/iso/', self.paths['iso'])])
+        self.app.add_routes([web.get('/ipxe.bin', self.get_ipxe_binary)])
+        self.app.add_routes([web.get('/ipxe.efi', self.get_ipxe_binary)])
+        self.app.add_routes([web.get('/downloads', self.get_downloads)])
+        self.app.add_routes([web.get('/metrics', self.get_metrics)])
+        self.app.add_routes([web.get('/packages/{filename:.+}', self.static_files['packages'].handle)])
+        self.app.add_routes([web.get('/boot_images/{filename:.+}', self.static_files['boot_images'].handle)])
+        self.app.add_routes([web.get('/iso/{filename:.+}', self.static_files['iso'].handle)])
+
+    async def get_downloads(self, request):
+        """
+        Get download counters for packages/, boot_images/, and iso/
+        :param request: web request
+        :type request: web.Request
+        :return: web response
+        :rtype: web.Response
+        """
+        downloads = {static_name: static_files.get_downloads() for static_name, static_files in self.static_files.items()}
+        return web.json_response(downloads)
+
+    async def get_metrics(self, request):
+        """
+        Get request metrics, as json, or in the prometheus text format with ?format=prometheus
+        :param request: web request
+        :type request: web.Request
+        :return: web response
+        :rtype: web.Response
+        """
+        if request.rel_url.query.get('format') == 'prometheus':
+            return web.Response(text=self.metrics.to_prometheus(), status=200, content_type='text/plain')
+        metrics = self.metrics.get_metrics()
+        metrics['client_state_queue'] = self.client_state_queue.get_stats()
+        metrics['admission_queue'] = self.admission_queue.get_stats()
+        metrics['boot_planner'] = self.boot_planner.get_stats()
+        file_caches = [self.stage2_body_cache, self.text_file_cache, self.unattended_template_cache, build_metadata_cache, boot_image_metadata_cache]
+        metrics['file_caches'] = {file_cache.name: file_cache.get_stats() for file_cache in file_caches}
+        return web.json_response(metrics)
+
+    async def get_ipxe_binary(self, request):
+        """
+        Get ipxe.bin or ipxe.efi from the client's ipxe build, the same one TFTP would serve. This is for UEFI HTTP Boot
+        :param request: web request
+        :type request: web.Request
+        :return: web response
+        :rtype: web.StreamResponse
+        """
+        # handle requests for /ipxe.bin and /ipxe.efi
+        try:
+            client_data = self.get_client(request.remote)
+        except Exception:
+            logging.exception('Unexpected exeception while looking up client for ipxe binary')
+            return web.Response(text='', status=500)
+        if not client_data:
+            logging.error('ipxe binary requested by an unknown client with ip: %s, this indicates dhcp sniffer may not be working correctly!!' % request.remote)
+            return web.Response(text='', status=404)
+        plan = self.boot_planner.get_plan(client_data)
+        if plan.ipxe_problem is not None:
+            self.log_warn(client_data, plan.ipxe_problem)
+        # we always serve ipxe.bin from the given build, whatever name was requested. up to build stage to make that the correct format
+        static_files = self.static_files['ipxe_builds']
+        if plan.ipxe_file is None:
+            self.log_error(client_data, 'Failed to find ipxe.bin in ipxe build: %s' % plan.ipxe_build)
+            return web.Response(text='', status=404)
+        file_path = plan.ipxe_file
+        if request.method != 'HEAD':
+            self.log_info(client_data, 'Serving ipxe_build file over http: %s' % file_path)
+            self.set_client_state(client_data.mac, 'ipxe')
+        return await static_files.serve(request, file_path)
 
     async def get_stage2(self, request):
         """
@@ -405,68 +660,66 @@ class NSStageServer:
             if str(request.remote) != args['ip']:
                 self.log_warn(client_data, 'ip addresses dont match! request: [%s], arg: [%s]' % (str(request.remote), args['ip']))
                 self.log_warn(client_data, 'taking the args version')
-            client_data['info']['ipxe'] = info_ipxe
-            # client_data['arch'] = info_ipxe['buildarch']
-            result = self.client_manager.set_client_info(args['mac'], client_data['info'])
+            client_data.info['ipxe'] = info_ipxe
+            # client_data.arch = info_ipxe['buildarch']
+            with self.metrics.phase('db'):
+                result = self.client_manager.set_client_info(args['mac'], client_data.info)
             if not result:
                 raise Exception('failed to update client info in database')
-            boot_image_name = client_data['config']['boot_image']
-            do_unattended = client_data['config']['do_unattended']
+            plan = self.boot_planner.get_plan(client_data)
+            boot_image_name = plan.boot_image_name
+            do_unattended = plan.do_unattended
+            stage2 = plan.stage2
+            stage2_variables = plan.stage2_variables
+            stage2_url_suffix = ''  # added to stage-2-url when the client needs to ask for the same thing again
+            if boot_image_name == 'menu' and args.get('boot_image'):
+                # a choice from the menu, which is not part of the plan
+                boot_image_name = args['boot_image']
+                stage2_url_suffix = '&boot_image=%s' % urllib.parse.quote(boot_image_name, safe='')
+                if boot_image_name in ['menu', 'standby_loop']:
+                    raise Exception('not a boot image: %s' % boot_image_name)
+                stage2 = self.boot_planner.resolve_stage2(boot_image_name, client_data.arch, do_unattended)
+                stage2_variables = render_stage2_variables(boot_image_name, client_data, self.client_manager.get_settings())
             if boot_image_name:
+                if boot_image_name in ['standby_loop', 'menu']:
+                    # not installing anything
+                    self.admission_queue.release(client_data.mac)
+                else:
+                    admitted, position, waiting = self.admission_queue.admit(client_data.mac, boot_image_name, (client_data.state, client_data.state_expiration))
+                    if not admitted:
+                        self.log_info(client_data, 'Waiting for admission to boot: %s, position: %s of %s' % (boot_image_name, position, waiting))
+                        retry_seconds = self.admission_queue.retry_seconds
+                        body = self.stage2_admission_wait % (position, waiting, boot_image_name, retry_seconds, retry_seconds * 1000, stage2_url_suffix) + self.stage2_epilogue
+                        self.set_client_state(client_data.mac, 'queued', state_text='Queued: %s of %s for %s' % (position, waiting, boot_image_name),
+                                              description='Too many clients are booting right now, client is number %s of %s waiting to boot: %s' % (position, waiting, boot_image_name))
+                        return web.Response(text=self.stage2_preamble + stage2_variables + body, status=200, content_type='text/plain')
+                if stage2['error'] is not None:
+                    raise Exception(stage2['error'])
                 if boot_image_name == 'standby_loop':
                     # special option standby_loop is not a real boot_image, but an internally rendered string
                     self.log_info(client_data, 'Serving virtual boot_image: standby_loop')
-                    content = self.wrap_stage2_content(boot_image_name, client_data, self.stage2_standby_loop)
+                    content = self.stage2_preamble + stage2_variables + self.stage2_standby_loop_body
                 elif boot_image_name == 'menu':
                     # special option menu is not a real boot_image, but an internally rendered string
                     self.log_info(client_data, 'Serving virtual boot_image: menu')
-                    content = self.wrap_stage2_content(boot_image_name, client_data, self.stage2_menu)
+                    content = self.stage2_preamble + stage2_variables + self.get_stage2_menu_body(client_data.arch)
                 else:
-                    b_path = self.paths['boot_images'].joinpath(boot_image_name)
-                    if pathlib.Path(b_path).is_file():
-                        # this is a file boot image, aka a-la-carte
-                        with open(b_path, 'r') as bpf:
-                            file_content = bpf.read()
-                        content = self.wrap_stage2_content(boot_image_name, client_data, file_content)
-                        self.log_info(client_data, 'Serving a-la-carte boot_image file: %s' % b_path)
-                    elif pathlib.Path(b_path).is_dir():
-                        # this is a folder boot image
-                        metafile = pathlib.Path(b_path).joinpath('metadata.yaml')
-                        with open(metafile, 'r') as mf:
-                            metadata = yaml.full_load(mf)
-                        metadata['boot_image_name'] = boot_image_name
-                        if not validate_boot_image_metadata(metadata):
-                            raise Exception('metadata validation failed for boot image: %s' % boot_image_name)
-                        if do_unattended:
-                            if metadata['supports_unattended']:
-                                b_file = b_path.joinpath(metadata['stage2_unattended_filename'])
-                            else:
-                                raise Exception('tried to do unattended for a boot image that does not support unattended')
-                        else:
-                            b_file = b_path.joinpath(metadata['stage2_filename'])
-                        if metadata['arch'] != 'none':
-                            if client_data['arch'] != metadata['arch']:
-                                raise Exception('client arch: %s does not match boot image arch: %s' % (client_data['arch'], metadata['arch']))
-                        if pathlib.Path(b_file).is_file():
-                            with open(b_file, 'r') as bpf:
-                                file_content = bpf.read()
-                            content = self.wrap_stage2_content(boot_image_name, client_data, file_content)
-                            self.log_info(client_data, 'Serving folder boot_image file: %s' % b_file)
-                        else:
-                            raise Exception('failed to find stage2 file at: %s' % b_file)
+                    content = self.stage2_preamble + stage2_variables + await self.read_cached(self.stage2_body_cache, stage2['file'])
+                    if stage2['kind'] == 'file':
+                        self.log_info(client_data, 'Serving a-la-carte boot_image file: %s' % stage2['file'])
                     else:
-                        raise Exception('failed to find boot_image named: %s, at path: %s' % (boot_image_name, b_path))
+                        self.log_info(client_data, 'Serving folder boot_image file: %s' % stage2['file'])
                 if not do_unattended:
-                    self.client_manager.set_client_state(client_data['mac'], 'stage2', state_text='Stage2: %s' % boot_image_name, description='Client fetched a boot image: %s, and will not be performing an unattended installation' % boot_image_name)
+                    self.set_client_state(client_data.mac, 'stage2', state_text='Stage2: %s' % boot_image_name, description='Client fetched a boot image: %s, and will not be performing an unattended installation' % boot_image_name)
                 else:
                     # TODO expiration for do_unattended situation is hardcoded here to 4hrs
-                    self.client_manager.set_client_state(client_data['mac'], 'stage2', state_text='Stage2: %s' % boot_image_name, state_expiration_seconds=14400, state_expiration_action='error', description='Client fetched a boot image: %s, and is performing unattended installation' % boot_image_name)
+                    self.set_client_state(client_data.mac, 'stage2', state_text='Stage2: %s' % boot_image_name, state_expiration_seconds=14400, state_expiration_action='error', description='Client fetched a boot image: %s, and is performing unattended installation' % boot_image_name)
             else:
                 raise Exception('failed to get boot_image for client with ip: %s, mac: %s' % (request.remote, args['mac']))
         except Exception as ex:
             logging.exception('Unexpected exeception while getting stage2 for a client: %s' % ex)
             content = self.wrap_stage2_error(ex)
-            self.client_manager.set_client_state(client_data['mac'], 'error', error_short='Stage2: Error', description=str(ex))
+            self.set_client_state(client_data.mac, 'error', error_short='Stage2: Error', description=str(ex))
 
         return web.Response(text=content, status=200, content_type='text/plain')
 
@@ -486,18 +739,19 @@ class NSStageServer:
         else:
             if client_data:
                 try:
-                    unattended_file_name = client_data['config']['unattended_config']
+                    plan = self.boot_planner.get_plan(client_data)
+                    unattended_file_name = plan.unattended_config
                     if unattended_file_name:
                         if unattended_file_name == 'blank.cfg':
                             # special option blank.cfg is not a real file, just returns empty file
                             self.log_info(client_data, 'Serving virtual unattended_config file: blank.cfg')
                             return web.Response(text='', status=200, content_type='text/plain')
-                        b_file = self.paths['unattended_configs'].joinpath(unattended_file_name)
-                        if pathlib.Path(b_file).is_file():
-                            with open(b_file, 'r') as bpf:
-                                content = bpf.read()
+                        b_file = plan.unattended_file
+                        if b_file.is_file():
+                            template = await self.read_cached(self.unattended_template_cache, b_file)
+                            content = self.render_unattended(client_data, template)
                             self.log_info(client_data, 'Serving unattended file: %s' % b_file)
-                            self.client_manager.set_client_state(client_data['mac'], 'unattended', state_text='Unattended: %s' % unattended_file_name, description='Client fetched unattended config: %s' % unattended_file_name)
+                            self.set_client_state(client_data.mac, 'unattended', state_text='Unattended: %s' % unattended_file_name, description='Client fetched unattended config: %s' % unattended_file_name)
                             return web.Response(text=content, status=200, content_type='text/plain')
                         else:
                             raise Exception('unable to find unattended_config file: %s' % b_file)
@@ -505,7 +759,7 @@ class NSStageServer:
                         raise Exception('failed to lookup unattended_config for client with ip: %s' % request.remote)
                 except Exception as ex:
                     logging.exception('Unexpected exeception while getting unattended config for a client')
-                    self.client_manager.set_client_state(client_data['mac'], 'error', error_short='Unattended: Error', description=str(ex))
+                    self.set_client_state(client_data.mac, 'error', error_short='Unattended: Error', description=str(ex))
         return web.Response(text='', status=500)
 
     async def get_stage4_unix(self, request):
@@ -526,15 +780,14 @@ class NSStageServer:
             if client_data:
                 try:
                     args = request.rel_url.query
-                    next_script = client_data['config']['stage4']
+                    next_script = client_data.config['stage4']
                     try:
                         filename = args['file']
                     except KeyError:
                         filename = None
                     if filename is None:
                         # special stage4.sh entry for unix style systems
-                        with open(self.paths['stage4-entry-unix'], 'r') as entryfile:
-                            stage4_entry_content = entryfile.read()
+                        stage4_entry_content = await self.read_cached(self.text_file_cache, self.paths['stage4-entry-unix'])
                         stage4_entry_preamble = (
                             '#!/usr/bin/env bash\n'
                             '# this is the preamble to the stage4-entry script for unix-style systems, auto-generated by Netboot Studio\n'
@@ -544,22 +797,21 @@ class NSStageServer:
                          ) % (self.stage_server_url, next_script)
                         stage4_entry = stage4_entry_preamble + stage4_entry_content
                         self.log_info(client_data, 'Serving stage4 entry for unix-style systems')
-                        self.client_manager.set_client_state(client_data['mac'], 'stage4', state_text='Stage4 Unix-like entry', description='Fetched Stage4 entry for Unix-like systems')
+                        self.set_client_state(client_data.mac, 'stage4', state_text='Stage4 Unix-like entry', description='Fetched Stage4 entry for Unix-like systems')
                         return web.Response(text=stage4_entry, status=200, content_type='text/plain')
                     else:
                         full_file_path = pathlib.Path(self.paths['stage4']).joinpath(filename)
                         if full_file_path.is_file():
-                            with open(full_file_path, 'r') as bpf:
-                                content = bpf.read()
+                            content = await self.read_cached(self.text_file_cache, full_file_path)
                             self.log_info(client_data, 'Serving stage4 file: %s' % full_file_path)
-                            self.client_manager.set_client_state(client_data['mac'], 'stage4', state_text='Stage4 script: %s' % filename, description='Fetched a Stage4 script: %s' % filename)
+                            self.set_client_state(client_data.mac, 'stage4', state_text='Stage4 script: %s' % filename, description='Fetched a Stage4 script: %s' % filename)
                             return web.Response(text=content, status=200, content_type='text/plain')
                         else:
                             self.log_error(client_data, 'failed to get stage4.sh filename: %s' % full_file_path)
                             raise Exception('failed to get stage4.sh filename: %s' % full_file_path)
                 except Exception as ex:
                     logging.exception('Unexpected exeception while getting stage4 for a client')
-                    self.client_manager.set_client_state(client_data['mac'], 'error', error_short='Stage4: Error', description=str(ex))
+                    self.set_client_state(client_data.mac, 'error', error_short='Stage4: Error', description=str(ex))
         return web.Response(text='', status=500)
 
     async def get_stage4_windows(self, request):
@@ -579,15 +831,14 @@ class NSStageServer:
             if client_data:
                 try:
                     args = request.rel_url.query
-                    next_script = client_data['config']['stage4']
+                    next_script = client_data.config['stage4']
                     try:
                         filename = args['file']
                     except KeyError:
                         filename = None
                     if filename is None:
                         # special stage4.bat entry for windows systems
-                        with open(self.paths['stage4-entry-windows'], 'r') as entryfile:
-                            stage4_entry_content = entryfile.read()
+                        stage4_entry_content = await self.read_cached(self.text_file_cache, self.paths['stage4-entry-windows'])
                         stage4_entry_preamble = (
                             '@echo off\n'
                             '@REM this is the preamble to the stage4-entry script for windows systems, auto-generated by Netboot Studio\n'
@@ -597,21 +848,20 @@ class NSStageServer:
                         ) % (self.stage_server_url, next_script)
                         stage4_entry = stage4_entry_preamble + stage4_entry_content
                         self.log_info(client_data, 'Serving stage4 entry for windows systems')
-                        self.client_manager.set_client_state(client_data['mac'], 'stage4', state_text='Stage4: Windows entry', description='Fetched Stage4 entry for Windows systems')
+                        self.set_client_state(client_data.mac, 'stage4', state_text='Stage4: Windows entry', description='Fetched Stage4 entry for Windows systems')
                         return web.Response(text=stage4_entry, status=200, content_type='text/plain')
                     else:
                         full_file_path = pathlib.Path(self.paths['stage4']).joinpath(filename)
                         if full_file_path.is_file():
-                            with open(full_file_path, 'r') as bpf:
-                                content = bpf.read()
+                            content = await self.read_cached(self.text_file_cache, full_file_path)
                             self.log_info(client_data, 'Serving stage4 file: %s' % full_file_path)
-                            self.client_manager.set_client_state(client_data['mac'], 'stage4', state_text='Stage4 script: %s' % filename, description='Fetched a Stage4 script: %s' % filename)
+                            self.set_client_state(client_data.mac, 'stage4', state_text='Stage4 script: %s' % filename, description='Fetched a Stage4 script: %s' % filename)
                             return web.Response(text=content, status=200, content_type='text/plain')
                         else:
                             self.log_error(client_data, 'failed to get stage4.bat filename: %s' % full_file_path)
                             raise Exception('failed to get stage4.bat filename: %s' % full_file_path)
                 except Exception as ex:
-                    self.client_manager.set_client_state(client_data['mac'], 'error', error_short='Stage4: Error', description=str(ex))
+                    self.set_client_state(client_data.mac, 'error', error_short='Stage4: Error', description=str(ex))
                     logging.exception('Unexpected exeception while getting stage4 for a client')
         return web.Response(text='', status=500)
 
@@ -629,13 +879,13 @@ class NSStageServer:
             if client_data:
                 args = request.rel_url.query
                 state = args['state']
-                logging.debug('client state endpoint: %s -> %s' % (client_data['hostname'], state))
+                logging.debug('client state endpoint: %s -> %s' % (client_data.hostname, state))
                 if state == 'error':
                     error_short = args['error_short']
                     description = args['description']
-                    self.client_manager.set_client_state(client_data['mac'], 'error', error_short=error_short, description=description)
+                    self.set_client_state(client_data.mac, 'error', error_short=error_short, description=description)
                 else:
-                    self.client_manager.set_client_state(client_data['mac'], 'complete')
+                    self.set_client_state(client_data.mac, 'complete')
             else:
                 raise Exception('client was not found')
         except Exception as ex:
@@ -658,7 +908,7 @@ class NSStageServer:
             if client_data:
                 # remember you have to escape every \ with another \
                 netboot_server_ip = self.config.get('main', 'netboot_server_ip')
-                boot_image_name = client_data['config']['boot_image']
+                boot_image_name = client_data.config['boot_image']
                 samba_path = '\\\\%s\\boot_images\\%s' % (netboot_server_ip, boot_image_name)
                 samba_user = self.config.get('samba', 'user')
                 samba_pass = self.config.get('samba', 'password')
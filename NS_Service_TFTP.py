@@ -24,10 +24,12 @@ from py3tftp import file_io
 from py3tftp.netascii import Netascii
 from threading import Thread
 
-from NSClientManager import NSClientManager
+from NSClientManager import NSClientManagerFollower
 from NSLogger import get_logger
 from NSService import NSService
 from NSCommon import print_object
+from NSBootImageCatalog import NSBootImageCatalog
+from NSBootPlan import NSBootPlanner
 
 # there are two different architecture values that can be found in a DHCP discover packet, and they dont always agree
 #   the first is the option 93 'pxe_client_architecture', which is definied by the IANA
@@ -253,10 +255,14 @@ class NSTFTPService(NSService):
         """
         super().__init__(args)
         logging.info('Netboot Studio TFTP Server v%s', self.version)
-        self.client_manager = NSClientManager(self.config, self.paths, 'NSTFTPService', self.loop)
-        self.tftp_server = NSTFTPServer(self.config, self.paths, self.loop, self.client_manager)
+        # we only need to read clients on the boot path, so follow the API service's client manager instead of using the database
+        self.client_manager = NSClientManagerFollower(self.config, self.paths, 'NSTFTPService', self.loop)
+        # which ipxe.bin to serve each client is worked out once per change of its config, settings, or ipxe builds
+        self.boot_planner = NSBootPlanner(self.config, self.paths, self.client_manager, NSBootImageCatalog(self.paths), self.loop)
+        self.tftp_server = NSTFTPServer(self.config, self.paths, self.loop, self.client_manager, self.boot_planner)
         self.dhcp_sniffer = DHCPSniffer(self.config, self.paths, self.loop, self.client_manager)
         self.stopabbles['tftp_server'] = self.tftp_server
+        self.stopabbles['boot_planner'] = self.boot_planner
         self.stopabbles['client_manager'] = self.client_manager
         logging.info('TFTP Server is ready')
         self.start()
@@ -400,7 +406,7 @@ class DHCPSniffer(object):
                 if arch_iana in pxe_client_arch_map:
                     client_info = self.client_manager.get_client(info_dhcp['mac'])
                     if client_info:
-                        client_ipxe_build = client_info['config']['ipxe_build']
+                        client_ipxe_build = client_info.config['ipxe_build']
                     else:
                         client_ipxe_build = None
                     if not client_ipxe_build:
@@ -454,7 +460,7 @@ class NSTFTPServer(object):
     transport = None
     protocol = None
 
-    def __init__(self, config, paths, loop, client_mgr):
+    def __init__(self, config, paths, loop, client_mgr, boot_planner):
         """
         TFTP Server
         :param config: config object
@@ -465,11 +471,14 @@ class NSTFTPServer(object):
         :type loop: AbstractEventLoop
         :param client_mgr: client manager
         :type client_mgr: NSClientManager
+        :param boot_planner: boot planner
+        :type boot_planner: NSBootPlanner
         """
         self.config = config
         self.paths = paths
         self.loop = loop
         self.client_manager = client_mgr
+        self.boot_planner = boot_planner
         self.host = '0.0.0.0'
         try:
             self.port = int(self.config.get('tftp', 'port'))
@@ -500,7 +509,7 @@ class NSTFTPServer(object):
         Prepare async tasks for TFTP Server
         """
         listen = self.loop.create_datagram_endpoint(
-            lambda: NSTFTPServerProtocol(self.host, self.loop, self.extra_opts, self.config, self.paths, self.client_manager),
+            lambda: NSTFTPServerProtocol(self.host, self.loop, self.extra_opts, self.config, self.paths, self.client_manager, self.boot_planner),
             local_addr=(self.host, self.port,))
         self.transport, self.protocol = self.loop.run_until_complete(listen)
 
@@ -519,7 +528,7 @@ class NSTFTPServerProtocol(BaseTFTPServerProtocol):
     """
     transport = None
 
-    def __init__(self, host_interface, loop, extra_opts, config, paths, client_mgr):
+    def __init__(self, host_interface, loop, extra_opts, config, paths, client_mgr, boot_planner):
         """
         TFTP Server Protocol
         :param host_interface:
@@ -534,11 +543,14 @@ class NSTFTPServerProtocol(BaseTFTPServerProtocol):
         :type paths: dict
         :param client_mgr: client manager
         :type client_mgr: NSClientManager
+        :param boot_planner: boot planner
+        :type boot_planner: NSBootPlanner
         """
         super().__init__(host_interface, loop, extra_opts)
         self.config = config
         self.paths = paths
         self.client_manager = client_mgr
+        self.boot_planner = boot_planner
 
     def datagram_received(self, data, addr):
         """
@@ -553,7 +565,7 @@ class NSTFTPServerProtocol(BaseTFTPServerProtocol):
         file_handler_cls = self.select_file_handler(first_packet)
 
         connect = self.loop.create_datagram_endpoint(
-            lambda: protocol(data, file_handler_cls, addr, self.extra_opts, self.config, self.paths, client_mgr=self.client_manager),
+            lambda: protocol(data, file_handler_cls, addr, self.extra_opts, self.config, self.paths, client_mgr=self.client_manager, boot_planner=self.boot_planner),
             local_addr=(self.host_interface,
                         0,))
 
@@ -636,7 +648,7 @@ class NSRRQProtocol(RRQProtocol):
     
     """
 
-    def __init__(self, rrq, file_handler_cls, addr, opts, config, paths, client_mgr=None):
+    def __init__(self, rrq, file_handler_cls, addr, opts, config, paths, client_mgr=None, boot_planner=None):
         """
         Read Protocol for TFTP
         :param rrq:
@@ -653,6 +665,8 @@ class NSRRQProtocol(RRQProtocol):
         :type paths: dict
         :param client_mgr: client manager
         :type client_mgr: NSClientManager
+        :param boot_planner: boot planner
+        :type boot_planner: NSBootPlanner
         """
         super().__init__(rrq, file_handler_cls, addr, opts)
         self.config = config
@@ -662,6 +676,7 @@ class NSRRQProtocol(RRQProtocol):
         self.uboot_scripts = pathlib.Path(self.paths['uboot_scripts'])
         self.uboot_binaries = pathlib.Path(self.paths['uboot_binaries'])
         self.client_manager = client_mgr
+        self.boot_planner = boot_planner
         self.dhcp_config = {
             'server': self.config.get('main', 'netboot_server_ip'),
             'file': '/ipxe.bin',
@@ -700,7 +715,7 @@ class NSRRQProtocol(RRQProtocol):
             tempfolder = pathlib.Path(temp)
             temp_script = tempfolder.joinpath('boot.cmd')
             output_file = tempfolder.joinpath('boot.scr.uimg')
-            if client_info['config']['uboot_script'] == 'default':
+            if client_info.config['uboot_script'] == 'default':
                 self.log_info('serving default (empty) uboot_script')
                 try:
                     with open(temp_script, 'w') as out:
@@ -711,11 +726,11 @@ class NSRRQProtocol(RRQProtocol):
                     result = False
                     pass
             else:
-                uboot_script_path = self.uboot_scripts.joinpath(client_info['config']['uboot_script'])
+                uboot_script_path = self.uboot_scripts.joinpath(client_info.config['uboot_script'])
                 self.log_info('serving uboot_script: %s' % uboot_script_path)
                 result = shutil.copyfile(uboot_script_path, temp_script)
             if result:
-                binary_filepath = self.uboot_binaries.joinpath('%s.uimg' % client_info['config']['uboot_script'])
+                binary_filepath = self.uboot_binaries.joinpath('%s.uimg' % client_info.config['uboot_script'])
                 result = subprocess.run('%s 2>&1' % cmd, shell=True, universal_newlines=True, cwd=tempfolder, capture_output=True, text=True)
                 if result.returncode == 0:
                     if shutil.copyfile(output_file, binary_filepath):
@@ -729,7 +744,7 @@ class NSRRQProtocol(RRQProtocol):
                 logging.error('failed to copy %s to %s' % (uboot_script_path, temp_script))
         if success:
             filename = binary_filepath
-            self.client_manager.set_client_state(client_info['mac'], 'uboot')
+            self.client_manager.set_client_state(client_info.mac, 'uboot')
         else:
             filename = self.get_tftp_file()
         return filename
@@ -801,22 +816,15 @@ class NSRRQProtocol(RRQProtocol):
         # figure out what file to serve this client
         #   by time we get here, there should always be a client entry populated by dhcp already
         #   this is where the ip is set for the first time
-        settings = self.client_manager.get_settings()
-        defaults = {
-            'arm64': settings['ipxe_build_arm64'],
-            'amd64': settings['ipxe_build_amd64'],
-            'bios32': settings['ipxe_build_bios32'],
-            'bios64': settings['ipxe_build_bios64'],
-        }
         try:
             client_info = self.client_manager.get_client(self.remote_mac_address)
             if client_info:
-                client_info['ip'] = self.remote_ip
-                client_info['hostname'] = self.hostname
+                client_info.ip = self.remote_ip
+                client_info.hostname = self.hostname
                 self.client_manager.set_client_ip(self.remote_mac_address, self.remote_ip)
                 self.client_manager.set_client_hostname(self.remote_mac_address, self.hostname)
-                self.remote_arch = client_info['arch']
-                self.client_ipxe_build = client_info['config']['ipxe_build']
+                self.remote_arch = client_info.arch
+                self.client_ipxe_build = client_info.config['ipxe_build']
             else:
                 self.log_error('client does not have an entry in database: %s' % self.remote_mac_address)
                 self.log_error('  this indicates dhcp sniffer may not be working correctly!!')
@@ -825,20 +833,17 @@ class NSRRQProtocol(RRQProtocol):
             logging.exception('something went wrong while trying to look up client: %s' % self.remote_mac_address)
             return None
         else:
-            if not pathlib.Path(self.ipxe_builds).joinpath(self.client_ipxe_build).joinpath('metadata.json').is_file():
-                default_ipxe_build = defaults[self.remote_arch]
-                self.log_warn('could not find build with id: %s, falling back to default[%s]: %s' % (self.client_ipxe_build, self.remote_arch, default_ipxe_build))
-                if not pathlib.Path(self.ipxe_builds).joinpath(default_ipxe_build).joinpath('metadata.json').is_file():
-                    self.log_error('default ipxe builds does not exist: %s' % default_ipxe_build)
-                else:
-                    self.client_ipxe_build = default_ipxe_build
+            plan = self.boot_planner.get_plan(client_info)
+            self.client_ipxe_build = plan.ipxe_build
+            if plan.ipxe_problem is not None:
+                self.log_warn(plan.ipxe_problem)
             # we always serve ipxe.bin from the given build. up to build stage to make that the correct format
-            filename = pathlib.Path(self.ipxe_builds).joinpath(self.client_ipxe_build).joinpath('ipxe.bin')
-            if not filename.is_file():
+            filename = self.ipxe_builds.joinpath(self.client_ipxe_build).joinpath('ipxe.bin')
+            if plan.ipxe_file is None:
                 self.log_error('Failed to find file: %s' % filename)
             else:
                 self.log_info('Serving ipxe_build file: %s' % filename)
-                self.client_manager.set_client_state(client_info['mac'], 'ipxe')
+                self.client_manager.set_client_state(client_info.mac, 'ipxe')
             return filename
 
     def set_proto_attributes(self):
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Benchmark: API Response Fan-out, shared topic vs per-session reply topics
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# measures what it costs when many web UI sessions are open and each makes api requests
+#   shared: every response is published on api_response, which every session subscribes to, so every session receives every response
+#   session: every response is published on the reply topic of the session that asked, see NSAPISessions
+#   this script plays the part of the api server itself, publishing a response of the given size for each request, so only the broker is needed
+#   each session is a separate mqtt connection, like a browser, and reports how many messages and bytes it had to receive to get its own responses
+# usage: ./benchmark-api-fanout.py <config dir> [num_sessions] [requests_per_session] [response_bytes]
+
+import sys
+import time
+import uuid
+import threading
+import paho.mqtt.client as mqtt
+
+from configparser import RawConfigParser
+
+from NSCommon import build_paths, NSMessage
+
+
+class Session:
+    """
+    A web UI session, counting the responses it receives
+    """
+
+    def __init__(self, config, paths, reply_topic, expected):
+        self.name = 'benchmark_session_%s' % uuid.uuid4()
+        self.reply_topic = reply_topic
+        self.expected = expected
+        self.request_ids = set()
+        self.received = 0
+        self.received_bytes = 0
+        self.own = 0
+        self.done = threading.Event()
+        self.subscribed = threading.Event()
+        self.client = mqtt.Client(self.name)
+        self.client.username_pw_set(username=config.get('broker', 'user'), password=config.get('broker', 'password'))
+        self.client.tls_set(paths['ssl_full_chain'])
+        self.client.on_connect = lambda client, userdata, flags, rc: client.subscribe(self.reply_topic)
+        self.client.on_subscribe = lambda client, userdata, mid, granted_qos: self.subscribed.set()
+        self.client.on_message = self.on_message
+        self.client.connect(config.get('main', 'netboot_server_hostname'), int(config.get('broker', 'port')))
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, message):
+        self.received += 1
+        self.received_bytes += len(message.payload)
+        # what the browser does with every response: parse it, then look up the correlation id
+        response = NSMessage(message.payload.decode('utf-8'))
+        if response.get('content')['id'] in self.request_ids:
+            self.own += 1
+            if self.own == self.expected:
+                self.done.set()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def run(config, paths, mode, num_sessions, num_requests, response_bytes):
+    run_id = uuid.uuid4()
+    sessions = []
+    for i in range(num_sessions):
+        # a shared topic of our own, so open browsers are not flooded
+        reply_topic = 'api_response/benchmark-%s' % run_id if mode == 'shared' else 'api_response/benchmark-%s-%s' % (run_id, i)
+        sessions.append(Session(config, paths, reply_topic, num_requests))
+    for session in sessions:
+        session.subscribed.wait(10)
+    server = sessions[0].client
+    filler = 'x' * response_bytes
+    start = time.perf_counter()
+    for _ in range(num_requests):
+        for session in sessions:
+            request_id = str(uuid.uuid4())
+            session.request_ids.add(request_id)
+            response = NSMessage()
+            response.set('topic', session.reply_topic)
+            response.set('content', {'id': request_id, 'endpoint': 'get_file', 'api_payload': {'result': filler}})
+            server.publish(session.reply_topic, response.to_json())
+    for session in sessions:
+        session.done.wait(300)
+    duration = time.perf_counter() - start
+    received = sum(session.received for session in sessions)
+    received_bytes = sum(session.received_bytes for session in sessions)
+    for session in sessions:
+        session.stop()
+    print('%-8s %4s sessions  %8.1f ms  %8s messages received  %8.1f MB received  %6.1f messages per session per response' % (
+        mode, num_sessions, duration * 1000, received, received_bytes / 1048576, received / (num_sessions * num_requests)))
+    return duration
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: %s <config dir> [num_sessions] [requests_per_session] [response_bytes]' % sys.argv[0])
+        sys.exit(1)
+    paths = build_paths(sys.argv[1])
+    config = RawConfigParser()
+    config.read(paths['config.ini'])
+    num_sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    num_requests = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    response_bytes = int(sys.argv[4]) if len(sys.argv) > 4 else 10000
+    shared = run(config, paths, 'shared', num_sessions, num_requests, response_bytes)
+    session = run(config, paths, 'session', num_sessions, num_requests, response_bytes)
+    print('per-session reply topics are %.1fx faster' % (shared / session))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Benchmark: Client Records
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# measures memory held by the in-memory clients list, and the time to check every client state (what get_clients does each second):
+#   dict: rows decoded into a dict holding nested info, config, and state dicts, as the client manager used to keep them
+#   record: rows loaded into NSClientRecord, with info left undecoded until accessed
+# usage: ./benchmark-client-records.py [num_clients ...]
+
+import sys
+import json
+import time
+import tracemalloc
+
+from NSClientRecord import NSClientRecord
+
+
+def make_rows(num_clients):
+    rows = []
+    for i in range(num_clients):
+        mac = '00:0c:29:%02x:%02x:%02x' % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+        info = {
+            'dhcp': {'mac': mac, 'vci': 'PXEClient:Arch:00007:UNDI:003016', 'arch_bytes': '0x00 0x07', 'arch_iana': 'x64 UEFI', 'arch': 'amd64', 'user_class': 'None'},
+            'ipxe': {'buildarch': 'x86_64', 'platform': 'efi', 'manufacturer': 'VMware, Inc.', 'chip': 'undionly', 'ip': '192.168.1.%s' % (i % 250), 'uuid': '564d1e1a-5b1b-4c3a-8b2f-%012d' % i,
+                     'serial': 'VMware-56 4d 1e 1a', 'product': 'VMware7,1', 'version': 'None', 'unixtime': '1680000000', 'asset': 'No Asset Tag'},
+        }
+        config = {'boot_image': 'standby_loop', 'unattended_config': 'blank.cfg', 'do_unattended': False, 'ipxe_build': '50384451-6b75-4726-8e38-4a2b53a21f8d', 'uboot_script': 'default', 'stage4': 'none', 'boot_image_once': False}
+        state = {'state': {'active': False, 'state': 'inactive', 'state_text': 'Inactive', 'state_expiration': 'none', 'state_expiration_action': 'none', 'error': False, 'error_short': '', 'description': 'Client is not doing Netboot Studio things'},
+                 'data': {'comment': 'reserved for future use'}}
+        rows.append({'mac': mac, 'ip': '192.168.1.%s' % (i % 250), 'arch': 'amd64', 'hostname': 'client-%s' % i, 'version': '1', 'info': json.dumps(info), 'config': json.dumps(config), 'state': json.dumps(state)})
+    return rows
+
+
+def load_dicts(rows):
+    clients = []
+    for row in rows:
+        client = dict(row)
+        client['info'] = json.loads(client['info'])
+        client['config'] = json.loads(client['config'])
+        client['state'] = json.loads(client['state'])
+        clients.append(client)
+    return clients
+
+
+def check_dicts(clients):
+    return sum(1 for client in clients if client['state']['state']['state_expiration'] != 'none' and client['state']['state']['state_expiration_action'] != 'none')
+
+
+def load_records(rows):
+    return [NSClientRecord.from_row(row) for row in rows]
+
+
+def check_records(clients):
+    return sum(1 for client in clients if client.state_expiration != 'none' and client.state_expiration_action != 'none')
+
+
+def measure(rows, load, check, cycles=20):
+    tracemalloc.start()
+    clients = load(rows)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(cycles):
+        check(clients)
+    check_time = (time.perf_counter() - start) / cycles
+    return size, check_time
+
+
+def benchmark(num_clients):
+    rows = make_rows(num_clients)
+    for name, load, check in [('dict', load_dicts, check_dicts), ('record', load_records, check_records)]:
+        size, check_time = measure(rows, load, check)
+        print('%6s clients  %-7s memory: %8.2f MB  (%5s bytes/client)  state check: %6.2f ms' % (num_clients, name, size / 1048576, size // num_clients, check_time * 1000))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    else:
+        sizes = [1000, 10000, 50000]
+    for size in sizes:
+        benchmark(size)
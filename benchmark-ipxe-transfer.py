@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Benchmark: iPXE Binary Transfer, TFTP vs HTTP
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# measures how long it takes to fetch ipxe.bin the way a client does: over TFTP (lock-step, one block in flight), and over HTTP from the stage server
+#   both services choose the binary by client config, so run this from a machine that already has a client entry (ex: after it netbooted once)
+#   TFTP is measured with the default 512 byte blocks, and with the largest block size that fits in a standard ethernet frame
+#   note that fetching ipxe.bin sets the client state to ipxe, like a real client would
+# usage: ./benchmark-ipxe-transfer.py <netboot server> [repeat]
+
+import sys
+import time
+import socket
+import struct
+import urllib.request
+
+TFTP_PORT = 69
+STAGE_PORT = 8082
+BLOCK_SIZES = [512, 1468]
+
+
+def tftp_get(server, filename, block_size, timeout=5):
+    """
+    Fetch a file using TFTP in octet mode, asking for block_size if it is not the default
+    :return: number of bytes received
+    :rtype: int
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        request = struct.pack('!H', 1) + filename.encode() + b'\x00octet\x00'
+        if block_size != 512:
+            request += b'blksize\x00' + str(block_size).encode() + b'\x00'
+        sock.sendto(request, (server, TFTP_PORT))
+        received = 0
+        expected_block = 1
+        while True:
+            packet, peer = sock.recvfrom(block_size + 4)
+            opcode = struct.unpack('!H', packet[:2])[0]
+            if opcode == 6:
+                # OACK, acknowledge with block 0 to start the transfer
+                sock.sendto(struct.pack('!HH', 4, 0), peer)
+                continue
+            if opcode == 5:
+                raise Exception('TFTP error: %s' % packet[4:].rstrip(b'\x00').decode(errors='replace'))
+            if opcode != 3:
+                raise Exception('unexpected TFTP opcode: %s' % opcode)
+            block = struct.unpack('!H', packet[2:4])[0]
+            sock.sendto(struct.pack('!HH', 4, block), peer)
+            if block != expected_block:
+                # a retransmit of a block we already have
+                continue
+            data = packet[4:]
+            received += len(data)
+            expected_block = (expected_block + 1) % 65536
+            if len(data) < block_size:
+                return received
+    finally:
+        sock.close()
+
+
+def http_get(server, path):
+    with urllib.request.urlopen('http://%s:%s%s' % (server, STAGE_PORT, path), timeout=30) as response:
+        return len(response.read())
+
+
+def measure(name, repeat, fetch):
+    durations = []
+    num_bytes = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        num_bytes = fetch()
+        durations.append(time.perf_counter() - start)
+    mean = sum(durations) / len(durations)
+    print('%-22s %8s bytes  mean: %8.1f ms  best: %8.1f ms  %8.2f MB/s' % (name, num_bytes, mean * 1000, min(durations) * 1000, num_bytes / mean / 1048576))
+    return mean
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: %s <netboot server> [repeat]' % sys.argv[0])
+        sys.exit(1)
+    server = sys.argv[1]
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    results = {}
+    for block_size in BLOCK_SIZES:
+        results['tftp blksize %s' % block_size] = measure('tftp blksize %s' % block_size, repeat, lambda: tftp_get(server, 'ipxe.bin', block_size))
+    http_mean = measure('http', repeat, lambda: http_get(server, '/ipxe.efi'))
+    for name, mean in results.items():
+        print('http is %.1fx faster than %s' % (mean / http_mean, name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Benchmark: MQTT, threaded paho vs asyncio loop
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# measures how many messages per second a service can publish to the broker and get back, the way DataSources do: publish on a topic it also subscribes to
+#   threaded: a plain paho client with its own network thread (loop_start), handing each message to the asyncio loop with call_soon_threadsafe, as services used to
+#   hub: NSMQTTHub, where the asyncio loop reads and writes the socket itself, and publish_async waits when too many messages are waiting to be sent
+#   both connect to the broker of a real Netboot Studio install, using the same config dir as the services
+# usage: ./benchmark-mqtt.py <config dir> [num_messages]
+
+import sys
+import time
+import uuid
+import asyncio
+import paho.mqtt.client as mqtt
+
+from configparser import RawConfigParser
+
+from NSCommon import build_paths
+from NSPubSub import NSMQTTClient
+
+PAYLOAD = '{"message_type": "delta", "version": 1, "changed": [{"name": "benchmark", "size": 1234, "modified": 1680000000}]}'
+
+
+async def run_threaded(config, paths, loop, topic, num_messages):
+    received = 0
+    done = asyncio.Event()
+    connected = asyncio.Event()
+
+    def handle_message(msg):
+        nonlocal received
+        received += 1
+        if received == num_messages:
+            done.set()
+
+    client = mqtt.Client('benchmark_threaded_%s' % uuid.uuid4())
+    client.username_pw_set(username=config.get('broker', 'user'), password=config.get('broker', 'password'))
+    client.tls_set(paths['ssl_full_chain'])
+    client.on_connect = lambda c, u, f, rc: loop.call_soon_threadsafe(connected.set)
+    client.on_message = lambda c, u, message: loop.call_soon_threadsafe(handle_message, message.payload.decode('utf-8'))
+    client.connect(config.get('main', 'netboot_server_hostname'), int(config.get('broker', 'port')))
+    client.loop_start()
+    try:
+        await connected.wait()
+        client.subscribe(topic)
+        await asyncio.sleep(0.5)  # let the subscription settle, there is no easy way to wait for suback here
+        start = time.perf_counter()
+        for _ in range(num_messages):
+            client.publish(topic, PAYLOAD)
+        await done.wait()
+        return time.perf_counter() - start
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+
+async def run_hub(config, paths, loop, topic, num_messages):
+    received = 0
+    done = asyncio.Event()
+    connected = asyncio.Event()
+
+    def handle_message(_topic, msg):
+        nonlocal received
+        received += 1
+        if received == num_messages:
+            done.set()
+
+    client = NSMQTTClient('benchmark_hub_%s' % uuid.uuid4(), config, paths, [(topic, 0)], handle_message, loop, connected.set)
+    try:
+        await connected.wait()
+        await asyncio.sleep(0.5)
+        start = time.perf_counter()
+        for _ in range(num_messages):
+            await client.publish_async(topic, PAYLOAD)
+        await done.wait()
+        return time.perf_counter() - start
+    finally:
+        client.stop()
+
+
+def report(name, num_messages, duration):
+    print('%-10s %8s messages  %8.1f ms  %10.0f messages/s' % (name, num_messages, duration * 1000, num_messages / duration))
+
+
+async def benchmark(config, paths, num_messages):
+    loop = asyncio.get_running_loop()
+    topic = 'NetbootStudio/benchmark/%s' % uuid.uuid4()
+    threaded = await asyncio.wait_for(run_threaded(config, paths, loop, topic, num_messages), timeout=300)
+    report('threaded', num_messages, threaded)
+    hub = await asyncio.wait_for(run_hub(config, paths, loop, topic, num_messages), timeout=300)
+    report('hub', num_messages, hub)
+    print('hub is %.2fx the throughput of threaded' % (threaded / hub))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: %s <config dir> [num_messages]' % sys.argv[0])
+        sys.exit(1)
+    paths = build_paths(sys.argv[1])
+    config = RawConfigParser()
+    config.read(paths['config.ini'])
+    num_messages = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    asyncio.run(benchmark(config, paths, num_messages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Benchmark: MQTT Payload Compression
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# measures bytes on the wire and cpu time for a clients DataSource value, as plain json and as the compressed envelope from NSJson.payload_dumps
+#   encode: what the provider does for every new_value / current_value message
+#   decode: what every subscriber does when it receives one
+#   each zlib level is shown, to check that PAYLOAD_COMPRESS_LEVEL is still a good trade
+# usage: ./benchmark-payloads.py [num_clients ...]
+
+import sys
+import time
+
+import NSJson
+
+LEVELS = [1, 3, 6, 9]
+
+
+def make_clients(num_clients):
+    clients = []
+    for i in range(num_clients):
+        mac = '00:0c:29:%02x:%02x:%02x' % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+        info = {
+            'dhcp': {'mac': mac, 'vci': 'PXEClient:Arch:00007:UNDI:003016', 'arch_bytes': '0x00 0x07', 'arch_iana': 'x64 UEFI', 'arch': 'amd64', 'user_class': 'None'},
+            'ipxe': {'buildarch': 'x86_64', 'platform': 'efi', 'manufacturer': 'VMware, Inc.', 'chip': 'undionly', 'ip': '192.168.1.%s' % (i % 250), 'uuid': '564d1e1a-5b1b-4c3a-8b2f-%012d' % i,
+                     'serial': 'VMware-56 4d 1e 1a', 'product': 'VMware7,1', 'version': 'None', 'unixtime': '1680000000', 'asset': 'No Asset Tag'},
+        }
+        config = {'boot_image': 'standby_loop', 'unattended_config': 'blank.cfg', 'do_unattended': False, 'ipxe_build': '50384451-6b75-4726-8e38-4a2b53a21f8d', 'uboot_script': 'default', 'stage4': 'none', 'boot_image_once': False}
+        state = {'state': {'active': False, 'state': 'inactive', 'state_text': 'Inactive', 'state_expiration': 'none', 'state_expiration_action': 'none', 'error': False, 'error_short': '', 'description': 'Client is not doing Netboot Studio things'}}
+        clients.append({'mac': mac, 'ip': '192.168.1.%s' % (i % 250), 'arch': 'amd64', 'hostname': 'client-%s' % i, 'version': '1', 'info': info, 'config': config, 'state': state})
+    return clients
+
+
+def measure(message, threshold, repeat=5):
+    encode_times = []
+    decode_times = []
+    payload = ''
+    for _ in range(repeat):
+        start = time.process_time()
+        payload = NSJson.payload_dumps(message, threshold=threshold)
+        encoded = time.process_time()
+        NSJson.payload_loads(payload)
+        decoded = time.process_time()
+        encode_times.append(encoded - start)
+        decode_times.append(decoded - encoded)
+    return len(payload), min(encode_times), min(decode_times)
+
+
+def benchmark(num_clients):
+    message = {'message_type': 'new_value', 'source_id': 'benchmark', 'version': 1, 'value': make_clients(num_clients)}
+    results = [('plain', measure(message, None))]
+    for level in LEVELS:
+        NSJson.PAYLOAD_COMPRESS_LEVEL = level
+        results.append(('zlib %s' % level, measure(message, 0)))
+    plain_size = results[0][1][0]
+    for name, (size, encode_time, decode_time) in results:
+        print('%6s clients  %-8s %10s bytes (%5.1f%%)  encode: %8.2f ms  decode: %8.2f ms' % (num_clients, name, size, size * 100 / plain_size, encode_time * 1000, decode_time * 1000))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    else:
+        sizes = [100, 1000, 10000]
+    print('NSJson backend: %s, default level: %s, threshold: %s bytes' % (NSJson.JSON_BACKEND, NSJson.PAYLOAD_COMPRESS_LEVEL, NSJson.PAYLOAD_COMPRESS_THRESHOLD))
+    for size in sizes:
+        benchmark(size)
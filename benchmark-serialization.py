@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Benchmark: JSON Serialization
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# measures cpu time of one update cycle, with the stdlib json module and with whatever backend NSJson picked:
+#   decode: what get_clients_from_db does for every row (info, config, state)
+#   encode: what NSDataSource.update does to compare, and then publish, the full clients list
+# usage: ./benchmark-serialization.py [num_clients ...]
+
+import sys
+import json
+import time
+
+import NSJson
+
+
+def make_clients(num_clients):
+    rows = []
+    for i in range(num_clients):
+        mac = '00:0c:29:%02x:%02x:%02x' % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+        info = {
+            'dhcp': {'mac': mac, 'vci': 'PXEClient:Arch:00007:UNDI:003016', 'arch_bytes': '0x00 0x07', 'arch_iana': 'x64 UEFI', 'arch': 'amd64', 'user_class': 'None'},
+            'ipxe': {'buildarch': 'x86_64', 'platform': 'efi', 'manufacturer': 'VMware, Inc.', 'chip': 'undionly', 'ip': '192.168.1.%s' % (i % 250), 'uuid': '564d1e1a-5b1b-4c3a-8b2f-%012d' % i,
+                     'serial': 'VMware-56 4d 1e 1a', 'product': 'VMware7,1', 'version': 'None', 'unixtime': '1680000000', 'asset': 'No Asset Tag'},
+        }
+        config = {'boot_image': 'standby_loop', 'unattended_config': 'blank.cfg', 'do_unattended': False, 'ipxe_build': '50384451-6b75-4726-8e38-4a2b53a21f8d', 'uboot_script': 'default', 'stage4': 'none', 'boot_image_once': False}
+        state = {'state': {'active': False, 'state': 'inactive', 'state_text': 'Inactive', 'state_expiration': 'none', 'state_expiration_action': 'none', 'error': False, 'error_short': '', 'description': 'Client is not doing Netboot Studio things'}}
+        rows.append({'mac': mac, 'ip': '192.168.1.%s' % (i % 250), 'arch': 'amd64', 'hostname': 'client-%s' % i, 'info': json.dumps(info), 'config': json.dumps(config), 'state': json.dumps(state)})
+    return rows
+
+
+def run_cycle(rows, dumps, loads):
+    start = time.process_time()
+    clients = []
+    for row in rows:
+        client = dict(row)
+        client['info'] = loads(client['info'])
+        client['config'] = loads(client['config'])
+        client['state'] = loads(client['state'])
+        clients.append(client)
+    decoded = time.process_time()
+    value_json = dumps(clients)
+    dumps({'message_type': 'new_value', 'value': clients})
+    encoded = time.process_time()
+    return decoded - start, encoded - decoded, len(value_json)
+
+
+def benchmark(num_clients, cycles=5):
+    rows = make_clients(num_clients)
+    results = {}
+    for name, dumps, loads in [('json', json.dumps, json.loads), (NSJson.JSON_BACKEND, NSJson.json_dumps, NSJson.json_loads)]:
+        timings = [run_cycle(rows, dumps, loads) for _ in range(cycles)]
+        results[name] = (min(t[0] for t in timings), min(t[1] for t in timings), timings[0][2])
+    for name, (decode_time, encode_time, size) in results.items():
+        print('%6s clients  %-8s decode: %8.2f ms  encode: %8.2f ms  total: %8.2f ms  (%s bytes)' % (num_clients, name, decode_time * 1000, encode_time * 1000, (decode_time + encode_time) * 1000, size))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    else:
+        sizes = [1000, 10000]
+    print('NSJson backend: %s' % NSJson.JSON_BACKEND)
+    for size in sizes:
+        benchmark(size)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Netboot Studio Benchmark: Stage2 Rendering
+"""
+
+#    This file is part of Netboot Studio, a system for managing netboot clients
+#    Copyright (C) 2020-2023 James Bishop (james@bishopdynamics.com)
+
+# measures how many stage2.ipxe responses per second can be rendered for a folder boot image, the part of get_stage2 that touches files:
+#   uncached: open and parse metadata.yaml, validate it, read the stage2 file, and concatenate everything, on every request
+#   cached: look up metadata in NSBootImageCatalog and stage2 body in NSFileCache (one stat() each), and only render the per-client variables
+# this does not include aiohttp itself, or the client lookup, which are the same either way
+# usage: ./benchmark-stage2.py [seconds]
+
+import sys
+import time
+import yaml
+import pathlib
+import tempfile
+
+from NSCommon import validate_boot_image_metadata
+from NSFileCache import NSFileCache
+from NSBootImageCatalog import NSBootImageCatalog
+
+# stand-ins for NSStageServer.stage2_preamble and stage2_epilogue, which are about this size
+PREAMBLE = '#!ipxe\n' + '    set some-variable ${some-other-variable}\n' * 40
+EPILOGUE = '\n' + '    item some-item Some Menu Item\n' * 80
+VARIABLES = '''
+    set boot-image-name %s
+    set client-ip %s
+    set client-mac %s
+    set client-hostname %s
+'''
+
+METADATA = {
+    'created': '2023-04-07 00:00:00 +0000',
+    'image_type': 'debian-webinstaller',
+    'description': 'Debian 11 Webinstaller',
+    'release': 'bullseye',
+    'arch': 'amd64',
+    'stage2_filename': 'stage2.ipxe',
+    'stage2_unattended_filename': 'stage2-unattended.ipxe',
+    'supports_unattended': True,
+}
+
+
+def make_boot_image(boot_images):
+    b_path = boot_images.joinpath('debian-11-amd64')
+    b_path.mkdir()
+    with open(b_path.joinpath('metadata.yaml'), 'w') as mf:
+        yaml.dump(METADATA, mf)
+    stage2 = 'kernel ${boot-image-path}/linux initrd=initrd.gz auto=true priority=critical url=${unattended-url-linux}\n' * 10
+    for name in ['stage2.ipxe', 'stage2-unattended.ipxe']:
+        with open(b_path.joinpath(name), 'w') as sf:
+            sf.write(stage2)
+    return b_path
+
+
+def render_uncached(b_path):
+    with open(b_path.joinpath('metadata.yaml'), 'r') as mf:
+        metadata = yaml.full_load(mf)
+    metadata['boot_image_name'] = b_path.name
+    if not validate_boot_image_metadata(metadata):
+        raise Exception('metadata validation failed')
+    with open(b_path.joinpath(metadata['stage2_filename']), 'r') as bpf:
+        file_content = bpf.read()
+    variables = VARIABLES % (b_path.name, '192.168.1.10', '00:0c:29:f1:58:a4', 'client-1')
+    return PREAMBLE + variables + file_content + EPILOGUE
+
+
+def load_body(file_path):
+    with open(file_path, 'r') as bpf:
+        return bpf.read() + EPILOGUE
+
+
+body_cache = NSFileCache('body', load_body)
+catalog = None
+
+
+def render_cached(b_path):
+    metadata = catalog.lookup(b_path.name)['metadata']
+    body = body_cache.get(b_path.joinpath(metadata['stage2_filename']))
+    variables = VARIABLES % (b_path.name, '192.168.1.10', '00:0c:29:f1:58:a4', 'client-1')
+    return PREAMBLE + variables + body
+
+
+def measure(render, b_path, seconds):
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        render(b_path)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        boot_image = make_boot_image(pathlib.Path(temp_dir))
+        catalog = NSBootImageCatalog({'boot_images': pathlib.Path(temp_dir), 'boot_image_catalog': pathlib.Path(temp_dir).joinpath('catalog.json')})
+        catalog.refresh()
+        assert render_uncached(boot_image) == render_cached(boot_image)
+        uncached = measure(render_uncached, boot_image, duration)
+        cached = measure(render_cached, boot_image, duration)
+    print('uncached: %10.0f renders/sec' % uncached)
+    print('cached:   %10.0f renders/sec  (%.0fx)' % (cached, cached / uncached))
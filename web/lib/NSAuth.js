@@ -192,6 +192,29 @@ async function postData(url = '', data = {}, timeout=POST_FETCH_TIMEOUT) {
     return _res;
 }
 
+async function export_clients(export_format='csv') {
+    // download all clients from /clients/export, which wants auth_token as a header, so it can not be a plain link
+    const response = await fetch(URL_APISERVER + '/clients/export?format=' + export_format, {
+        method: 'GET',
+        mode: 'cors',
+        cache: 'no-cache',
+        headers: {
+            'auth_token': GetAuthTokenFromSessionStorage(),
+        },
+        referrerPolicy: 'no-referrer',
+    });
+    if (response.status !== 200) {
+        console.error('Failed to export clients. status: ' + response.status);
+        return;
+    }
+    const object_url = URL.createObjectURL(await response.blob());
+    download_a_file(object_url, 'clients.' + export_format);
+    // the download has started by the time the click returns, but give it a moment anyway
+    setTimeout(function() {
+        URL.revokeObjectURL(object_url);
+    }, 1000);
+}
+
 function APICall(endpoint, payload={}, callback=null) {
     // make an api call and pass the result to the callback
     const _message = new NSMessage();
@@ -203,12 +226,28 @@ function APICall(endpoint, payload={}, callback=null) {
         id: request_id,
         endpoint: endpoint,
         api_payload: payload,
+        reply_to: MQTT_REPLY_TOPIC, // so that only this page receives the response
     });
     // register callback first
     if (request_id in REQUEST_REGISTER) {
         console.error('somehow there is already a request with this id in the register (this should be impossible): ' + request_id);
     } else {
-        REQUEST_REGISTER[request_id] = callback;
+        REQUEST_REGISTER[request_id] = {
+            endpoint: endpoint,
+            callback: callback,
+            sent: Date.now(),
+        };
         MQTT_CLIENT.publish(topic, _message.to_json());
     }
 }
+
+function expire_requests() {
+    // forget requests which were never answered, ex: sent while the api server was restarting
+    const stale = Date.now() - REQUEST_TIMEOUT;
+    Object.keys(REQUEST_REGISTER).forEach(function(request_id) {
+        if (REQUEST_REGISTER[request_id]['sent'] < stale) {
+            console.warn('no response to api request: ' + REQUEST_REGISTER[request_id]['endpoint'] + ', id: ' + request_id);
+            delete REQUEST_REGISTER[request_id];
+        }
+    });
+}
@@ -120,6 +120,31 @@ function getDataSourceByName(data_source_name) {
     return found_data_source;
 }
 
+// parse an mqtt message, which is either plain json, or a compressed envelope: {"__ns_encoding":"zlib","payload":"<base64>"}
+//   large messages are compressed by the server, see payload_dumps in NSJson.py
+//   an envelope has exactly those two keys, anything else is plain json which happens to start the same way
+//   returns a promise, since DecompressionStream is async
+async function parse_payload(message) {
+    const text = message.toString();
+    if (!text.startsWith('{"__ns_encoding":"')) {
+        return JSON.parse(text);
+    }
+    const envelope = JSON.parse(text);
+    const keys = Object.keys(envelope);
+    if (keys.length !== 2 || !keys.includes('__ns_encoding') || typeof envelope['payload'] !== 'string') {
+        return envelope;
+    }
+    if (envelope['__ns_encoding'] !== 'zlib') {
+        throw new Error('unsupported payload encoding: ' + envelope['__ns_encoding']);
+    }
+    const compressed = Uint8Array.from(atob(envelope['payload']), function(c) {
+        return c.charCodeAt(0);
+    });
+    // zlib is what DecompressionStream calls deflate
+    const stream = new Blob([compressed]).stream().pipeThrough(new DecompressionStream('deflate'));
+    return JSON.parse(await new Response(stream).text());
+}
+
 class NSMessage {
     // common message format for http, websocket, and mqtt messages
     // if this came from the broker via a topic, that gets set within the message, otherwise it is blank and you must set it yourself
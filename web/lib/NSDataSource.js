@@ -1,6 +1,10 @@
 // NSDataSource
 
 
+// values have a version and a source_id, changes to keyed lists arrive as a delta: added, changed and removed entries
+//   a delta is applied only if we have the version it was made from, otherwise we ask for the current value
+//   large messages arrive compressed and are decompressed asynchronously, so messages are queued to be handled in the order they arrived
+
 class NSDataSource {
     constructor(mqtt_client, name, static_data, on_change) {
         this.mqtt_client = mqtt_client;
@@ -9,6 +13,9 @@ class NSDataSource {
         this.static_data = static_data;
         this.value = {};
         this.value_json = JSON.stringify(this.value);
+        this.version = 0;
+        this.source_id = null;
+        this.message_queue = Promise.resolve();
         this.mqtt_topic = 'NetbootStudio/DataSources/' + this.name;
         this.setup();
     }
@@ -17,10 +24,7 @@ class NSDataSource {
         // subscribe to topic
         console.log('setting up data source: ' + this.name);
         this.mqtt_client.subscribe(this.mqtt_topic);
-        const request_message = {
-            message_type: 'request',
-        };
-        this.mqtt_client.publish(this.mqtt_topic, JSON.stringify(request_message));
+        this.request_value();
         // you can have multiple instances registered with the same name, handle_message will be called for all of them
         DATA_SOURCE_REGISTER.push({
             name: this.name,
@@ -28,13 +32,64 @@ class NSDataSource {
         });
     }
 
+    request_value() {
+        // ask the provider for the whole current value
+        const request_message = {
+            message_type: 'request',
+        };
+        this.mqtt_client.publish(this.mqtt_topic, JSON.stringify(request_message));
+    }
+
+    apply_delta(delta) {
+        const key_field = delta['key_field'];
+        const entries = new Map();
+        this.value.forEach(function(entry) {
+            entries.set(entry[key_field], entry);
+        });
+        // order is only sent if it changed
+        const order = delta['order'] || Array.from(entries.keys());
+        delta['removed'].forEach(function(key) {
+            entries.delete(key);
+        });
+        delta['added'].concat(delta['changed']).forEach(function(entry) {
+            entries.set(entry[key_field], entry);
+        });
+        this.value = order.map(function(key) {
+            return entries.get(key);
+        });
+        this.value_json = JSON.stringify(this.value);
+        this.version = delta['version'];
+    }
+
     handle_message(message) {
-        // handle messages on our topic
+        // handle messages on our topic, after any still being decompressed
+        const data_source = this;
+        this.message_queue = this.message_queue.then(function() {
+            return parse_payload(message);
+        }).then(function(message_dict) {
+            data_source.handle_message_dict(message_dict);
+        }).catch(function(e) {
+            console.error('exception while parsing message for data_source: ' + data_source.name + ', ' + e);
+        });
+    }
+
+    handle_message_dict(message_dict) {
         try {
-            const message_dict = JSON.parse(message);
-            // we only care about new_value
+            // we only care about new_value, current_value and delta
             // console.log('message for: ' + this.name + ', ' + message);
-            if (message_dict['message_type'] === 'new_value' || message_dict['message_type'] === 'current_value') {
+            if (message_dict['message_type'] === 'delta') {
+                if (message_dict['source_id'] !== this.source_id || message_dict['base_version'] !== this.version) {
+                    // we missed something (or the provider restarted), a delta is no use to us
+                    console.log('version gap for data_source: ' + this.name + ', have: ' + this.version + ', delta from: ' + message_dict['base_version']);
+                    this.request_value();
+                    return;
+                }
+                this.apply_delta(message_dict);
+                console.log('new delta for data_source: ' + this.name + ', value: ', this.value);
+                this.onchange(this.value, this.static_data);
+            } else if (message_dict['message_type'] === 'new_value' || message_dict['message_type'] === 'current_value') {
+                this.source_id = message_dict['source_id'] || null;
+                this.version = message_dict['version'] || 0;
                 const new_json = JSON.stringify(message_dict['value']);
                 if (this.value_json !== new_json) {
                     console.log('new value for data_source: ' + this.name + ', value: ', message_dict['value']);
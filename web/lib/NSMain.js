@@ -42,7 +42,11 @@ const MODAL_OPTIONS = {
 
 let MQTT_CLIENT = null;
 
-const REQUEST_REGISTER = {}; // requests are stored here by id, alond with reference to callback
+const REQUEST_REGISTER = {}; // requests are stored here by id, alond with reference to callback and when it was sent
+const REQUEST_TIMEOUT = 120000; // ms, requests without a response after this long are dropped from the register
+
+// api responses for this page only arrive here, the api server publishes to the reply topic named in each request
+let MQTT_REPLY_TOPIC = null;
 
 const DATA_SOURCE_REGISTER = []; // data sources are stored here
 
@@ -100,6 +104,7 @@ document.addEventListener('DOMContentLoaded', onPageReady);
 function SetupMQTTClient() {
     let client = null;
     const client_id = 'NSWebUI-Browser-' + uuid4();
+    MQTT_REPLY_TOPIC = 'api_response/' + client_id;
     console.debug('attempting to connect to broker: ' + URL_BROKER);
     try {
         // connect, reconnect, close, disconnect, offline, error, message
@@ -127,19 +132,23 @@ function SetupMQTTClient() {
         });
         client.on('message', function(topic, message) {
             // console.info('A message has arrived on topic: ' + topic + ', message: ' + message);
-            if (topic === 'api_response') {
-                try {
-                    const ns_message = new NSMessage(message);
-                    const content = ns_message.get_key('content');
+            if (topic === MQTT_REPLY_TOPIC) {
+                // large responses arrive compressed, so parsing is async
+                parse_payload(message).then(function(message_data) {
+                    const content = message_data['content'];
                     if (content.id in REQUEST_REGISTER) {
-                        REQUEST_REGISTER[content.id](content.api_payload.result); // pass result to callback
+                        // content.id is the correlation id of the request
+                        const callback = REQUEST_REGISTER[content.id]['callback'];
                         delete REQUEST_REGISTER[content.id]; // clean up
+                        if (callback !== null) {
+                            callback(content.api_payload.result); // pass result to callback
+                        }
                     } else {
                         console.warn('ignoring reqponse to unregistered request id: ' + content.id);
                     }
-                } catch (ex) {
-                    console.error('failed to handle mqtt message on topic: api_response: ' + ex);
-                }
+                }).catch(function(ex) {
+                    console.error('failed to handle mqtt message on topic: ' + topic + ': ' + ex);
+                });
             } else if (topic.includes('NetbootStudio/DataSources/')) {
                 DATA_SOURCE_REGISTER.forEach(function(data_source) {
                     if (topic === 'NetbootStudio/DataSources/' + data_source['name']) {
@@ -150,8 +159,9 @@ function SetupMQTTClient() {
                 console.info('ignoring message on topic: ' + topic);
             }
         });
-        client.subscribe('api_response');
+        client.subscribe(MQTT_REPLY_TOPIC);
         client.subscribe('task_status');
+        setInterval(expire_requests, REQUEST_TIMEOUT / 4);
     } catch (e) {
         console.error('failed to setup mqtt client ( ' + URL_BROKER + ' ): ' + e);
     }